@@ -16,10 +16,19 @@
 #     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
 #
 import base64
+import contextvars
+import copy
+import hashlib
 import json
 import os
 import pathlib
+import tempfile
+import threading
 import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, Optional, Tuple
 
 # import osm_fieldwork
 
@@ -36,10 +45,24 @@ from sqlalchemy.orm import Session
 from ..config import settings
 from ..db import db_models
 from ..projects import project_schemas
+from . import odk_clients
 
+# Number of converted XLSForms kept in memory
+XFORM_TEMPLATE_CACHE_SIZE = 32
 
-def get_odk_project(odk_central: project_schemas.ODKCentral = None):
-    """Helper function to get the OdkProject with credentials."""
+_xform_templates = OrderedDict()
+_xform_templates_lock = threading.Lock()
+# [lock, number of threads using it] of the XLSForms being converted, by
+# cache key. Entries are removed once no thread uses them.
+_xform_template_locks = {}
+
+
+def get_odk_client(client_class, odk_central: project_schemas.ODKCentral = None):
+    """Get an osm_fieldwork client of a class, with the project's credentials.
+
+    The client shares the keep-alive session and auth token of its server,
+    see odk_clients.
+    """
     if odk_central:
         url = odk_central.odk_central_url
         user = odk_central.odk_central_user
@@ -53,65 +76,27 @@ def get_odk_project(odk_central: project_schemas.ODKCentral = None):
 
     try:
         logger.debug(f"Connecting to ODKCentral: url={url} user={user}")
-        project = OdkProject(url, user, pw)
+        return odk_clients.get_client(client_class, url, user, pw)
     except Exception as e:
         logger.error(e)
         raise HTTPException(
             status_code=500, detail=f"Error creating project on ODK Central: {e}"
         ) from e
 
-    return project
+
+def get_odk_project(odk_central: project_schemas.ODKCentral = None):
+    """Helper function to get the OdkProject with credentials."""
+    return get_odk_client(OdkProject, odk_central)
 
 
 def get_odk_form(odk_central: project_schemas.ODKCentral = None):
     """Helper function to get the OdkForm with credentials."""
-    if odk_central:
-        url = odk_central.odk_central_url
-        user = odk_central.odk_central_user
-        pw = odk_central.odk_central_password
-
-    else:
-        logger.debug("ODKCentral connection variables not set in function")
-        logger.debug("Attempting extraction from environment variables")
-        url = settings.ODK_CENTRAL_URL
-        user = settings.ODK_CENTRAL_USER
-        pw = settings.ODK_CENTRAL_PASSWD
-
-    try:
-        logger.debug(f"Connecting to ODKCentral: url={url} user={user}")
-        form = OdkForm(url, user, pw)
-    except Exception as e:
-        logger.error(e)
-        raise HTTPException(
-            status_code=500, detail=f"Error creating project on ODK Central: {e}"
-        ) from e
-
-    return form
+    return get_odk_client(OdkForm, odk_central)
 
 
 def get_odk_app_user(odk_central: project_schemas.ODKCentral = None):
     """Helper function to get the OdkAppUser with credentials."""
-    if odk_central:
-        url = odk_central.odk_central_url
-        user = odk_central.odk_central_user
-        pw = odk_central.odk_central_password
-    else:
-        logger.debug("ODKCentral connection variables not set in function")
-        logger.debug("Attempting extraction from environment variables")
-        url = settings.ODK_CENTRAL_URL
-        user = settings.ODK_CENTRAL_USER
-        pw = settings.ODK_CENTRAL_PASSWD
-
-    try:
-        logger.debug(f"Connecting to ODKCentral: url={url} user={user}")
-        form = OdkAppUser(url, user, pw)
-    except Exception as e:
-        logger.error(e)
-        raise HTTPException(
-            status_code=500, detail=f"Error creating project on ODK Central: {e}"
-        ) from e
-
-    return form
+    return get_odk_client(OdkAppUser, odk_central)
 
 
 def list_odk_projects(odk_central: project_schemas.ODKCentral = None):
@@ -152,28 +137,113 @@ def delete_odk_project(project_id: int, odk_central: project_schemas.ODKCentral
     return result
 
 
-def create_appuser(project_id: int, name: str, odk_credentials: dict = None):
-    """Create an app-user on a remote ODK Server.
-    If odk credentials of the project are provided, use them to create an app user.
+def odk_login(odk_credentials: dict = None) -> tuple:
+    """Get the url, user and password of the project's ODK Central server.
+
+    Falls back to the server set in the environment if the project has none.
     """
     if odk_credentials:
-        url = odk_credentials["odk_central_url"]
-        user = odk_credentials["odk_central_user"]
-        pw = odk_credentials["odk_central_password"]
+        return (
+            odk_credentials["odk_central_url"],
+            odk_credentials["odk_central_user"],
+            odk_credentials["odk_central_password"],
+        )
+
+    logger.debug("ODKCentral connection variables not set in function")
+    logger.debug("Attempting extraction from environment variables")
+    return (
+        settings.ODK_CENTRAL_URL,
+        settings.ODK_CENTRAL_USER,
+        settings.ODK_CENTRAL_PASSWD,
+    )
 
-    else:
-        logger.debug("ODKCentral connection variables not set in function")
-        logger.debug("Attempting extraction from environment variables")
-        url = settings.ODK_CENTRAL_URL
-        user = settings.ODK_CENTRAL_USER
-        pw = settings.ODK_CENTRAL_PASSWD
 
-    app_user = OdkAppUser(url, user, pw)
+def create_appuser(project_id: int, name: str, odk_credentials: dict = None):
+    """Create an app-user on a remote ODK Server.
+    If odk credentials of the project are provided, use them to create an app user.
+    """
+    app_user = odk_clients.get_client(OdkAppUser, *odk_login(odk_credentials))
     result = app_user.create(project_id, name)
     logger.info(f"Created app user: {result.json()}")
     return result
 
 
+def create_appusers(
+    project_id: int,
+    names: dict,
+    odk_credentials: dict = None,
+    max_workers: int = settings.ODK_CENTRAL_CONCURRENCY,
+) -> dict:
+    """Create many app-users on a remote ODK Server, over one session.
+
+    names maps task ids to app-user names. The requests share a keep-alive
+    connection, and run concurrently, max_workers at a time.
+    Returns the created app-users by task id, each with its id and token.
+    Tasks whose app-user could not be created are logged and left out.
+    """
+    app_user = odk_clients.get_client(OdkAppUser, *odk_login(odk_credentials))
+
+    def create(task_id: int):
+        result = app_user.create(project_id, names[task_id])
+        result.raise_for_status()
+        return result.json()
+
+    appusers = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # In copies of this context, to log to the job log of the caller
+        futures = {
+            executor.submit(contextvars.copy_context().run, create, task_id): task_id
+            for task_id in names
+        }
+        for future in as_completed(futures):
+            task_id = futures[future]
+            try:
+                appusers[task_id] = future.result()
+            except Exception as e:
+                logger.error(f"Couldn't create appuser for task {task_id}: {e}")
+
+    logger.info(f"Created {len(appusers)} app users in ODK project {project_id}")
+    return appusers
+
+
+def assign_appuser_roles(
+    project_id: int,
+    actors: dict,
+    odk_credentials: dict = None,
+    max_workers: int = settings.ODK_CENTRAL_CONCURRENCY,
+) -> set:
+    """Give many app-users access to their XForm, over one session.
+
+    actors maps task ids to (xform id, app-user id). The requests share a
+    keep-alive connection, and run concurrently, max_workers at a time.
+    Returns the ids of the tasks whose role was assigned.
+    """
+    app_user = odk_clients.get_client(OdkAppUser, *odk_login(odk_credentials))
+
+    def assign(task_id: int):
+        xform_id, actor_id = actors[task_id]
+        result = app_user.updateRole(
+            projectId=project_id, xform=xform_id, actorId=actor_id
+        )
+        result.raise_for_status()
+
+    assigned = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(contextvars.copy_context().run, assign, task_id): task_id
+            for task_id in actors
+        }
+        for future in as_completed(futures):
+            task_id = futures[future]
+            try:
+                future.result()
+                assigned.add(task_id)
+            except Exception as e:
+                logger.warning(f"Couldn't assign the role of task {task_id}: {e}")
+
+    return assigned
+
+
 def delete_app_user(
     project_id: int, name: str, odk_central: project_schemas.ODKCentral = None
 ):
@@ -190,20 +260,8 @@ def create_odk_xform(
     title = os.path.basename(os.path.splitext(filespec)[0])
     # result = xform.createForm(project_id, title, filespec, True)
     # Pass odk credentials of project in xform
-    if odk_credentials:
-        url = odk_credentials["odk_central_url"]
-        user = odk_credentials["odk_central_user"]
-        pw = odk_credentials["odk_central_password"]
-
-    else:
-        logger.debug("ODKCentral connection variables not set in function")
-        logger.debug("Attempting extraction from environment variables")
-        url = settings.ODK_CENTRAL_URL
-        user = settings.ODK_CENTRAL_USER
-        pw = settings.ODK_CENTRAL_PASSWD
-
     try:
-        xform = OdkForm(url, user, pw)
+        xform = odk_clients.get_client(OdkForm, *odk_login(odk_credentials))
     except Exception as e:
         logger.error(e)
         raise HTTPException(
@@ -250,6 +308,88 @@ def list_task_submissions(odk_project_id:int, form_id: str, odk_central: project
     return submissions
 
 
+def iter_fan_out(
+    call: Callable, task_ids: Iterable[int], max_workers: int = None
+) -> Iterator[Tuple[int, Any, Optional[Exception]]]:
+    """Call call(task_id) for many tasks concurrently, yielding in task order.
+
+    Yields the task id, result and error (or None) of each call. At most
+    max_workers calls (ODK_CENTRAL_FAN_OUT by default) are run or waiting
+    to be consumed at once, so only that many results are held in memory.
+    Each ODK Central request times out after ODK_CENTRAL_TIMEOUT seconds.
+    call must not share an osm_fieldwork client between tasks, as clients
+    keep the result of their last request.
+    """
+    max_workers = max_workers or settings.ODK_CENTRAL_FAN_OUT
+    task_ids = iter(dict.fromkeys(task_ids))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def submit(task_id: int) -> tuple:
+            # In a copy of this context, to log to the job log of the caller
+            context = contextvars.copy_context()
+            return task_id, executor.submit(context.run, call, task_id)
+
+        pending = deque(submit(task_id) for task_id in islice(task_ids, max_workers))
+        try:
+            while pending:
+                task_id, future = pending.popleft()
+                try:
+                    result, error = future.result(), None
+                except Exception as e:
+                    logger.warning(
+                        f"ODK Central request for task {task_id} failed: {e}"
+                    )
+                    result, error = None, e
+
+                for next_id in islice(task_ids, 1):
+                    pending.append(submit(next_id))
+                yield task_id, result, error
+        finally:
+            # Stopped early, do not start the waiting calls
+            for _, future in pending:
+                future.cancel()
+
+
+def fan_out(
+    call: Callable, task_ids: Iterable[int], max_workers: int = None
+) -> Tuple[dict, dict]:
+    """Call call(task_id) for many tasks concurrently, see iter_fan_out.
+
+    Returns the results and the errors of the calls, by task id, both in
+    the order of task_ids.
+    """
+    results, errors = {}, {}
+    for task_id, result, error in iter_fan_out(call, task_ids, max_workers):
+        if error:
+            errors[task_id] = str(error)
+        else:
+            results[task_id] = result
+    return results, errors
+
+
+def list_tasks_submissions(
+    odk_project_id: int,
+    form_ids: dict,
+    odk_central: project_schemas.ODKCentral = None,
+) -> Tuple[dict, dict]:
+    """List the submissions of many task forms concurrently.
+
+    form_ids maps task ids to the XForm ids of the tasks.
+    Returns the submission lists and the errors by task id, see fan_out.
+    """
+
+    def list_task(task_id: int):
+        xform = get_odk_form(odk_central)
+        submissions = xform.listSubmissions(odk_project_id, form_ids[task_id])
+        if not isinstance(submissions, list):
+            # ODK Central returns an error object instead
+            raise ValueError(submissions.get("message", submissions))
+        return submissions
+
+    return fan_out(list_task, form_ids)
+
+
 def list_submissions(project_id: int, odk_central: project_schemas.ODKCentral = None):
     """List submissions from a remote ODK server."""
     project = get_odk_project(odk_central)
@@ -291,35 +431,106 @@ def download_submissions(
     return fixed.splitlines()
 
 
+def download_submission_media(
+    project_id: int,
+    xform_id: str,
+    file: BinaryIO,
+    odk_central: project_schemas.ODKCentral = None,
+    chunk_size: int = 1024 * 1024,
+):
+    """Download the zip of the submissions and media of a form to a file.
+
+    The response is streamed, so it is never held in memory as a whole.
+    """
+    xform = get_odk_form(odk_central)
+    url = f"{xform.base}projects/{project_id}/forms/{xform_id}/submissions.csv.zip"
+    with xform.session.get(
+        url, auth=xform.auth, verify=xform.verify, stream=True
+    ) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size):
+            file.write(chunk)
+    file.seek(0)
+
+
+def convert_xlsform(xlsform: str) -> dict:
+    """Convert an XLSForm to an XForm, parsed with xmltodict."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outfile = os.path.join(tmpdir, "template.xml")
+        try:
+            xls2xform_convert(xlsform_path=xlsform, xform_path=outfile, validate=False)
+        except Exception as e:
+            logger.error(f"Couldn't convert {xlsform} to an XForm! {e}")
+            raise HTTPException(status_code=400, detail=str(e)) from e
+
+        if os.path.getsize(outfile) <= 0:
+            logger.warning(f"{outfile} is empty!")
+            raise HTTPException(status_code=400, detail=f"{outfile} is empty!")
+
+        with open(outfile, "r") as xml:
+            return xmltodict.parse(xml.read())
+
+
+def get_xform_template(xlsform: str) -> dict:
+    """Get the XForm of an XLSForm, parsed with xmltodict.
+
+    The conversion is slow, so it is done once per distinct XLSForm, keyed
+    by the file name and a hash of its contents, and the result is cached.
+    Conversions hold a lock of their own key only, so other forms are
+    converted, and cached templates returned, meanwhile.
+    Callers must copy the returned template before changing it.
+    """
+    with open(xlsform, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    key = (os.path.basename(xlsform), digest)
+
+    with _xform_templates_lock:
+        if key in _xform_templates:
+            _xform_templates.move_to_end(key)
+            return _xform_templates[key]
+        key_lock = _xform_template_locks.setdefault(key, [threading.Lock(), 0])
+        key_lock[1] += 1
+
+    try:
+        with key_lock[0]:
+            # Another thread may have converted it while this one waited
+            with _xform_templates_lock:
+                if key in _xform_templates:
+                    return _xform_templates[key]
+
+            template = convert_xlsform(xlsform)
+
+            with _xform_templates_lock:
+                _xform_templates[key] = template
+                if len(_xform_templates) > XFORM_TEMPLATE_CACHE_SIZE:
+                    _xform_templates.popitem(last=False)
+            return template
+    finally:
+        # Kept while threads wait on it, even if the conversion failed, so
+        # that a new thread never converts the same form alongside them
+        with _xform_templates_lock:
+            key_lock[1] -= 1
+            if not key_lock[1]:
+                _xform_template_locks.pop(key, None)
+
+
 def generate_updated_xform(
-    db: Session,
-    task_id: dict,
+    task_id: int,
     xlsform: str,
     xform: str,
 ):
-    """Update the version in an XForm so it's unique."""
+    """Update the version in an XForm so it's unique.
+
+    The XForm is built from the cached template of the XLSForm, only
+    substituting the data extract, form id and title of this task.
+    """
     name = os.path.basename(xform).replace(".xml", "")
     outfile = xform
-    try:
-        xls2xform_convert(xlsform_path=xlsform, xform_path=outfile, validate=False)
-    except Exception as e:
-        logger.error(f"Couldn't convert {xlsform} to an XForm!", str(e))
-        raise HTTPException(status_code=400, detail=str(e)) from e
-
-    if os.path.getsize(outfile) <= 0:
-        logger.warning(f"{outfile} is empty!")
-        raise HTTPException(status=400, detail=f"{outfile} is empty!") from None
-
-    xls = open(outfile, "r")
-    data = xls.read()
-    xls.close()
 
     tmp = name.split("_")
-    tmp[0]
-    tmp[1]
     id = tmp[2].split(".")[0]
     extract = f"jr://file/{name}.geojson"
-    xml = xmltodict.parse(str(data))
+    xml = copy.deepcopy(get_xform_template(xlsform))
     # First change the osm data extract file
     index = 0
     for inst in xml["h:html"]["h:head"]["model"]["instance"]:
@@ -364,8 +575,10 @@ def generate_updated_xform(
     return outfile
 
 
-def create_qrcode(project_id: int, token: str, name: str, odk_credentials: dict = None):
-    """Create the QR Code for an app-user."""
+def get_qrcode_data(
+    project_id: int, token: str, name: str, odk_credentials: dict = None
+):
+    """Get the ODK Collect settings encoded in the QR Code of an app-user."""
     if odk_credentials:
         central_url = odk_credentials["odk_central_url"]
 
@@ -387,9 +600,12 @@ def create_qrcode(project_id: int, token: str, name: str, odk_credentials: dict
     }
 
     # Base64 encoded
-    qr_data = base64.b64encode(
-        zlib.compress(json.dumps(qr_code_setting).encode("utf-8"))
-    )
+    return base64.b64encode(zlib.compress(json.dumps(qr_code_setting).encode("utf-8")))
+
+
+def create_qrcode(project_id: int, token: str, name: str, odk_credentials: dict = None):
+    """Create the QR Code for an app-user."""
+    qr_data = get_qrcode_data(project_id, token, name, odk_credentials)
 
     # Generate qr code using segno
     qrcode = segno.make(qr_data, micro=False)
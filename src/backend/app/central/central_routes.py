@@ -32,6 +32,7 @@ from sqlalchemy.sql import text
 from ..central import central_crud
 from ..db import database
 from ..projects import project_crud, project_schemas
+from ..submission import submission_sync
 
 router = APIRouter(
     prefix="/central",
@@ -134,7 +135,19 @@ async def list_submissions(
     xml_form_id: str = None,
     db: Session = Depends(database.get_db),
     ):
+    """List the submissions of the project forms, or of one form.
+
+    Returns the submission metadata of each form. Once the project has been
+    synced (see POST /submission/sync), it is read from the local copy.
+    """
     try:
+        if submission_sync.use_local_copy(db, project_id):
+            forms = submission_sync.get_form_submissions(db, project_id, xml_form_id)
+            return [
+                [submission_sync.submission_metadata(record) for record in records]
+                for records in forms.values()
+            ]
+
         project = table(
             "projects", column("project_name_prefix"), column("xform_title"), column("id"), column("odkid")
         )
@@ -189,10 +202,19 @@ async def get_submission(
     submission_id:str: the submission id of the submission in Central.
 
     If the submission_id is provided, an individual submission is returned.
+    Once the project has been synced (see POST /submission/sync), the
+    submissions are read from the local copy.
 
     Returns: Submission json.
     """
     try:
+        if submission_sync.use_local_copy(db, project_id):
+            forms = submission_sync.get_form_submissions(
+                db, project_id, xmlFormId, submission_id
+            )
+            # In the shape of the ODK Central OData responses
+            return [{"value": records} for records in forms.values()]
+
         """Download the submissions data from Central."""
         project = table(
             "projects", column("project_name_prefix"), column("xform_title"), column("id"), column("odkid"),
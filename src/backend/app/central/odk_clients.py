@@ -0,0 +1,206 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+"""Process-wide registry of ODK Central connections.
+
+osm_fieldwork clients open a new HTTP session for every instance, and send
+the user's password with every request. The registry keeps one keep-alive
+session per (url, user) instead, which authenticates with an ODK Central
+session token, cached until shortly before it expires. The clients are
+still created per call, as they keep the results of their last request,
+but they share the session of their server.
+
+The least recently used sessions are closed once more than
+MAX_SESSIONS servers have been used.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Type, TypeVar
+
+import requests
+from fastapi.logger import logger as logger
+from osm_fieldwork.OdkCentral import OdkCentral
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase, HTTPBasicAuth
+
+from ..config import settings
+
+# Number of ODK Central (url, user) sessions kept open
+MAX_SESSIONS = 16
+
+# Session tokens are renewed this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 60
+
+OdkClient = TypeVar("OdkClient", bound=OdkCentral)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """Apply a default timeout to the requests that do not set one.
+
+    osm_fieldwork does not pass a timeout, so a stalled server would
+    otherwise block the calling thread forever.
+    """
+
+    def __init__(self, timeout: float, **kwargs):
+        """Use timeout, in seconds, for the requests without one."""
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        """Send a request, with the default timeout if it has none."""
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class OdkTokenAuth(AuthBase):
+    """Authenticate requests with a cached ODK Central session token.
+
+    Falls back to basic auth if a token cannot be created, so the request
+    fails (or succeeds) as it would have without the token. A request
+    refused because the server ended the session is retried once, with a
+    new token.
+    """
+
+    def __init__(self, session: requests.Session, url: str, user: str, passwd: str):
+        """Create the session tokens of user with session, on the server at url."""
+        self.session = session
+        self.url = url
+        self.basic = HTTPBasicAuth(user, passwd)
+        self.user = user
+        self.passwd = passwd
+        self.token = None
+        self.expires = 0.0
+        self.lock = threading.Lock()
+
+    def get_token(self) -> Optional[str]:
+        """Get the cached session token, creating a new one if it expired."""
+        with self.lock:
+            if self.token and time.time() < self.expires - TOKEN_EXPIRY_MARGIN:
+                return self.token
+
+            response = self.session.post(
+                f"{self.url}/v1/sessions",
+                json={"email": self.user, "password": self.passwd},
+            )
+            if not response.ok:
+                logger.warning(
+                    f"Could not create an ODK Central session for {self.user}: "
+                    f"{response.status_code}"
+                )
+                self.token = None
+                return None
+
+            data = response.json()
+            expires = datetime.fromisoformat(data["expiresAt"].replace("Z", "+00:00"))
+            self.token, self.expires = data["token"], expires.timestamp()
+            return self.token
+
+    def handle_401(self, response: requests.Response, **kwargs):
+        """Drop a token the server no longer accepts, and retry with a new one.
+
+        Requests whose body is a file are not retried, as it was read.
+        """
+        if response.status_code != 401:
+            return response
+
+        with self.lock:
+            # Unless another request has already replaced it
+            if response.request.headers.get("Authorization") == f"Bearer {self.token}":
+                self.token = None
+        token = self.get_token()
+        if not token or hasattr(response.request.body, "read"):
+            return response
+
+        # Read the body, so the connection can be reused
+        response.content
+        response.close()
+        retry = response.request.copy()
+        retry.headers["Authorization"] = f"Bearer {token}"
+        retried = response.connection.send(retry, **kwargs)
+        retried.history.append(response)
+        retried.request = retry
+        return retried
+
+    def __call__(self, request: requests.PreparedRequest):
+        """Add the token, or basic auth, to a request."""
+        token = self.get_token()
+        if not token:
+            return self.basic(request)
+
+        request.headers["Authorization"] = f"Bearer {token}"
+        request.register_hook("response", self.handle_401)
+        return request
+
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def get_session(url: str, user: str, passwd: str, verify=True) -> tuple:
+    """Get the shared session and auth of an ODK Central server and user."""
+    key = (url, user)
+    with _sessions_lock:
+        entry = _sessions.get(key)
+        if entry and entry[1].passwd == passwd:
+            _sessions.move_to_end(key)
+            return entry
+
+        session = requests.Session()
+        session.verify = verify
+        # Enough pooled connections for the concurrent requests of a job
+        adapter = TimeoutHTTPAdapter(
+            timeout=settings.ODK_CENTRAL_TIMEOUT,
+            pool_maxsize=max(
+                settings.ODK_CENTRAL_CONCURRENCY * 2, settings.ODK_CENTRAL_FAN_OUT, 10
+            ),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        entry = (session, OdkTokenAuth(session, url, user, passwd))
+
+        if key in _sessions:
+            _sessions.pop(key)[0].close()
+        _sessions[key] = entry
+        while len(_sessions) > MAX_SESSIONS:
+            _, (old_session, _) = _sessions.popitem(last=False)
+            old_session.close()
+        return entry
+
+
+def get_client(
+    client_class: Type[OdkClient], url: str, user: str, passwd: str
+) -> OdkClient:
+    """Create an osm_fieldwork client using the shared session of its server."""
+    client = client_class(url, user, passwd)
+    session, auth = get_session(client.url, client.user, client.passwd, client.verify)
+    client.session.close()
+    client.session = session
+    client.auth = auth
+    return client
+
+
+def clear():
+    """Close all the shared sessions."""
+    with _sessions_lock:
+        for session, _ in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -105,6 +105,30 @@ class Settings(BaseSettings):
     ODK_CENTRAL_URL: Optional[AnyUrl]
     ODK_CENTRAL_USER: Optional[str]
     ODK_CENTRAL_PASSWD: Optional[str]
+    # Maximum number of simultaneous requests to ODK Central per job
+    ODK_CENTRAL_CONCURRENCY: int = 4
+    # Maximum number of simultaneous per-task requests when reading a project
+    ODK_CENTRAL_FAN_OUT: int = 8
+    # Seconds to wait for ODK Central to connect, or to send more data
+    ODK_CENTRAL_TIMEOUT: float = 60
+    # Seconds before the local copy of a project's submissions is refreshed
+    SUBMISSION_SYNC_INTERVAL: int = 300
+
+    RAW_DATA_API_URL: str = "https://raw-data-api0.hotosm.org/v1"
+
+    EXTRACT_CACHE_DIR: str = "/tmp/fmtm_extracts"
+    EXTRACT_CACHE_TTL: int = 24 * 60 * 60
+    EXTRACT_CACHE_MAX_SIZE: int = 1024 * 1024 * 1024
+
+    # Background job workers (python -m app.jobs.worker)
+    JOB_WORKERS: int = 2
+    JOB_POLL_INTERVAL: float = 2
+    JOB_HEARTBEAT_INTERVAL: int = 15
+    # Jobs without a heartbeat for this long are retried, or failed
+    JOB_HEARTBEAT_TIMEOUT: int = 120
+    JOB_MAX_ATTEMPTS: int = 3
+    # Uploads are spooled here for the workers, so it must be shared with them
+    JOB_FILES_DIR: str = "/tmp/fmtm_jobs"
 
     OSM_CLIENT_ID: str
     OSM_CLIENT_SECRET: str
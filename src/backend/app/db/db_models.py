@@ -50,6 +50,7 @@ from ..models.enums import (
     ProjectStatus,
     TaskAction,
     TaskCreationMode,
+    TaskGenerationStage,
     TaskStatus,
     TeamVisibility,
     UserRole,
@@ -348,7 +349,7 @@ class DbTask(Base):
     )
     project_task_index = Column(Integer)
     project_task_name = Column(String)
-    outline = Column(Geometry("POLYGON", srid=4326))
+    outline = Column(Geometry("POLYGON", srid=4326, spatial_index=False))
     geometry_geojson = Column(String)
     initial_feature_count = Column(Integer)
     task_status = Column(Enum(TaskStatus), default=TaskStatus.READY)
@@ -374,6 +375,11 @@ class DbTask(Base):
     lock_holder = relationship(DbUser, foreign_keys=[locked_by])
     mapper = relationship(DbUser, foreign_keys=[mapped_by])
 
+    __table_args__ = (
+        Index("idx_tasks_outline", outline, postgresql_using="gist"),
+        {},
+    )
+
     ## ---------------------------------------------- ##
     # FOR REFERENCE: OTHER ATTRIBUTES IN TASKING MANAGER
     # x = Column(Integer)
@@ -566,18 +572,90 @@ class DbFeatures(Base):
     category = relationship(DbXForm)
     task_id = Column(Integer, nullable=True)
     properties = Column(JSONB)
-    geometry = Column(Geometry(geometry_type="GEOMETRY", srid=4326))
+    geometry = Column(
+        Geometry(geometry_type="GEOMETRY", srid=4326, spatial_index=False)
+    )
 
     __table_args__ = (
         ForeignKeyConstraint(
             [task_id, project_id], ["tasks.id", "tasks.project_id"], name="fk_tasks"
         ),
         Index("idx_features_composite", "task_id", "project_id"),
+        Index("idx_features_geometry", geometry, postgresql_using="gist"),
+        {},
+    )
+
+
+class DbTaskGeneration(Base):
+    """Progress of the app user and form generation of each task.
+
+    Stages are recorded as they finish, so a failed generation can be
+    resumed without recreating the app users and forms already done.
+    """
+
+    __tablename__ = "task_generation"
+
+    task_id = Column(Integer, primary_key=True)
+    project_id = Column(Integer, ForeignKey("projects.id"), primary_key=True)
+    stage = Column(Enum(TaskGenerationStage), nullable=False)
+    appuser_id = Column(Integer)
+    appuser_token = Column(String)
+    updated = Column(DateTime, default=timestamp, onupdate=timestamp)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            [task_id, project_id],
+            ["tasks.id", "tasks.project_id"],
+            name="fk_tasks",
+            ondelete="CASCADE",
+        ),
         {},
     )
 
 
+class DbSubmission(Base):
+    """Local copy of the ODK Central submissions of a project.
+
+    Kept up to date by submission_sync, so submissions can be read without
+    downloading them all from ODK Central again.
+    """
+
+    __tablename__ = "submissions"
+
+    project_id = Column(Integer, ForeignKey("projects.id"), primary_key=True)
+    instance_id = Column(String, primary_key=True)
+    task_id = Column(Integer)
+    xform_id = Column(String)
+    # __system/submissionDate, in UTC
+    submitted = Column(DateTime)
+    # The OData record of the submission
+    data = Column(JSONB)
+    geometry = Column(
+        Geometry(geometry_type="GEOMETRY", srid=4326, spatial_index=False)
+    )
+
+    __table_args__ = (
+        Index("idx_submissions_task", project_id, task_id, submitted),
+        Index("idx_submissions_geometry", geometry, postgresql_using="gist"),
+        {},
+    )
+
+
+class DbSubmissionSync(Base):
+    """The latest submission copied from each task form, see DbSubmission."""
+
+    __tablename__ = "submission_sync"
+
+    project_id = Column(Integer, ForeignKey("projects.id"), primary_key=True)
+    xform_id = Column(String, primary_key=True)
+    # High-water mark: the next sync only requests newer submissions
+    last_submission = Column(DateTime)
+    synced = Column(DateTime, default=timestamp, onupdate=timestamp)
+
+
 class BackgroundTasks(Base):
+    """Background jobs, also used as the queue read by the job workers."""
+
     __tablename__ = "background_tasks"
 
     id = Column(String, primary_key=True)
@@ -585,6 +663,20 @@ class BackgroundTasks(Base):
     status = Column(Enum(BackgroundTaskStatus), nullable=False)
     message = Column(String)
 
+    # Job queue
+    params = Column(JSONB)
+    progress = Column(JSONB)
+    created = Column(DateTime, default=timestamp)
+    started = Column(DateTime)
+    heartbeat = Column(DateTime)
+    worker = Column(String)
+    attempts = Column(Integer, default=0)
+
+    __table_args__ = (
+        Index("idx_background_tasks_queue", status, created),
+        {},
+    )
+
 
 class DbUserRoles(Base):
     __tablename__ = "user_roles"
@@ -604,5 +696,12 @@ class DbOsmLines(Base):
     id = Column(Integer, primary_key=True)
     project_id = Column(Integer, ForeignKey("projects.id"))
     project = relationship(DbProject, backref="osm_lines")
-    geometry = Column(Geometry(geometry_type="GEOMETRY", srid=4326))
+    geometry = Column(
+        Geometry(geometry_type="GEOMETRY", srid=4326, spatial_index=False)
+    )
     properties = Column(JSONB)
+
+    __table_args__ = (
+        Index("idx_osm_lines_geometry", geometry, postgresql_using="gist"),
+        {},
+    )
@@ -0,0 +1,105 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+"""Schema updates for existing databases, which create_all does not apply.
+
+Run as a module to also cluster the tables on their spatial indexes:
+
+    python -m app.db.migrations
+"""
+
+import logging
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import text
+
+logger = logging.getLogger(__name__)
+
+# GiST indexes declared in db_models, as (index name, table, geometry column)
+SPATIAL_INDEXES = [
+    ("idx_tasks_outline", "tasks", "outline"),
+    ("idx_features_geometry", "features", "geometry"),
+    ("idx_osm_lines_geometry", "osm_lines", "geometry"),
+    ("idx_submissions_geometry", "submissions", "geometry"),
+]
+
+
+def create_spatial_indexes(engine: Engine):
+    """Create any missing spatial index, then refresh the planner statistics."""
+    with engine.begin() as conn:
+        for name, table, column in SPATIAL_INDEXES:
+            conn.execute(
+                text(
+                    f"CREATE INDEX IF NOT EXISTS {name} "
+                    f"ON {table} USING gist ({column})"
+                )
+            )
+        for _, table, _ in SPATIAL_INDEXES:
+            conn.execute(text(f"ANALYZE {table}"))
+
+
+# Job queue columns added to background_tasks, as (column, type)
+BACKGROUND_TASK_COLUMNS = [
+    ("params", "JSONB"),
+    ("progress", "JSONB"),
+    ("created", "TIMESTAMP DEFAULT now()"),
+    ("started", "TIMESTAMP"),
+    ("heartbeat", "TIMESTAMP"),
+    ("worker", "VARCHAR"),
+    ("attempts", "INTEGER DEFAULT 0"),
+]
+
+
+def add_job_queue_columns(engine: Engine):
+    """Add the job queue columns and index to an existing background_tasks."""
+    with engine.begin() as conn:
+        for column, column_type in BACKGROUND_TASK_COLUMNS:
+            conn.execute(
+                text(
+                    "ALTER TABLE background_tasks "
+                    f"ADD COLUMN IF NOT EXISTS {column} {column_type}"
+                )
+            )
+        conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS idx_background_tasks_queue "
+                "ON background_tasks (status, created)"
+            )
+        )
+
+
+def cluster_spatial_indexes(engine: Engine):
+    """Physically reorder the tables by their spatial index.
+
+    Nearby geometries end up in the same pages, so spatial queries read far
+    fewer blocks. CLUSTER locks each table while it runs, so this is not
+    run at startup.
+    """
+    with engine.begin() as conn:
+        for name, table, _ in SPATIAL_INDEXES:
+            logger.info(f"Clustering {table} on {name}")
+            conn.execute(text(f"CLUSTER {table} USING {name}"))
+            conn.execute(text(f"ANALYZE {table}"))
+
+
+if __name__ == "__main__":
+    from .database import engine
+
+    add_job_queue_columns(engine)
+    create_spatial_indexes(engine)
+    cluster_spatial_indexes(engine)
@@ -16,12 +16,23 @@
 #     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
 #
 
+import csv
 import datetime
+import io
+import os
+from itertools import islice
+from typing import BinaryIO, Iterable, Iterator, List
 
+import ijson
+import shapely
 from geoalchemy2 import Geometry
 from geoalchemy2.shape import to_shape
 from geojson_pydantic import Feature
 from shapely.geometry import mapping
+from sqlalchemy.orm import Session
+
+# Number of rows sent per COPY statement when bulk loading
+COPY_CHUNK_SIZE = 10000
 
 
 def timestamp():
@@ -50,3 +61,85 @@ def get_centroid(geometry: Geometry, properties: str = {}):
             "properties": properties,
         }
         return Feature(**geojson)
+
+
+def to_ewkb(geometry, srid: int = 4326):
+    """Get the hex EWKB of a shapely geometry, as accepted by COPY."""
+    return shapely.to_wkb(shapely.set_srid(geometry, srid), hex=True, include_srid=True)
+
+
+def copy_rows(
+    db: Session,
+    table: str,
+    columns: List[str],
+    rows: Iterable[tuple],
+    chunk_size: int = COPY_CHUNK_SIZE,
+):
+    """Stream rows into a table with COPY FROM STDIN, chunk_size rows at a time.
+
+    The rows are consumed lazily, so only one chunk is held in memory.
+    Geometries should be passed as hex EWKB and JSONB values as JSON strings.
+    The copy runs in the session transaction and is not committed.
+    Returns the number of rows copied.
+    """
+    cursor = db.connection().connection.cursor()
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+
+    rows = iter(rows)
+    total = 0
+    while chunk := list(islice(rows, chunk_size)):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(chunk)
+        buffer.seek(0)
+        cursor.copy_expert(sql, buffer)
+        total += len(chunk)
+
+    cursor.close()
+    return total
+
+
+def iter_geojson_features(file: BinaryIO) -> Iterator[dict]:
+    """Yield the features of a GeoJSON Feature or FeatureCollection file.
+
+    The file is parsed incrementally, so only one feature is held in memory
+    at a time, whatever the size of the FeatureCollection. Raises a
+    ValueError if the file is not valid GeoJSON.
+    """
+    root = ijson.ObjectBuilder()
+    feature = None
+    try:
+        for prefix, event, value in ijson.parse(file, use_float=True):
+            if prefix == "features.item" or prefix.startswith("features.item."):
+                if prefix == "features.item" and event == "start_map":
+                    feature = ijson.ObjectBuilder()
+                if feature is None:
+                    continue
+                feature.event(event, value)
+                if prefix == "features.item" and event == "end_map":
+                    yield feature.value
+                    feature = None
+            else:
+                root.event(event, value)
+    except ijson.JSONError as e:
+        raise ValueError(f"Invalid GeoJSON: {e}") from e
+
+    geojson_type = root.value.get("type") if isinstance(root.value, dict) else None
+    if geojson_type == "Feature":
+        yield root.value
+    elif geojson_type != "FeatureCollection":
+        raise ValueError(f"Invalid GeoJSON type: {geojson_type}")
+
+
+def iter_geojson_file(path: str, remove: bool = False) -> Iterator[dict]:
+    """Yield the features of a GeoJSON file on disk, removing it when done if asked."""
+    try:
+        with open(path, "rb") as file:
+            yield from iter_geojson_features(file)
+    finally:
+        if remove:
+            os.remove(path)
+
+
+def read_geojson(file: BinaryIO) -> dict:
+    """Read a GeoJSON Feature or FeatureCollection file as a FeatureCollection."""
+    return {"type": "FeatureCollection", "features": list(iter_geojson_features(file))}
@@ -0,0 +1,168 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+"""Queue of background jobs, stored in the background_tasks table.
+
+The API enqueues jobs as PENDING rows, and the workers in app.jobs.worker
+claim them with SELECT ... FOR UPDATE SKIP LOCKED, so each job is run by
+exactly one worker however many are polling.
+"""
+
+import uuid
+from typing import Iterable, Optional
+
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import text
+
+from ..db import db_models
+from ..models.enums import BackgroundTaskStatus
+
+# Job names, each run by the handler of the same name in app.jobs.worker
+GENERATE_APPUSER_FILES = "generate_appuser_files"
+ADD_FEATURES = "add_features"
+SYNC_SUBMISSIONS = "sync_submissions"
+
+
+def enqueue_job(db: Session, name: str, params: dict, commit: bool = True) -> str:
+    """Queue a job for the workers, returning its id.
+
+    The params are stored as JSON, and passed to the job handler as keyword
+    arguments. Without commit, the job is queued with the caller's
+    transaction.
+    """
+    job_id = str(uuid.uuid4())
+    job = db_models.BackgroundTasks(
+        id=job_id,
+        name=name,
+        status=BackgroundTaskStatus.PENDING,
+        params=params,
+        attempts=0,
+    )
+    db.add(job)
+    if commit:
+        db.commit()
+    else:
+        db.flush()
+    return job_id
+
+
+def claim_job(db: Session, worker: str, names: Iterable[str]) -> Optional[dict]:
+    """Claim the oldest pending job with one of the names, if any.
+
+    Rows locked by other workers are skipped, rather than waited for.
+    Returns the id, name, params and attempts of the claimed job.
+    """
+    query = text(
+        """UPDATE background_tasks
+        SET status = 'RECEIVED',
+            started = now(),
+            heartbeat = now(),
+            worker = :worker,
+            attempts = COALESCE(attempts, 0) + 1
+        WHERE id = (
+            SELECT id
+            FROM background_tasks
+            WHERE status = 'PENDING'
+            AND name = ANY(:names)
+            ORDER BY created
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, name, params, attempts"""
+    )
+    row = db.execute(query, {"worker": worker, "names": list(names)}).first()
+    db.commit()
+    return dict(row._mapping) if row else None
+
+
+def heartbeat(db: Session, job_id: str):
+    """Record that the worker running a job is still alive."""
+    db.execute(
+        text(
+            """UPDATE background_tasks
+            SET heartbeat = now()
+            WHERE id = :job_id
+            AND status = 'RECEIVED'"""
+        ),
+        {"job_id": job_id},
+    )
+    db.commit()
+
+
+def save_progress(db: Session, job_id: str, progress: dict):
+    """Store the progress counters of a job, see app.jobs.progress."""
+    db.query(db_models.BackgroundTasks).filter(
+        db_models.BackgroundTasks.id == job_id
+    ).update({db_models.BackgroundTasks.progress: progress})
+    db.commit()
+
+
+def get_job(db: Session, job_id: str) -> Optional[db_models.BackgroundTasks]:
+    """Get a job by its id."""
+    return (
+        db.query(db_models.BackgroundTasks)
+        .filter(db_models.BackgroundTasks.id == job_id)
+        .first()
+    )
+
+
+def finish_job(
+    db: Session, job_id: str, status: BackgroundTaskStatus, message: str = None
+):
+    """Set the final status of a job, unless its handler already did."""
+    db.execute(
+        text(
+            """UPDATE background_tasks
+            SET status = :status, message = COALESCE(:message, message)
+            WHERE id = :job_id
+            AND status = 'RECEIVED'"""
+        ),
+        {"job_id": job_id, "status": status.name, "message": message},
+    )
+    db.commit()
+
+
+def requeue_stale_jobs(db: Session, timeout: int, max_attempts: int) -> int:
+    """Requeue the running jobs whose worker has stopped sending heartbeats.
+
+    Jobs that have already been tried max_attempts times are failed instead.
+    Returns the number of jobs requeued.
+    """
+    params = {"timeout": timeout, "max_attempts": max_attempts}
+    stale = """status = 'RECEIVED'
+        AND heartbeat < now() - make_interval(secs => :timeout)"""
+
+    db.execute(
+        text(
+            f"""UPDATE background_tasks
+            SET status = 'FAILED', message = 'The worker running the job stopped'
+            WHERE {stale}
+            AND attempts >= :max_attempts"""
+        ),
+        params,
+    )
+    result = db.execute(
+        text(
+            f"""UPDATE background_tasks
+            SET status = 'PENDING', worker = NULL
+            WHERE {stale}"""
+        ),
+        params,
+    )
+    db.commit()
+    return result.rowcount
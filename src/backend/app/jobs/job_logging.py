@@ -0,0 +1,88 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+"""Per-job log files.
+
+A job writes its log records to its own file by running inside job_log.
+The handler is only attached to the logger for the duration of the job,
+and only accepts records logged from the job's context, so concurrent
+jobs do not write to each other's files and no handlers are left behind.
+Records are written to the file by a QueueListener thread, so logging
+does not wait for the disk.
+"""
+
+import logging
+import queue
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+from fastapi.logger import logger as fastapi_logger
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# The id of the job log of the current context, if any
+current_job_log: ContextVar[Optional[str]] = ContextVar("current_job_log", default=None)
+
+
+class JobLogFilter(logging.Filter):
+    """Accept only the records logged from the context of one job log."""
+
+    def __init__(self, log_id: str):
+        """Accept the records logged while current_job_log is log_id."""
+        super().__init__()
+        self.log_id = log_id
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Check if the record was logged from the job's context."""
+        return current_job_log.get() == self.log_id
+
+
+@contextmanager
+def job_log(
+    path: str, logger: logging.Logger = fastapi_logger, level: int = logging.DEBUG
+):
+    """Write the records logged in this context to the file at path.
+
+    Worker threads started in the block only log to the file if they run
+    in a copy of the context, see contextvars.copy_context.
+    """
+    log_id = str(uuid.uuid4())
+
+    file_handler = logging.FileHandler(path)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    records = queue.SimpleQueue()
+    queue_handler = QueueHandler(records)
+    queue_handler.setLevel(level)
+    queue_handler.addFilter(JobLogFilter(log_id))
+    listener = QueueListener(records, file_handler)
+
+    listener.start()
+    token = current_job_log.set(log_id)
+    logger.addHandler(queue_handler)
+    try:
+        yield
+    finally:
+        logger.removeHandler(queue_handler)
+        current_job_log.reset(token)
+        # Writes out the records still queued
+        listener.stop()
+        file_handler.close()
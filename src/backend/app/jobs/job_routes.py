@@ -0,0 +1,95 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+"""Status and live progress of background jobs."""
+
+import asyncio
+import json
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from ..db import database
+from ..models.enums import BackgroundTaskStatus
+from . import job_crud, progress
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["jobs"],
+    dependencies=[Depends(database.get_db)],
+    responses={404: {"description": "Not found"}},
+)
+
+FINISHED = (BackgroundTaskStatus.SUCCESS.name, BackgroundTaskStatus.FAILED.name)
+
+
+def job_status(db: Session, job_id: str) -> dict:
+    """Get the status and progress summary of a job."""
+    job = job_crud.get_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {
+        "id": job.id,
+        "name": job.name,
+        "status": job.status.name,
+        "message": job.message,
+        "progress": progress.summarize(job.progress),
+    }
+
+
+@router.get("/{job_id}")
+async def read_job(job_id: str, db: Session = Depends(database.get_db)):
+    """Get the status and progress of a background job.
+
+    ## Response
+    - `status`: PENDING, RECEIVED (running), SUCCESS or FAILED.
+    - `progress`: the current stage, its ETA in seconds, and for each stage
+      the items done and total, percent, elapsed seconds and items per minute.
+    """
+    return job_status(db, job_id)
+
+
+@router.get("/{job_id}/events")
+async def stream_job(job_id: str, interval: float = 2):
+    """Stream the status and progress of a background job as server-sent events.
+
+    An event is sent every interval seconds, until the job succeeds or fails.
+    """
+
+    def read_status():
+        db = database.SessionLocal()
+        try:
+            return job_status(db, job_id)
+        finally:
+            db.close()
+
+    # Raise a 404 before the stream starts
+    first = await run_in_threadpool(read_status)
+
+    async def events():
+        current = first
+        while True:
+            yield f"data: {json.dumps(current)}\n\n"
+            if current["status"] in FINISHED:
+                return
+            await asyncio.sleep(max(interval, 0.5))
+            current = await run_in_threadpool(read_status)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -0,0 +1,170 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+"""Progress of background jobs: per-stage counters, throughput and ETA.
+
+Jobs count their work in a JobProgress, which writes the counters to the
+progress column of their background_tasks row in batches, at most every
+flush_interval seconds. Readers turn the stored counters into rates and
+estimates with summarize, so polling a job is a single primary key lookup.
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from sqlalchemy.orm import Session
+
+from ..db import database
+from . import job_crud
+
+
+class JobProgress:
+    """Per-stage counters of a running job.
+
+    The counters are stored as:
+
+        {"stage": "tasks", "started": 1690000000.0, "stages": {
+            "tasks": {"total": 120, "done": 40, "initial": 10,
+                      "started": 1690000010.0, "finished": None}}}
+
+    where initial is the work already done before this run (on resume),
+    which is left out of the rates.
+    """
+
+    def __init__(
+        self,
+        job_id: str,
+        flush_interval: float = 2,
+        session_factory: Callable[[], Session] = database.SessionLocal,
+    ):
+        """Count the progress of a job, stored with sessions of session_factory."""
+        self.job_id = str(job_id)
+        self.flush_interval = flush_interval
+        self.session_factory = session_factory
+        self.data = {"stage": None, "started": time.time(), "stages": {}}
+        self.flushed = 0.0
+        self.lock = threading.Lock()
+
+    def start_stage(self, stage: str, total: int, done: int = 0):
+        """Start a stage of total items, done of which are already done."""
+        with self.lock:
+            self.data["stage"] = stage
+            self.data["stages"][stage] = {
+                "total": total,
+                "done": done,
+                "initial": done,
+                "started": time.time(),
+                "finished": None,
+            }
+        self.flush(force=True)
+
+    def advance(self, stage: str, count: int = 1):
+        """Count items done in a stage, flushing if flush_interval has passed."""
+        with self.lock:
+            self.data["stages"][stage]["done"] += count
+        self.flush()
+
+    def finish_stage(self, stage: str):
+        """Mark a stage as finished."""
+        with self.lock:
+            self.data["stages"][stage]["finished"] = time.time()
+        self.flush(force=True)
+
+    def done(self, stage: str) -> int:
+        """Get the number of items done in a stage."""
+        with self.lock:
+            return self.data["stages"][stage]["done"]
+
+    def flush(self, force: bool = False):
+        """Store the counters, unless they were stored less than flush_interval ago."""
+        now = time.time()
+        with self.lock:
+            if not force and now - self.flushed < self.flush_interval:
+                return
+            self.flushed = now
+            data = {**self.data, "updated": now}
+
+        db = self.session_factory()
+        try:
+            job_crud.save_progress(db, self.job_id, data)
+        finally:
+            db.close()
+
+
+def summarize(progress: Optional[dict], now: float = None) -> Optional[dict]:
+    """Add timings, rates and ETAs to stored job progress.
+
+    Each stage gets its percent done, elapsed seconds, items per minute and
+    the estimated seconds left, and the job gets the ETA of its current stage.
+    """
+    if not progress:
+        return None
+    now = now or time.time()
+
+    stages = {}
+    for name, stage in progress["stages"].items():
+        end = stage["finished"] or now
+        elapsed = max(end - stage["started"], 0)
+        done, total = stage["done"], stage["total"]
+
+        per_minute = None
+        eta = 0 if stage["finished"] else None
+        if elapsed > 0 and done > stage["initial"]:
+            per_minute = (done - stage["initial"]) / elapsed * 60
+            if not stage["finished"]:
+                eta = max(total - done, 0) / per_minute * 60
+
+        stages[name] = {
+            "done": done,
+            "total": total,
+            "percent": round(100 * done / total, 1) if total else 100.0,
+            "elapsed": round(elapsed, 1),
+            "per_minute": round(per_minute, 2) if per_minute else per_minute,
+            "eta": round(eta, 1) if eta is not None else None,
+        }
+
+    current = stages.get(progress["stage"], {})
+    return {
+        "stage": progress["stage"],
+        "elapsed": round(now - progress["started"], 1),
+        "eta": current.get("eta"),
+        "updated": progress.get("updated"),
+        "stages": stages,
+    }
+
+
+def tail(path: str, lines: int = 50, block_size: int = 8192) -> str:
+    """Get the last lines of a text file, reading backwards from its end.
+
+    Only the blocks holding those lines are read, however big the file is.
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b""
+        # One more newline than lines, as the file usually ends with one
+        while position > 0 and data.count(b"\n") <= lines:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            data = f.read(size) + data
+
+    text = data.decode("utf-8", errors="replace")
+    return "".join(text.splitlines(keepends=True)[-lines:])
@@ -0,0 +1,207 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+"""Worker processes running the background jobs queued by the API.
+
+Run with:
+
+    python -m app.jobs.worker [--processes N]
+
+Each process claims one job at a time from the queue in job_crud, runs it
+with its own database sessions, and sends heartbeats while it runs, so jobs
+of a crashed worker are picked up again by the others. The workers also
+queue the due syncs of the local copies of project submissions.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from ..config import settings
+from ..db import database, postgis_utils
+from ..models.enums import BackgroundTaskStatus
+from ..projects import project_crud
+from ..submission import submission_sync
+from . import job_crud
+
+logger = logging.getLogger(__name__)
+
+# Seconds between the checks for due submission syncs
+SYNC_CHECK_INTERVAL = 60
+
+
+def generate_appuser_files(
+    db,
+    job: dict,
+    project_id: int,
+    extract_polygon: bool,
+    upload_path: str = None,
+    category: str = None,
+    resume: bool = False,
+):
+    """Generate the app users, forms and QR codes of a project's tasks."""
+    upload = None
+    if upload_path and os.path.exists(upload_path):
+        with open(upload_path, "rb") as f:
+            upload = f.read()
+        os.remove(upload_path)
+
+    project_crud.generate_appuser_files(
+        db,
+        project_id,
+        extract_polygon,
+        upload,
+        category,
+        job["id"],
+        # A retried job carries on from the tasks generated by the last attempt
+        resume=resume or job["attempts"] > 1,
+    )
+
+
+def add_features(db, job: dict, project_id: int, path: str):
+    """Load the features of a spooled GeoJSON upload into a project."""
+    features = postgis_utils.iter_geojson_file(path, remove=True)
+    project_crud.add_features_into_database(project_id, features, job["id"])
+
+
+def sync_submissions(db, job: dict, project_id: int):
+    """Copy the new ODK Central submissions of a project."""
+    submission_sync.sync_submissions(db, project_id)
+
+
+JOB_HANDLERS = {
+    job_crud.GENERATE_APPUSER_FILES: generate_appuser_files,
+    job_crud.ADD_FEATURES: add_features,
+    job_crud.SYNC_SUBMISSIONS: sync_submissions,
+}
+
+
+def send_heartbeats(job_id: str, stop: threading.Event):
+    """Update the heartbeat of a job until stop is set."""
+    while not stop.wait(settings.JOB_HEARTBEAT_INTERVAL):
+        db = database.SessionLocal()
+        try:
+            job_crud.heartbeat(db, job_id)
+        except Exception as e:
+            logger.warning(f"Could not update the heartbeat of job {job_id}: {e}")
+        finally:
+            db.close()
+
+
+def run_job(job: dict):
+    """Run a claimed job, then record its final status."""
+    logger.info(f"Running job {job['id']} ({job['name']})")
+
+    stop_heartbeats = threading.Event()
+    heartbeats = threading.Thread(
+        target=send_heartbeats, args=(job["id"], stop_heartbeats), daemon=True
+    )
+    heartbeats.start()
+
+    db = database.SessionLocal()
+    try:
+        handler = JOB_HANDLERS[job["name"]]
+        handler(db, job, **(job["params"] or {}))
+        status, message = BackgroundTaskStatus.SUCCESS, None
+    except Exception as e:
+        logger.exception(f"Job {job['id']} failed")
+        db.rollback()
+        status, message = BackgroundTaskStatus.FAILED, str(e)
+    finally:
+        stop_heartbeats.set()
+        heartbeats.join()
+
+    try:
+        job_crud.finish_job(db, job["id"], status, message)
+    finally:
+        db.close()
+    logger.info(f"Finished job {job['id']}")
+
+
+def work(name: str, stop: threading.Event):
+    """Claim and run jobs until stop is set."""
+    # Let the job in progress finish on shutdown, rather than interrupting it
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+
+    logging.basicConfig(level=settings.LOG_LEVEL)
+    logger.info(f"Worker {name} started")
+
+    next_sync_check = 0.0
+    while not stop.is_set():
+        db = database.SessionLocal()
+        try:
+            requeued = job_crud.requeue_stale_jobs(
+                db, settings.JOB_HEARTBEAT_TIMEOUT, settings.JOB_MAX_ATTEMPTS
+            )
+            if requeued:
+                logger.warning(f"Requeued {requeued} jobs of stopped workers")
+            if time.monotonic() >= next_sync_check:
+                next_sync_check = time.monotonic() + SYNC_CHECK_INTERVAL
+                if queued := submission_sync.queue_due_syncs(db):
+                    logger.info(f"Queued {queued} submission syncs")
+            job = job_crud.claim_job(db, name, JOB_HANDLERS)
+        except Exception as e:
+            logger.error(f"Could not claim a job: {e}")
+            job = None
+        finally:
+            db.close()
+
+        if job:
+            run_job(job)
+        else:
+            stop.wait(settings.JOB_POLL_INTERVAL)
+
+    logger.info(f"Worker {name} stopped")
+
+
+def main():
+    """Start the worker processes, and wait for them to stop."""
+    parser = argparse.ArgumentParser(description="Run FMTM background jobs")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=settings.JOB_WORKERS,
+        help="number of jobs to run at the same time",
+    )
+    args = parser.parse_args()
+
+    # Spawn, so no database connection is shared with the parent process
+    context = multiprocessing.get_context("spawn")
+    stop = context.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+
+    hostname = socket.gethostname()
+    processes = [
+        context.Process(target=work, args=(f"{hostname}-{os.getpid()}-{index}", stop))
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -33,8 +33,10 @@ from .__version__ import __version__
 from .auth import auth_routes
 from .central import central_routes
 from .config import settings
+from .db import migrations
 from .db.database import Base, engine, get_db
 from .debug import debug_routes
+from .jobs import job_routes
 from .projects import project_routes
 from .projects.project_crud import read_xlsforms
 from .submission import submission_routes
@@ -87,6 +89,7 @@ def get_application() -> FastAPI:
     _app.include_router(auth_routes.router)
     _app.include_router(submission_routes.router)
     _app.include_router(organization_routes.router)
+    _app.include_router(job_routes.router)
 
     if settings.DEBUG:
         _app.include_router(debug_routes.router)
@@ -123,6 +126,8 @@ async def startup_event():
     logger.debug("Starting up FastAPI server.")
     logger.debug("Connecting to DB with SQLAlchemy")
     Base.metadata.create_all(bind=engine)
+    migrations.add_job_queue_columns(engine)
+    migrations.create_spatial_indexes(engine)
 
     # Read in XLSForms
     read_xlsforms(next(get_db()), xlsforms_path)
@@ -212,6 +212,22 @@ class ProjectSplitStrategy(IntEnum, Enum):
     OTHER = 2
 
 
+class GridType(StrEnum, Enum):
+    """Enum describing the cell shapes available for task grids."""
+
+    SQUARE = "square"
+    HEXAGON = "hexagon"
+
+
+class TaskGenerationStage(IntEnum, Enum):
+    """Enum describing how far the file generation of a task has got."""
+
+    APPUSER_CREATED = 1
+    XFORM_PUBLISHED = 2
+    ROLE_ASSIGNED = 3
+    COMPLETED = 4
+
+
 class BackgroundTaskStatus(IntEnum, Enum):
     """Enum describing fast api background Task Statuses."""
 
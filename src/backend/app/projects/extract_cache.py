@@ -0,0 +1,120 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+"""On-disk cache of OSM data extracts, keyed by AOI and query."""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Optional
+
+import shapely
+from fastapi.logger import logger as logger
+from shapely.geometry import shape
+
+from ..config import settings
+
+# Coordinates are rounded to this grid (degrees, ~1cm) before hashing
+KEY_PRECISION = 1e-7
+
+
+def cache_key(geometry: dict, **params) -> str:
+    """Get the cache key of an extract of the geometry with the given params.
+
+    The geometry is normalised first, so the same AOI gives the same key
+    whatever its ring orientation, starting vertex or coordinate noise.
+    The params (filters, category...) must be JSON serialisable.
+    """
+    geom = shapely.normalize(shapely.set_precision(shape(geometry), KEY_PRECISION))
+
+    digest = hashlib.sha256(shapely.to_wkb(geom))
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def get_cached_extract(key: str) -> Optional[dict]:
+    """Get a cached extract, or None if it is missing or has expired."""
+    path = os.path.join(settings.EXTRACT_CACHE_DIR, f"{key}.geojson")
+    try:
+        if time.time() - os.path.getmtime(path) > settings.EXTRACT_CACHE_TTL:
+            os.remove(path)
+            return None
+
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    # Mark the entry as recently used, for size-based eviction
+    os.utime(path, (time.time(), os.path.getmtime(path)))
+    logger.info(f"Using cached OSM extract {key}")
+    return data
+
+
+def cache_extract(key: str, data: dict):
+    """Store an extract in the cache, then evict stale and excess entries.
+
+    Setting EXTRACT_CACHE_TTL to 0 disables the cache.
+    """
+    cache_dir = settings.EXTRACT_CACHE_DIR
+    if settings.EXTRACT_CACHE_TTL <= 0:
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Write to a temporary file first, so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, os.path.join(cache_dir, f"{key}.geojson"))
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    evict(cache_dir, settings.EXTRACT_CACHE_TTL, settings.EXTRACT_CACHE_MAX_SIZE)
+
+
+def evict(cache_dir: str, ttl: int, max_size: int):
+    """Remove expired entries, then least recently used ones over max_size bytes."""
+    now = time.time()
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith(".geojson"):
+            continue
+        try:
+            stat = entry.stat()
+            if now - stat.st_mtime > ttl:
+                os.remove(entry.path)
+            else:
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            # Removed by another worker
+            continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -17,15 +17,16 @@
 #
 
 
-import base64
+import contextvars
+import functools
 import io
 import json
-import logging
 import os
+import threading
 import uuid
-from base64 import b64encode
-from json import dumps, loads
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from json import dumps
+from typing import Iterable, List
 from zipfile import ZipFile
 
 
@@ -33,17 +34,16 @@ import geoalchemy2
 import geojson
 import numpy as np
 import segno
-import shapely.wkb as wkblib
+import shapely
 import sqlalchemy
 from fastapi import HTTPException, UploadFile
 from fastapi.logger import logger as logger
 from geoalchemy2.shape import from_shape
 from geojson import dump
 from osm_fieldwork.make_data_extract import PostgresClient
-from osm_fieldwork.OdkCentral import OdkAppUser
 from osm_fieldwork.xlsforms import xlsforms_path
 from shapely import wkt
-from shapely.geometry import MultiPolygon, Polygon, mapping, shape
+from shapely.geometry import MultiPolygon, mapping, shape
 from sqlalchemy import (
     column,
     inspect,
@@ -56,20 +56,26 @@ from sqlalchemy.sql import text
 
 from ..central import central_crud
 from ..config import settings
-from ..db import db_models
+from ..db import database, db_models, postgis_utils
 from ..db.postgis_utils import geometry_to_geojson, timestamp
+from ..jobs.job_logging import job_log
+from ..jobs.progress import JobProgress
+from ..models.enums import GridType, TaskGenerationStage
 from ..tasks import tasks_crud
 from ..users import user_crud
 
 # from ..osm_fieldwork.make_data_extract import PostgresClient, OverpassClient
-from . import project_schemas
+from . import extract_cache, project_schemas, project_splitting, raw_data_api
 
 # --------------
 # ---- CRUD ----
 # --------------
 
 QR_CODES_DIR = "QR_codes/"
+EMPTY_EXTRACT = {"type": "FeatureCollection", "features": []}
 TASK_GEOJSON_DIR = "geojson/"
+# The number of rejected features whose reason is kept for the job message
+REJECTED_REASONS = 10
 
 
 def get_projects(
@@ -356,6 +362,7 @@ def update_multi_polygon_project_boundary(
 
         """Update the boundary polyon on the database."""
         polygons = boundary["features"]
+        outlines = []
         for polygon in polygons:
 
             """If the polygon is a MultiPolygon, convert it to a Polygon"""
@@ -373,17 +380,10 @@ def update_multi_polygon_project_boundary(
             """ Apply the lambda function to each coordinate in its geometry """
             list(map(remove_z_dimension, polygon["geometry"]["coordinates"][0]))
 
-            db_task = db_models.DbTask(
-                project_id=project_id,
-                outline=wkblib.dumps(shape(polygon["geometry"]), hex=True),
-                project_task_index=1,
-            )
-            db.add(db_task)
-            db.commit()
+            outlines.append(shape(polygon["geometry"]))
 
-            """ Id is passed in the task_name too. """
-            db_task.project_task_name = str(db_task.id)
-            db.commit()
+        """ Id is passed in the task_name too. """
+        tasks_crud.bulk_create_tasks(db, project_id, outlines)
 
         """ Generate project outline from tasks """
         # query = f'''SELECT ST_AsText(ST_Buffer(ST_Union(outline), 0.5, 'endcap=round')) as oval_envelope
@@ -408,7 +408,12 @@ def update_multi_polygon_project_boundary(
         raise HTTPException(e) from e
 
 
-async def preview_tasks(boundary: str, dimension: int):
+async def preview_tasks(
+    boundary: str,
+    dimension: int,
+    grid_type: GridType = GridType.SQUARE,
+    projected: bool = False,
+):
     """Preview tasks by returning a list of task objects."""
     """Use a lambda function to remove the "z" dimension from each coordinate in the feature's geometry """
 
@@ -431,61 +436,8 @@ async def preview_tasks(boundary: str, dimension: int):
 
     boundary = shape(features[0]["geometry"])
 
-    minx, miny, maxx, maxy = boundary.bounds
-
-    # 1 degree = 111139 m
-    value = dimension / 111139
-
-    nx = int((maxx - minx) / value)
-    ny = int((maxy - miny) / value)
-    # gx, gy = np.linspace(minx, maxx, nx), np.linspace(miny, maxy, ny)
-
-    xdiff = abs(maxx - minx)
-    ydiff = abs(maxy - miny)
-    if xdiff > ydiff:
-        gx, gy = np.linspace(minx, maxx, ny), np.linspace(miny, miny + xdiff, ny)
-    else:
-        gx, gy = np.linspace(minx, minx + ydiff, nx), np.linspace(miny, maxy, nx)
-    grid = list()
-
-    id = 0
-    for i in range(len(gx) - 1):
-        for j in range(len(gy) - 1):
-            poly = Polygon(
-                [
-                    [gx[i], gy[j]],
-                    [gx[i], gy[j + 1]],
-                    [gx[i + 1], gy[j + 1]],
-                    [gx[i + 1], gy[j]],
-                    [gx[i], gy[j]],
-                ]
-            )
-
-            if boundary.intersection(poly):
-                feature = geojson.Feature(
-                    geometry=boundary.intersection(poly), properties={"id": str(id)}
-                )
-                id += 1
-
-                geom = shape(feature["geometry"])
-                # Check if the geometry is a MultiPolygon
-                if geom.geom_type == "MultiPolygon":
-
-                    # Get the constituent Polygon objects from the MultiPolygon
-                    polygons = geom.geoms
-
-                    for x in range(len(polygons)):
-                        # Convert the two polygons to GeoJSON format
-                        feature1 = {
-                            "type": "Feature",
-                            "properties": {},
-                            "geometry": mapping(polygons[x]),
-                        }
-                        grid.append(feature1)
-                else:
-                    grid.append(feature)
-
-    collection = geojson.FeatureCollection(grid)
+    grid = project_splitting.create_grid(boundary, dimension, grid_type, projected)
+    collection = project_splitting.grid_to_feature_collection(grid)
 
     # If project outline cannot be divided into multiple tasks,
     #   whole boundary is made into a single task.
@@ -500,67 +452,85 @@ async def preview_tasks(boundary: str, dimension: int):
     return collection
 
 
-def get_osm_extracts(boundary: str):
-    # Filters for osm extracts
-    query={"filters":{
-            "tags": {
-                "all_geometry": {
-                    "join_or": {
-                        "highway": [],
-                        "waterway":[]     
-                        }
-                    }
-                }
-            },
-            "geometryType": [
-                "polygon",
-                "line",
-                "line"
-            ],
-            "centroid": "false"
-        }
-    query["geometry"] = json.loads(boundary)["features"][0]["geometry"]
-
-    base_url = "https://raw-data-api0.hotosm.org/v1"
-    query_url = f"{base_url}/snapshot/"
-    headers = {"accept": "application/json", "Content-Type": "application/json"}
+def load_osm_lines(
+    db: Session,
+    project_id: int,
+    features: Iterable[dict],
+    chunk_size: int = postgis_utils.COPY_CHUNK_SIZE,
+    table: str = "osm_lines",
+):
+    """Bulk load OSM line features into the osm_lines table with COPY.
 
-    import requests
-    import time
-    import zipfile
-    from io import BytesIO
+    Features are converted and sent chunk_size at a time, so memory use
+    does not grow with the size of the extract. Another table with the same
+    columns, such as a temporary staging table, can be given instead.
+    The lines are not committed, so they can be used in the same transaction.
+    """
+    rows = (
+        (
+            project_id,
+            postgis_utils.to_ewkb(shape(feature["geometry"])),
+            json.dumps(feature["properties"]),
+        )
+        for feature in features
+    )
+    count = postgis_utils.copy_rows(
+        db, table, ["project_id", "geometry", "properties"], rows, chunk_size
+    )
+    logger.debug(f"Loaded {count} osm lines for project {project_id}")
+    return count
 
-    result = requests.post(query_url, data=json.dumps(query), headers=headers)
 
-    if result.status_code == 200:
-        task_id = result.json()['task_id']
-    else:
-        return False
+def delete_project_tasks(db: Session, project_id: int):
+    """Delete the tasks of a project, so that it can be split again.
 
-    task_url = f"{base_url}/tasks/status/{task_id}"
-    # extracts = requests.get(task_url)
-    while True:
-        result = requests.get(task_url, headers=headers)
-        if result.json()['status'] == "PENDING":
-            time.sleep(1)
-        elif result.json()['status'] == "SUCCESS":
-            break
-
-    zip_url = result.json()['result']['download_url']
-    zip_url
-    result = requests.get(zip_url, headers=headers)
-    # result.content
-    fp = BytesIO(result.content)
-    zfp = zipfile.ZipFile(fp, "r")
-    zfp.extract("Export.geojson", "/tmp/")
-    data = eval(zfp.read("Export.geojson"))
+    The features of the project are unassigned first. Tasks that have been
+    mapped or validated cannot be deleted, as their history refers to them,
+    so a 400 is raised instead.
+    """
+    query = text(
+        """SELECT
+            EXISTS (SELECT 1 FROM task_history WHERE project_id = :project_id)
+            OR EXISTS (
+                SELECT 1 FROM task_invalidation_history
+                WHERE project_id = :project_id
+            )"""
+    )
+    if db.execute(query, {"project_id": project_id}).scalar():
+        raise HTTPException(
+            status_code=400,
+            detail=f"Project {project_id} has task history, it cannot be split again",
+        )
 
-    return data
+    db.execute(
+        text("UPDATE features SET task_id = NULL WHERE project_id = :project_id"),
+        {"project_id": project_id},
+    )
+    db.execute(
+        text("DELETE FROM tasks WHERE project_id = :project_id"),
+        {"project_id": project_id},
+    )
 
 
 async def split_into_tasks(
-    db: Session, project_id: int, boundary: str   
-    ):
+    db: Session, project_id: int, boundary: dict, min_task_area: float = 500
+):
+    """Split the project boundary into tasks along OSM highways and waterways.
+
+    The lines are staged in a temporary table dropped at commit, so nothing
+    is left behind in osm_lines. The polygonize, sliver merge, task insert
+    and task naming then run as one statement: polygons smaller than
+    min_task_area (square metres) are merged into the neighbour they share
+    the longest edge with. Existing tasks are replaced, unless they have
+    history, see delete_project_tasks.
+    Returns the number of tasks created.
+    """
+    boundary_data = boundary["features"][0]["geometry"]
+    outline = shape(boundary_data)
+
+    # Fetched before the first query, so no transaction is left open while
+    # waiting for the Raw Data API
+    data = await raw_data_api.get_osm_extracts(boundary_data)
 
     # verify project exists in db
     db_project = get_project(db, project_id)
@@ -568,90 +538,182 @@ async def split_into_tasks(
         logger.error(f"Project {project_id} doesn't exist!")
         return False
 
-    outline = json.loads(boundary)
-
-    """Update the boundary polyon on the database."""
-    boundary_data = outline["features"][0]["geometry"]
-    outline = shape(boundary_data)
-
     # Update the project outline and centroid in project table.
     db_project.outline = outline.wkt
     db_project.centroid = outline.centroid.wkt
-    db.commit()
-    db.refresh(db_project)
-
-    data = get_osm_extracts(boundary)
-
-    for feature in data["features"]:
-        
-        # If the osm extracts contents do not have a title, provide an empty text for that.
-        feature_shape = shape(feature['geometry'])
-
-        wkb_element = from_shape(feature_shape, srid=4326)
-
-        db_feature = db_models.DbOsmLines(
-            project_id=project_id,
-            geometry=wkb_element,
-            properties=feature["properties"]
+    db.flush()
+
+    db.execute(
+        text(
+            """CREATE TEMPORARY TABLE split_lines (
+                project_id integer,
+                geometry geometry(Geometry, 4326),
+                properties jsonb
+            ) ON COMMIT DROP"""
         )
+    )
+    load_osm_lines(db, project_id, data["features"], table="split_lines")
 
-        db.add(db_feature)
-        db.commit()
-
+    # Replace any existing tasks, and lines left by earlier splits
+    delete_project_tasks(db, project_id)
+    db.execute(
+        text("DELETE FROM osm_lines WHERE project_id = :project_id"),
+        {"project_id": project_id},
+    )
 
-    query = f"""    
+    query = text(
+        """
         WITH boundary AS (
-        SELECT ST_Boundary(outline) AS geom
-        FROM "projects" WHERE id={project_id}
+            SELECT outline AS geom FROM projects WHERE id = :project_id
         ),
-        splitlines AS (
-        SELECT ST_Intersection(a.outline, l.geometry) AS geom
-        FROM "projects" a, "osm_lines" l
-        WHERE a.id={project_id} and l.project_id={project_id}
-        AND ST_Intersects(a.outline, l.geometry)
+        lines AS (
+            SELECT ST_Boundary(boundary.geom) AS geom FROM boundary
+            UNION ALL
+            SELECT ST_Intersection(boundary.geom, l.geometry)
+            FROM boundary, split_lines AS l
+            WHERE ST_Intersects(boundary.geom, l.geometry)
         ),
-        merged AS (
-        SELECT ST_LineMerge(ST_Union(splitlines.geom)) AS geom
-        FROM splitlines
+        polygons AS (
+            SELECT
+                row_number() OVER () AS polyid,
+                dumped.geom,
+                ST_Area(dumped.geom::geography) AS area
+            FROM (
+                SELECT (ST_Dump(ST_Polygonize(noded.geom))).geom AS geom
+                FROM (SELECT ST_Union(geom) AS geom FROM lines) AS noded
+            ) AS dumped, boundary
+            -- Drop polygons filling holes in the boundary
+            WHERE ST_Within(ST_PointOnSurface(dumped.geom), boundary.geom)
+        ),
+        slivers AS (
+            SELECT * FROM polygons WHERE area < :min_task_area
         ),
-        comb AS (
-        SELECT ST_Union(boundary.geom, merged.geom) AS geom
-        FROM boundary, merged
+        keep AS (
+            SELECT * FROM polygons WHERE area >= :min_task_area
         ),
-        splitpolysnoindex AS (
-        SELECT (ST_Dump(ST_Polygonize(comb.geom))).geom as geom
-        FROM comb
+        assigned AS (
+            SELECT DISTINCT ON (s.polyid) s.polyid, k.polyid AS target, s.geom
+            FROM slivers AS s
+            JOIN keep AS k ON ST_Intersects(s.geom, k.geom)
+            CROSS JOIN LATERAL (
+                SELECT ST_Length(ST_Intersection(s.geom, k.geom)) AS shared
+            ) AS edge
+            WHERE edge.shared > 0
+            ORDER BY s.polyid, edge.shared DESC
+        ),
+        merged AS (
+            SELECT
+                k.polyid,
+                ST_Union(
+                    array_append(
+                        array_agg(a.geom) FILTER (WHERE a.geom IS NOT NULL), k.geom
+                    )
+                ) AS geom
+            FROM keep AS k
+            LEFT JOIN assigned AS a ON a.target = k.polyid
+            GROUP BY k.polyid, k.geom
+            UNION ALL
+            -- Slivers with no neighbour to merge into are kept as they are
+            SELECT polyid, geom
+            FROM slivers
+            WHERE polyid NOT IN (SELECT polyid FROM assigned)
+        ),
+        new_tasks AS (
+            SELECT nextval(pg_get_serial_sequence('tasks', 'id')) AS id, geom
+            FROM (
+                SELECT (ST_Dump(geom)).geom AS geom
+                FROM merged
+                ORDER BY polyid
+            ) AS ordered
         )
-        -- Add row numbers to function as temporary unique IDs for our new polygons
-        SELECT row_number () over () as polyid, * 
-        from splitpolysnoindex
-
+        INSERT INTO tasks (
+            id, project_id, project_task_index, project_task_name, outline, task_status
+        )
+        SELECT id, :project_id, 1, id::text, geom, 'READY'
+        FROM new_tasks
         """
+    )
+    result = db.execute(
+        query, {"project_id": project_id, "min_task_area": min_task_area}
+    )
+    task_count = result.rowcount
 
-    result = db.execute(query)
-    geom_data = result.fetchall()
+    db.execute(
+        text(
+            """UPDATE projects SET total_tasks = :task_count
+            WHERE id = :project_id"""
+        ),
+        {"project_id": project_id, "task_count": task_count},
+    )
+    db.commit()
+    logger.debug(f"Split project {project_id} into {task_count} tasks")
 
-    for geom in geom_data:
-        # Add tasks in the database
-        db_task = db_models.DbTask(
-            project_id=project_id,
-            outline=geom[1]
+    return task_count
+
+
+def split_by_feature_count(
+    db: Session,
+    project_id: int,
+    boundary: dict,
+    max_features: int,
+    data_extract: dict = None,
+):
+    """Split the project into tasks holding at most max_features features each.
+
+    The AOI is subdivided with a quadtree over the feature centroids, taken
+    from the data extract if one is provided, or from the features already
+    loaded for the project otherwise. Any existing tasks are replaced,
+    unless they have history, see delete_project_tasks.
+    Returns the number of tasks created.
+    """
+    db_project = get_project(db, project_id)
+    if not db_project:
+        logger.error(f"Project {project_id} doesn't exist!")
+        return False
+
+    outline = shapely.force_2d(shape(boundary["features"][0]["geometry"]))
+
+    # If the outline is a multipolygon, use the first polygon
+    if isinstance(outline, MultiPolygon):
+        outline = outline.geoms[0]
+
+    if data_extract:
+        geoms = [shape(feature["geometry"]) for feature in data_extract["features"]]
+        points = shapely.get_coordinates(shapely.centroid(np.array(geoms)))
+    else:
+        query = text(
+            """SELECT ST_X(ST_Centroid(geometry)), ST_Y(ST_Centroid(geometry))
+            FROM features
+            WHERE project_id = :project_id AND geometry IS NOT NULL"""
         )
+        result = db.execute(query, {"project_id": project_id})
+        points = np.array(result.fetchall(), dtype=float).reshape(-1, 2)
 
-        db.add(db_task)
-        db.commit()
+    polygons = project_splitting.split_by_feature_count(outline, points, max_features)
+    if not polygons:
+        polygons = [outline]
 
-        """ Id is passed in the task_name too. """
-        db_task.project_task_name = str(db_task.id)
-        db.commit()
+    db_project.outline = outline.wkt
+    db_project.centroid = outline.centroid.wkt
 
-        print('tasks added to db')
+    # Replace any existing tasks
+    delete_project_tasks(db, project_id)
 
-    return True
+    task_names = [str(index) for index in range(1, len(polygons) + 1)]
+    tasks_crud.bulk_create_tasks(db, project_id, polygons, task_names)
+    logger.debug(f"Split project {project_id} into {len(polygons)} tasks")
+
+    return len(polygons)
 
 
 def update_project_boundary(
-    db: Session, project_id: int, boundary: str, dimension: int
+    db: Session,
+    project_id: int,
+    boundary: str,
+    dimension: int,
+    server_side: bool = False,
+    grid_type: GridType = GridType.SQUARE,
+    projected: bool = False,
 ):
     # verify project exists in db
     db_project = get_project_by_id(db, project_id)
@@ -697,27 +759,26 @@ def update_project_boundary(
     db.refresh(db_project)
     logger.debug("Added project boundary!")
 
-    result = create_task_grid(db, project_id=project_id, delta=dimension)
-
-    tasks = eval(result)
-    for poly in tasks["features"]:
-        logger.debug(poly)
-        task_name = str(poly["properties"]["id"])
-        db_task = db_models.DbTask(
+    if server_side:
+        create_task_grid_in_db(
+            db,
             project_id=project_id,
-            project_task_name=task_name,
-            outline=wkblib.dumps(shape(poly["geometry"]), hex=True),
-            # qr_code=db_qr,
-            # qr_code_id=db_qr.id,
-            # project_task_index=feature["properties"]["fid"],
-            project_task_index=1,
-            # geometry_geojson=geojson.dumps(task_geojson),
-            # initial_feature_count=len(task_geojson["features"]),
+            dimension=dimension,
+            grid_type=grid_type,
+            projected=projected,
         )
-        db.add(db_task)
-        db.commit()
+        return True
+
+    grid = project_splitting.create_grid(outline, dimension, grid_type, projected)
+
+    # If project outline cannot be divided into multiple tasks,
+    #   whole boundary is made into a single task.
+    if not grid:
+        grid = [outline]
+
+    task_names = [str(index) for index in range(1, len(grid) + 1)]
+    tasks_crud.bulk_create_tasks(db, project_id, grid, task_names)
 
-        # FIXME: write to tasks table
     return True
 
 
@@ -936,299 +997,608 @@ def get_odk_id_for_project(db: Session, project_id: int):
     return project_info.odkid
 
 
-def generate_appuser_files(
+def get_data_extract(
+    outline: dict, category: str, extract_polygon: bool, outfile: str
+):
+    """Get the OSM features of a category within the outline.
+
+    Extracts are looked up in the extract cache first, and only fetched from
+    the raw-data-api (and written to outfile) on a miss.
+    """
+    key = extract_cache.cache_key(
+        outline,
+        source=settings.RAW_DATA_API_URL,
+        category=category,
+        polygon=extract_polygon,
+    )
+    if (data := extract_cache.get_cached_extract(key)) is not None:
+        return data
+
+    pg = PostgresClient(settings.RAW_DATA_API_URL, "underpass")
+    data = pg.getFeatures(
+        boundary=outline,
+        filespec=outfile,
+        polygon=extract_polygon,
+        xlsfile=f"{category}.xls",
+        category=category,
+    )
+    extract_cache.cache_extract(key, data)
+    return data
+
+
+def load_data_extract(
     db: Session,
     project_id: int,
-    extract_polygon: bool,
-    upload: str,
+    outline: dict,
     category: str,
-    background_task_id: uuid.UUID,
+    extract_polygon: bool,
+    outfile: str,
 ):
-    """Generate the files for each appuser.
-        QR code, new XForm, and the OSM data extract.
-
-        Parameters:
-            - db: the database session
-            - project_id: Project ID
-            - extract_polygon: boolean to determine if we should extract the polygon
-            - upload: the xls file to upload if we have a custom form
-            - category: the category of the project
-            - background_task_id: the task_id of the background task running this function.
+    """Load the OSM data extract of the project outline into the features table."""
+    outline_geojson = get_data_extract(outline, category, extract_polygon, outfile)
+
+    # Collect feature mappings for bulk insert
+    feature_mappings = []
+
+    for feature in outline_geojson["features"]:
+        # If the osm extracts contents do not have a title,
+        # provide an empty text for that.
+        feature["properties"]["title"] = ""
+
+        feature_shape = shape(feature["geometry"])
+
+        # If the centroid of the Polygon is not inside the outline, skip the feature.
+        if extract_polygon and (
+            not shape(outline).contains(shape(feature_shape.centroid))
+        ):
+            continue
+
+        wkb_element = from_shape(feature_shape, srid=4326)
+        feature_mapping = {
+            "project_id": project_id,
+            "category_title": category,
+            "geometry": wkb_element,
+            "properties": feature["properties"],
+        }
+        feature_mappings.append(feature_mapping)
+
+    # Bulk insert the osm extracts into the db.
+    db.bulk_insert_mappings(db_models.DbFeatures, feature_mappings)
+
+
+def assign_features_to_tasks(db: Session, project_id: int):
+    """Set the task_id of the project features to the task they intersect.
+
+    All features are assigned in a single UPDATE joined against the tasks
+    table, so the spatial indexes are used rather than one scan per task.
+    A feature straddling several tasks goes to the task containing its
+    centroid, or to the task with the lowest id if none does.
+    Returns the number of features whose task changed.
+    """
+    query = text(
         """
+        UPDATE features AS f
+        SET task_id = assigned.task_id
+        FROM (
+            SELECT DISTINCT ON (f.id) f.id, t.id AS task_id
+            FROM features AS f
+            JOIN tasks AS t
+                ON t.project_id = f.project_id
+                AND ST_Intersects(t.outline, f.geometry)
+            WHERE f.project_id = :project_id
+            ORDER BY
+                f.id,
+                ST_Intersects(t.outline, ST_Centroid(f.geometry)) DESC,
+                t.id
+        ) AS assigned
+        WHERE f.id = assigned.id
+        AND f.task_id IS DISTINCT FROM assigned.task_id
+        """
+    )
+    result = db.execute(query, {"project_id": project_id})
+    logger.debug(f"Assigned {result.rowcount} features to tasks in {project_id}")
+    return result.rowcount
 
-    try:
-        ## Logging ##
-        # create file handler
-        handler = logging.FileHandler(f"/tmp/{project_id}_generate.log")
-        handler.setLevel(logging.DEBUG)
-
-        # create formatter
-        formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-        )
-        handler.setFormatter(formatter)
-
-        # add handler to logger
-        logger.addHandler(handler)
-        logger.info(f"Starting generate_appuser_files for project {project_id}")
-
-        # Get the project table contents.
-        project = table(
-            "projects", 
-            column("project_name_prefix"), 
-            column("xform_title"), 
-            column("id"), 
-            column("odkid"),
-            column("odk_central_url"),
-            column("odk_central_user"),
-            column("odk_central_password"),
-            column("outline")
+
+def get_task_features(db: Session, project_id: int) -> dict:
+    """Get the features of every task in the project, in one query.
+
+    Returns a dict of task id to FeatureCollection.
+    """
+    query = text(
+        """
+        SELECT task_id, jsonb_build_object(
+            'type', 'FeatureCollection',
+            'features', jsonb_agg(
+                jsonb_build_object(
+                    'type', 'Feature',
+                    'id', id,
+                    'geometry', ST_AsGeoJSON(geometry)::jsonb,
+                    'properties', properties
+                )
+            )
         )
+        FROM features
+        WHERE project_id = :project_id AND task_id IS NOT NULL
+        GROUP BY task_id
+        """
+    )
+    result = db.execute(query, {"project_id": project_id})
+    return dict(result.fetchall())
 
-        where = f"id={project_id}"
-        sql = select(
-                        project.c.project_name_prefix,
-                        project.c.xform_title,
-                        project.c.id,
-                        project.c.odkid,
-                        project.c.odk_central_url,
-                        project.c.odk_central_user,
-                        project.c.odk_central_password,
-
-                    geoalchemy2.functions.ST_AsGeoJSON(project.c.outline).label("outline"),
-                    ).where(text(where))
-        result = db.execute(sql)
 
-        # There should only be one match
-        if result.rowcount != 1:
-            logger.warning(str(sql))
-            if result.rowcount < 1:
-                raise HTTPException(status_code=400, detail="Project not found")
-            else:
-                raise HTTPException(status_code=400, detail="Multiple projects found")
+def save_generation_stage(
+    db: Session, project_id: int, task_id: int, stage: TaskGenerationStage, **values
+):
+    """Record that a task has reached a generation stage, without committing."""
+    statement = insert(db_models.DbTaskGeneration).values(
+        task_id=task_id, project_id=project_id, stage=stage, **values
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["task_id", "project_id"],
+        set_={"stage": stage, "updated": timestamp(), **values},
+    )
+    db.execute(statement)
 
-        one = result.first()
 
-        if one:
-            prefix = one.project_name_prefix
+def checkpoint_task(
+    project_id: int, task_id: int, stage: TaskGenerationStage, **values
+):
+    """Record a generation stage from a worker thread, in its own session."""
+    db = database.SessionLocal()
+    try:
+        save_generation_stage(db, project_id, task_id, stage, **values)
+        db.commit()
+    finally:
+        db.close()
 
-            task = table("tasks", column("outline"), column("id"))
-            where = f"project_id={project_id}"
-            sql = select(task
-                # task.c.id,
-                # geoalchemy2.functions.ST_AsGeoJSON(task.c.outline).label("outline"),
-            ).where(text(where))
-            result = db.execute(sql)
 
-            # Get odk project id, and odk credentials from project.
-            odk_id = one.odkid
-            odk_credentials = {
-                "odk_central_url": one.odk_central_url,
-                "odk_central_user": one.odk_central_user,
-                "odk_central_password": one.odk_central_password,
-            }
-
-            xform_title = one.xform_title if one.xform_title else None
-
-            if upload:
-                xlsform = "/tmp/custom_form.xls"
-                contents = upload
-                with open(xlsform, "wb") as f:
-                    f.write(contents)
-            else:
-                xlsform = f"{xlsforms_path}/{xform_title}.xls"
+def get_generation_stages(db: Session, project_id: int) -> dict:
+    """Get the generation progress of the project tasks, by task id.
 
-            category = xform_title
+    The rows are plain column values, so they are not reloaded after a commit.
+    """
+    generation = db_models.DbTaskGeneration
+    rows = (
+        db.query(
+            generation.task_id,
+            generation.stage,
+            generation.appuser_id,
+            generation.appuser_token,
+        )
+        .filter(generation.project_id == project_id)
+        .all()
+    )
+    return {row.task_id: row for row in rows}
+
+
+def get_incomplete_generation_count(db: Session, project_id: int) -> int:
+    """Get the number of project tasks whose files are not all generated."""
+    query = text(
+        """SELECT count(*)
+        FROM tasks
+        LEFT JOIN task_generation AS g
+            ON g.task_id = tasks.id AND g.project_id = tasks.project_id
+        WHERE tasks.project_id = :project_id
+        AND g.stage IS DISTINCT FROM 'COMPLETED'"""
+    )
+    return db.execute(query, {"project_id": project_id}).scalar()
+
+
+def generate_task_files(
+    task_id: int,
+    features: dict,
+    stage: TaskGenerationStage,
+    appuser_token: str,
+    project_id: int,
+    odk_id: int,
+    prefix: str,
+    xform_title: str,
+    xlsform: str,
+    odk_credentials: dict,
+    odk_limit: threading.Semaphore,
+    convert_limit: threading.Semaphore,
+):
+    """Create the QR code, data extract and XForm of one task.
+
+    This runs in a worker thread, so it does not use the request session.
+    The app user of the task must already exist, see
+    central_crud.create_appusers. The published XForm is checkpointed, and
+    skipped if an earlier run already published it (stage).
+    ODK Central requests hold odk_limit, and the XForm conversion holds
+    convert_limit.
+    Returns the task id and the PNG image of its QR code.
+    """
+    name = f"{prefix}_{xform_title}_{task_id}"
 
-            print('Category ', category)
+    # prefix should be sent instead of name
+    _, qr_image = render_qrcode(odk_id, appuser_token, prefix, odk_credentials)
 
-            # OSM Extracts for whole project
-            pg = PostgresClient('https://raw-data-api0.hotosm.org/v1', "underpass")
-            outfile = f"/tmp/{prefix}_{xform_title}.geojson"  # This file will store osm extracts
+    if stage < TaskGenerationStage.XFORM_PUBLISHED:
+        xform = f"/tmp/{name}.xml"  # This file will store xml contents of an xls form.
+        outfile = f"/tmp/{name}.geojson"  # This file will store osm extracts
 
-            outline = eval(one.outline)
-            outline_geojson = pg.getFeatures(boundary = outline, 
-                                                filespec = outfile,
-                                                polygon = extract_polygon,
-                                                xlsfile = f'{category}.xls',
-                                                category = category
-                                                )
+        # Update outfile containing osm extracts with the new geojson contents
+        # containing title in the properties.
+        with open(outfile, "w") as jsonfile:
+            dump(features, jsonfile)
 
-            updated_outline_geojson = {
-                "type": "FeatureCollection",
-                "features": []}
+        with convert_limit:
+            outfile = central_crud.generate_updated_xform(task_id, xlsform, xform)
 
-            # Collect feature mappings for bulk insert
-            feature_mappings = []
+        # Create an odk xform, 409 if it was created by an earlier run
+        with odk_limit:
+            status = central_crud.create_odk_xform(
+                odk_id, task_id, outfile, odk_credentials
+            )
+        if status not in (200, 409):
+            raise HTTPException(
+                status_code=500,
+                detail=f"Could not publish the XForm of task {task_id}: {status}",
+            )
+        checkpoint_task(project_id, task_id, TaskGenerationStage.XFORM_PUBLISHED)
 
-            for feature in outline_geojson["features"]:
-                
-                # If the osm extracts contents do not have a title, provide an empty text for that.
-                feature["properties"]["title"] = ""
+    return task_id, qr_image
 
-                feature_shape = shape(feature['geometry'])
 
-                # If the centroid of the Polygon is not inside the outline, skip the feature.
-                if extract_polygon and (not shape(outline).contains(shape(feature_shape.centroid))):
-                    continue
+def generate_appuser_files(
+    db: Session,
+    project_id: int,
+    extract_polygon: bool,
+    upload: str,
+    category: str,
+    background_task_id: uuid.UUID,
+    resume: bool = False,
+):
+    """Generate the files for each appuser.
 
-                wkb_element = from_shape(feature_shape, srid=4326)
-                feature_mapping = {
-                    'project_id': project_id,
-                    'category_title': category,
-                    'geometry': wkb_element,
-                    'properties': feature["properties"],
-                }
-                updated_outline_geojson['features'].append(feature)
-                feature_mappings.append(feature_mapping)
+    QR code, new XForm, and the OSM data extract.
 
-            # Bulk insert the osm extracts into the db.
-            db.bulk_insert_mappings(db_models.DbFeatures, feature_mappings)
+    Tasks whose files were all generated by an earlier run are skipped,
+    and tasks that were part way through carry on from their last stage.
 
-            for poly in result.fetchall():
+    Parameters:
+        - db: the database session
+        - project_id: Project ID
+        - extract_polygon: boolean to determine if we should extract the polygon
+        - upload: the xls file to upload if we have a custom form
+        - category: the category of the project
+        - background_task_id: the task_id of the background task running this
+            function.
+        - resume: reuse the data extract and custom form of the earlier run.
+    """
 
-                name = f"{prefix}_{category}_{poly.id}"
+    # Log to the project's generate log, read by the generate-log endpoint
+    with job_log(f"/tmp/{project_id}_generate.log"):
+        try:
+            logger.info(f"Starting generate_appuser_files for project {project_id}")
+            progress = JobProgress(background_task_id)
+
+            # Get the project table contents.
+            project = table(
+                "projects", 
+                column("project_name_prefix"), 
+                column("xform_title"), 
+                column("id"), 
+                column("odkid"),
+                column("odk_central_url"),
+                column("odk_central_user"),
+                column("odk_central_password"),
+                column("outline")
+            )
 
-                # Create an app user for the task
-                appuser = central_crud.create_appuser(odk_id, name, odk_credentials)
+            where = f"id={project_id}"
+            sql = select(
+                            project.c.project_name_prefix,
+                            project.c.xform_title,
+                            project.c.id,
+                            project.c.odkid,
+                            project.c.odk_central_url,
+                            project.c.odk_central_user,
+                            project.c.odk_central_password,
+
+                        geoalchemy2.functions.ST_AsGeoJSON(project.c.outline).label("outline"),
+                        ).where(text(where))
+            result = db.execute(sql)
 
-                # If app user could not be created, raise an exception.
-                if not appuser:
-                    logger.error(f"Couldn't create appuser for project {project_id}")
+            # There should only be one match
+            if result.rowcount != 1:
+                logger.warning(str(sql))
+                if result.rowcount < 1:
+                    raise HTTPException(status_code=400, detail="Project not found")
+                else:
                     raise HTTPException(
-                        status_code=400, detail="Could not create appuser"
+                        status_code=400, detail="Multiple projects found"
                     )
 
-                # prefix should be sent instead of name
-                create_qr = create_qrcode(
-                    db, odk_id, appuser.json()["token"], prefix, odk_credentials
-                )
+            one = result.first()
+
+            if one:
+                prefix = one.project_name_prefix
+
+                task = table("tasks", column("outline"), column("id"))
+                where = f"project_id={project_id}"
+                sql = select(task
+                    # task.c.id,
+                    # geoalchemy2.functions.ST_AsGeoJSON(task.c.outline).label("outline"),
+                ).where(text(where))
+                result = db.execute(sql)
+
+                # Get odk project id, and odk credentials from project.
+                odk_id = one.odkid
+                odk_credentials = {
+                    "odk_central_url": one.odk_central_url,
+                    "odk_central_user": one.odk_central_user,
+                    "odk_central_password": one.odk_central_password,
+                }
 
-                xform = f"/tmp/{prefix}_{xform_title}_{poly.id}.xml"  # This file will store xml contents of an xls form.
-                outfile = f"/tmp/{prefix}_{xform_title}_{poly.id}.geojson"  # This file will store osm extracts
-
-                # xform_id_format
-                xform_id = f"{prefix}_{xform_title}_{poly.id}".split("_")[2]
-
-                # Get the features for this task.
-                # Postgis query to filter task inside this task outline and of this project
-                # Update those features and set task_id
-                query = f'''UPDATE features
-                            SET task_id={poly.id}
-                            WHERE id in (
-                            
-                            SELECT id
-                            FROM features
-                            WHERE project_id={project_id} and ST_Intersects(geometry, '{poly.outline}'::Geometry)
-
-                            )'''
-
-                result = db.execute(query)
-
-                # Get the geojson of those features for this task.
-                query = f'''SELECT jsonb_build_object(
-                            'type', 'FeatureCollection',
-                            'features', jsonb_agg(feature)
-                            )
-                            FROM (
-                            SELECT jsonb_build_object(
-                                'type', 'Feature',
-                                'id', id,
-                                'geometry', ST_AsGeoJSON(geometry)::jsonb,
-                                'properties', properties
-                            ) AS feature
-                            FROM features
-                            WHERE project_id={project_id} and task_id={poly.id}
-                            ) features;'''
-
-
-                result = db.execute(query)
-                features = result.fetchone()[0]
-
-                # Update outfile containing osm extracts with the new geojson contents containing title in the properties.
-                with open(outfile, "w") as jsonfile:
-                    jsonfile.truncate(0)  # clear the contents of the file
-                    dump(features, jsonfile)
-
-                outfile = central_crud.generate_updated_xform(
-                    db, poly.id, xlsform, xform
-                )
+                xform_title = one.xform_title if one.xform_title else None
 
-                # Update tasks table qith qr_Code id
-                task = tasks_crud.get_task(db, poly.id)
-                task.qr_code_id = create_qr["qr_code_id"]
-                db.commit()
-                db.refresh(task)
+                custom_xlsform = f"/tmp/{project_id}_custom_form.xls"
+                if upload:
+                    xlsform = custom_xlsform
+                    contents = upload
+                    with open(xlsform, "wb") as f:
+                        f.write(contents)
+                elif resume and os.path.exists(custom_xlsform):
+                    xlsform = custom_xlsform
+                else:
+                    xlsform = f"{xlsforms_path}/{xform_title}.xls"
+
+                category = xform_title
 
-                # Create an odk xform
-                result = central_crud.create_odk_xform(
-                    odk_id, poly.id, outfile, odk_credentials
+                logger.debug(f"Category {category}")
+
+                # OSM Extracts for whole project, kept from the earlier run on resume
+                has_features = (
+                    db.query(db_models.DbFeatures.id)
+                    .filter(db_models.DbFeatures.project_id == project_id)
+                    .first()
                 )
+                reuse_extract = bool(resume and has_features)
+                progress.start_stage("extract", 1, done=int(reuse_extract))
+                if not reuse_extract:
+                    # Replace the features of an earlier run, not add to them
+                    if has_features:
+                        db.query(db_models.DbFeatures).filter(
+                            db_models.DbFeatures.project_id == project_id
+                        ).delete(synchronize_session=False)
+
+                    # This file will store osm extracts
+                    outfile = f"/tmp/{prefix}_{xform_title}.geojson"
+                    load_data_extract(
+                        db,
+                        project_id,
+                        json.loads(one.outline),
+                        category,
+                        extract_polygon,
+                        outfile,
+                    )
+                    progress.advance("extract")
+                progress.finish_stage("extract")
 
-                # Update the user role for the created xform.
-                try:
-                    # Pass odk credentials
-                    if odk_credentials:
-                        url = odk_credentials["odk_central_url"]
-                        user = odk_credentials["odk_central_user"]
-                        pw = odk_credentials["odk_central_password"]
-
-                    else:
-                        logger.debug(
-                            "ODKCentral connection variables not set in function"
-                        )
-                        logger.debug("Attempting extraction from environment variables")
-                        url = settings.ODK_CENTRAL_URL
-                        user = settings.ODK_CENTRAL_USER
-                        pw = settings.ODK_CENTRAL_PASSWD
+                # Set the task_id of every feature in one pass
+                assign_features_to_tasks(db, project_id)
 
-                    odk_app = OdkAppUser(url, user, pw)
 
-                    odk_app.updateRole(
-                        projectId=one[3], xform=xform_id, actorId=appuser.json()["id"]
+                # Skip the tasks completed by an earlier run
+                stages = get_generation_stages(db, project_id)
+                completed = {
+                    task_id
+                    for task_id, task_stage in stages.items()
+                    if task_stage.stage == TaskGenerationStage.COMPLETED
+                }
+                all_task_ids = [poly.id for poly in result.fetchall()]
+                task_ids = [
+                    task_id for task_id in all_task_ids if task_id not in completed
+                ]
+                task_features = get_task_features(db, project_id)
+
+                # Create the missing app users in one batch, over one session
+                names = {
+                    task_id: f"{prefix}_{xform_title}_{task_id}"
+                    for task_id in task_ids
+                    if task_id not in stages
+                }
+                progress.start_stage("appusers", len(names))
+                appusers = central_crud.create_appusers(odk_id, names, odk_credentials)
+                for task_id, appuser in appusers.items():
+                    save_generation_stage(
+                        db,
+                        project_id,
+                        task_id,
+                        TaskGenerationStage.APPUSER_CREATED,
+                        appuser_id=appuser["id"],
+                        appuser_token=appuser["token"],
                     )
-                except Exception as e:
-                    logger.warning(str(e))
+                db.commit()
+                progress.advance("appusers", len(appusers))
+                if failed := len(names) - len(appusers):
+                    raise HTTPException(
+                        status_code=400, detail=f"Could not create {failed} appusers"
+                    )
+                progress.finish_stage("appusers")
+                stages = get_generation_stages(db, project_id)
+
+                # Tasks run in a thread pool. ODK Central requests and XForm
+                # conversions are each capped, so the server is not overwhelmed.
+                convert_workers = os.cpu_count() or 1
+                generate = functools.partial(
+                    generate_task_files,
+                    project_id=project_id,
+                    odk_id=odk_id,
+                    prefix=prefix,
+                    xform_title=xform_title,
+                    xlsform=xlsform,
+                    odk_credentials=odk_credentials,
+                    odk_limit=threading.BoundedSemaphore(settings.ODK_CENTRAL_CONCURRENCY),
+                    convert_limit=threading.BoundedSemaphore(convert_workers),
+                )
 
-                # Add the count of completed task in project table extract_completed_count column.
-                project = get_project_by_id(db, project_id)
-                project.extract_completed_count += 1
+                progress.start_stage("tasks", len(all_task_ids), done=len(completed))
+                with ThreadPoolExecutor(
+                    max_workers=settings.ODK_CENTRAL_CONCURRENCY + convert_workers
+                ) as executor:
+                    futures = [
+                        # In a copy of this context, to log to the job log
+                        executor.submit(
+                            contextvars.copy_context().run,
+                            generate,
+                            task_id,
+                            task_features.get(task_id, EMPTY_EXTRACT),
+                            stages[task_id].stage,
+                            stages[task_id].appuser_token,
+                        )
+                        for task_id in task_ids
+                    ]
+                    qr_images = {}
+                    try:
+                        # The database is only used from this thread
+                        for future in as_completed(futures):
+                            task_id, qr_image = future.result()
+                            qr_images[task_id] = qr_image
+
+                            # Stored in batches, not for every task
+                            progress.advance("tasks")
+
+                        # Committed below, once for the whole stage
+                        save_task_qrcodes(db, project_id, qr_images, f"{prefix}.png")
+                    except Exception:
+                        for future in futures:
+                            future.cancel()
+                        db.rollback()
+                        raise
+                    finally:
+                        # Keep the project extract_completed_count up to date
+                        project = get_project_by_id(db, project_id)
+                        project.extract_completed_count = progress.done("tasks")
+                        db.commit()
+                progress.finish_stage("tasks")
+
+                # Give the app users access to their forms in one batch
+                actors = {
+                    task_id: (
+                        f"{prefix}_{xform_title}_{task_id}".split("_")[2],
+                        stages[task_id].appuser_id,
+                    )
+                    for task_id in task_ids
+                    if stages[task_id].stage < TaskGenerationStage.ROLE_ASSIGNED
+                }
+                progress.start_stage("roles", len(actors))
+                assigned = central_crud.assign_appuser_roles(
+                    odk_id, actors, odk_credentials
+                )
+                progress.advance("roles", len(assigned))
+                for task_id in assigned:
+                    save_generation_stage(
+                        db, project_id, task_id, TaskGenerationStage.ROLE_ASSIGNED
+                    )
                 db.commit()
-                db.refresh(project)
 
-        # Update background task status to COMPLETED
-        update_background_task_status_in_database(
-            db, background_task_id, 4
-        )  # 4 is COMPLETED
+                # Tasks whose role failed stay at their stage, for a resume
+                for task_id in task_ids:
+                    if task_id in assigned or task_id not in actors:
+                        save_generation_stage(
+                            db, project_id, task_id, TaskGenerationStage.COMPLETED
+                        )
+                db.commit()
+                if failed := len(actors) - len(assigned):
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Could not assign the roles of {failed} appusers",
+                    )
+                progress.finish_stage("roles")
 
-    except Exception as e:
-        logger.warning(str(e))
+            # Update background task status to COMPLETED
+            update_background_task_status_in_database(
+                db, background_task_id, 4
+            )  # 4 is COMPLETED
 
-        # Update background task status to FAILED
-        update_background_task_status_in_database(
-            db, background_task_id, 2, str(e)
-        )  # 2 is FAILED
+        except Exception as e:
+            logger.warning(str(e))
 
+            # Update background task status to FAILED
+            update_background_task_status_in_database(
+                db, background_task_id, 2, str(e)
+            )  # 2 is FAILED
 
-def create_qrcode(
-    db: Session,
+
+def render_qrcode(
     project_id: int,
     token: str,
     project_name: str,
     odk_credentials: dict = None,
 ):
-    # Make QR code for an app_user.
-    qrcode = central_crud.create_qrcode(
+    """Render the QR code of an app user as a PNG image, in memory.
+
+    Nothing is written to disk, so this is safe to run for many app users
+    at once. Returns the segno QR code and the PNG bytes.
+    """
+    qr_data = central_crud.get_qrcode_data(
         project_id, token, project_name, odk_credentials
     )
-    qrcode = segno.make(qrcode, micro=False)
-    image_name = f"{project_name}.png"
-    with open(image_name, "rb") as f:
-        base64_data = b64encode(f.read()).decode()
-    qr_code_text = base64.b64decode(base64_data)
-    qrdb = db_models.DbQrCode(image=qr_code_text, filename=image_name)
+    qrcode = segno.make(qr_data, micro=False)
+    image = io.BytesIO()
+    qrcode.save(image, kind="png", scale=5)
+    return qrcode, image.getvalue()
+
+
+def save_qrcode(db: Session, image: bytes, filename: str):
+    """Store a QR code image in the database."""
+    qrdb = db_models.DbQrCode(image=image, filename=filename)
     db.add(qrdb)
     db.commit()
+    return qrdb
+
+
+def save_task_qrcodes(db: Session, project_id: int, images: dict, filename: str):
+    """Store the QR code of each task and set its qr_code_id, without committing.
+
+    images maps task ids to PNG images. The QR code ids are reserved first,
+    so the codes are inserted and the tasks updated in one statement each.
+    """
+    if not images:
+        return
+    task_ids = list(images)
+    result = db.execute(
+        text(
+            """SELECT nextval(pg_get_serial_sequence('qr_code', 'id'))
+            FROM generate_series(1, :count)"""
+        ),
+        {"count": len(task_ids)},
+    )
+    qr_code_ids = [row[0] for row in result]
+
+    db.execute(
+        insert(db_models.DbQrCode).values(
+            [
+                {"id": qr_code_id, "image": images[task_id], "filename": filename}
+                for task_id, qr_code_id in zip(task_ids, qr_code_ids)
+            ]
+        )
+    )
+    db.execute(
+        text(
+            """UPDATE tasks SET qr_code_id = codes.qr_code_id
+            FROM unnest(
+                CAST(:task_ids AS integer[]), CAST(:qr_code_ids AS integer[])
+            ) AS codes(task_id, qr_code_id)
+            WHERE tasks.project_id = :project_id AND tasks.id = codes.task_id"""
+        ),
+        {"project_id": project_id, "task_ids": task_ids, "qr_code_ids": qr_code_ids},
+    )
+
+
+def create_qrcode(
+    db: Session,
+    project_id: int,
+    token: str,
+    project_name: str,
+    odk_credentials: dict = None,
+):
+    # Make QR code for an app_user.
+    qrcode, image = render_qrcode(project_id, token, project_name, odk_credentials)
+    qrdb = save_qrcode(db, image, f"{project_name}.png")
     codes = table("qr_code", column("id"))
     sql = select(sqlalchemy.func.count(codes.c.id))
     result = db.execute(sql)
@@ -1275,102 +1645,85 @@ def download_geometry(
     return {"filespec": out}
 
 
-def create_task_grid(db: Session, project_id: int, delta: int):
-    try:
-        # Query DB for project AOI
-        projects = table("projects", column("outline"), column("id"))
-        where = f"projects.id={project_id}"
-        sql = select(geoalchemy2.functions.ST_AsGeoJSON(projects.c.outline)).where(
-            text(where)
+def create_task_grid_in_db(
+    db: Session,
+    project_id: int,
+    dimension: int,
+    grid_type: GridType = GridType.SQUARE,
+    projected: bool = False,
+):
+    """Create the task grid for a project inside PostGIS.
+
+    The cells are generated with ST_SquareGrid or ST_HexagonGrid, clipped to
+    the project outline and inserted into the tasks table in one
+    INSERT ... SELECT, so the task geometries never pass through Python.
+    With projected=True the grid is laid out in metres, in a Lambert
+    azimuthal equal-area projection centred on the project.
+    Returns the number of tasks created.
+    """
+    grid_function = {
+        GridType.SQUARE: "ST_SquareGrid",
+        GridType.HEXAGON: "ST_HexagonGrid",
+    }[grid_type]
+
+    if projected:
+        local_proj = """format(
+            '+proj=laea +lat_0=%s +lon_0=%s +ellps=WGS84 +units=m',
+            ST_Y(ST_Centroid(outline)),
+            ST_X(ST_Centroid(outline))
+        )"""
+        size = dimension
+    else:
+        local_proj = "NULL::text"
+        size = dimension / project_splitting.METRES_PER_DEGREE
+
+    query = text(
+        f"""
+        WITH aoi AS (
+            SELECT
+                CASE WHEN proj IS NULL THEN outline
+                ELSE ST_Transform(outline, proj) END AS geom,
+                proj
+            FROM (
+                SELECT outline, {local_proj} AS proj
+                FROM projects
+                WHERE id = :project_id
+            ) AS project
+        ),
+        clipped AS (
+            SELECT cell.i, cell.j, (ST_Dump(ST_Intersection(aoi.geom, cell.geom))).*
+            FROM aoi, {grid_function}(:size, aoi.geom) AS cell
+            WHERE ST_Intersects(aoi.geom, cell.geom)
         )
-        result = db.execute(sql)
-        # There should only be one match
-        if result.rowcount != 1:
-            logger.warning(str(sql))
-            return False
-        data = result.fetchall()
-        boundary = shape(loads(data[0][0]))
-        minx, miny, maxx, maxy = boundary.bounds
-
-        # 1 degree = 111139 m
-        value = delta / 111139
-
-        nx = int((maxx - minx) / value)
-        ny = int((maxy - miny) / value)
-        # gx, gy = np.linspace(minx, maxx, nx), np.linspace(miny, maxy, ny)
-
-        xdiff = maxx - minx
-        ydiff = maxy - miny
-        if xdiff > ydiff:
-            gx, gy = np.linspace(minx, maxx, ny), np.linspace(miny, miny + xdiff, ny)
-        else:
-            gx, gy = np.linspace(minx, minx + ydiff, nx), np.linspace(miny, maxy, nx)
-
-        grid = list()
-
-        id = 0
-        for i in range(len(gx) - 1):
-            for j in range(len(gy) - 1):
-                poly = Polygon(
-                    [
-                        [gx[i], gy[j]],
-                        [gx[i], gy[j + 1]],
-                        [gx[i + 1], gy[j + 1]],
-                        [gx[i + 1], gy[j]],
-                        [gx[i], gy[j]],
-                    ]
-                )
-
-                if boundary.intersection(poly):
-                    feature = geojson.Feature(
-                        geometry=boundary.intersection(poly), properties={"id": str(id)}
-                    )
-
-                    geom = shape(feature["geometry"])
-                    # Check if the geometry is a MultiPolygon
-                    if geom.geom_type == "MultiPolygon":
-
-                        # Get the constituent Polygon objects from the MultiPolygon
-                        polygons = geom.geoms
-
-                        for x in range(len(polygons)):
-                            id += 1
-                            # Convert the two polygons to GeoJSON format
-                            feature1 = {
-                                "type": "Feature",
-                                "properties": {"id": str(id)},
-                                "geometry": mapping(polygons[x]),
-                            }
-                            grid.append(feature1)
-                    else:
-                        id += 1
-                        grid.append(feature)
-
-        collection = geojson.FeatureCollection(grid)
-        # jsonout = open("tmp.geojson", 'w')
-        # out = dump(collection, jsonout)
-        out = dumps(collection)
-
-        # If project outline cannot be divided into multiple tasks,
-        #   whole boundary is made into a single task.
-        result = json.loads(out)
-        if len(result["features"]) == 0:
-            geom = loads(data[0][0])
-            out = {
-                "type": "FeatureCollection",
-                "features": [
-                    {
-                        "type": "Feature",
-                        "geometry": geom,
-                        "properties": {"id": project_id},
-                    }
-                ],
-            }
-            out = json.dumps(out)
+        INSERT INTO tasks (
+            project_id, project_task_name, project_task_index, outline, task_status
+        )
+        SELECT
+            :project_id,
+            (row_number() OVER (ORDER BY clipped.i, clipped.j, clipped.path))::text,
+            1,
+            CASE WHEN aoi.proj IS NULL THEN clipped.geom
+            ELSE ST_Transform(clipped.geom, aoi.proj, 4326) END,
+            'READY'
+        FROM clipped, aoi
+        WHERE ST_GeometryType(clipped.geom) = 'ST_Polygon'
+        """
+    )
+    result = db.execute(query, {"project_id": project_id, "size": size})
+    db.execute(
+        text(
+            """UPDATE projects
+            SET total_tasks = (
+                SELECT count(*) FROM tasks WHERE project_id = :project_id
+            )
+            WHERE id = :project_id"""
+        ),
+        {"project_id": project_id},
+    )
+    db.commit()
 
-        return out
-    except Exception as e:
-        logger.error(e)
+    logger.debug(f"Created {result.rowcount} tasks for project {project_id} in db")
+    return result.rowcount
 
 
 def get_json_from_zip(zip, filename: str, error_detail: str):
@@ -1561,36 +1914,6 @@ async def get_extract_completion_count(project_id: int, db: Session):
     return project.extract_completed_count
 
 
-async def get_background_task_status(task_id: uuid.UUID, db: Session):
-    """Get the status of a background task."""
-    task = (
-        db.query(db_models.BackgroundTasks)
-        .filter(db_models.BackgroundTasks.id == str(task_id))
-        .first()
-    )
-    return task.status, task.message
-
-
-async def insert_background_task_into_database(
-    db: Session, task_id: uuid.UUID, name: str = None
-):
-    """Inserts a new task into the database
-    Params:
-        db: database session
-        task_id: uuid of the task
-        name: name of the task.
-    """
-    task = db_models.BackgroundTasks(
-        id=str(task_id), name=name, status=1
-    )  # 1 = running
-
-    db.add(task)
-    db.commit()
-    db.refresh(task)
-
-    return True
-
-
 def update_background_task_status_in_database(
     db: Session, task_id: uuid.UUID, status: int, message: str = None
 ):
@@ -1611,39 +1934,129 @@ def update_background_task_status_in_database(
     return True
 
 
+class RejectedFeatures:
+    """Count the features rejected from an upload, keeping the first reasons."""
+
+    def __init__(self, limit: int = REJECTED_REASONS):
+        """Keep up to limit reasons, however many features are rejected."""
+        self.count = 0
+        self.reasons = []
+        self.limit = limit
+
+    def add(self, reason: str):
+        """Count a rejected feature, keeping its reason if under the limit."""
+        self.count += 1
+        if len(self.reasons) < self.limit:
+            self.reasons.append(reason)
+
+
+def feature_rows(features: Iterable[dict], rejected: RejectedFeatures):
+    """Convert features to (EWKB, JSON properties) rows for COPY.
+
+    Z coordinates are dropped, like the other upload paths do. Features
+    without a usable geometry are skipped and added to rejected.
+    """
+    for index, feature in enumerate(features):
+        try:
+            if not feature.get("geometry"):
+                raise ValueError("missing geometry")
+            geometry = shapely.force_2d(shape(feature["geometry"]))
+            if geometry.is_empty:
+                raise ValueError("empty geometry")
+            properties = json.dumps(feature.get("properties") or {})
+        except Exception as e:
+            rejected.add(f"feature {index}: {e!r}")
+            continue
+        yield postgis_utils.to_ewkb(geometry), properties
+
+
 def add_features_into_database(
-    db: Session, project_id: int, features: dict, background_task_id: uuid.UUID
+    project_id: int,
+    features: Iterable[dict],
+    background_task_id: uuid.UUID,
+    category_title: str = "buildings",
+    chunk_size: int = postgis_utils.COPY_CHUNK_SIZE,
 ):
-    """Inserts a new task into the database
+    """Bulk load features into a project.
+
+    The features are streamed with COPY into a staging table, chunk_size at a
+    time, then inserted into the features table in one statement that also
+    sets the task_id of each feature, by the same rule as
+    assign_features_to_tasks. Rejected features are counted, and the first
+    reasons recorded in the background task message.
+    This runs as a background task, so it opens its own database session.
+
     Params:
-          db: database session
           project_id: id of the project
-          features: features to be added.
+          features: features to be added, which may be streamed from a file.
+          background_task_id: uuid of the background task running this function.
     """
-    success = 0
-    failure = 0
-    for feature in features["features"]:
-        try:
-            feature_geometry = feature["geometry"]
-            feature_shape = shape(feature_geometry)
-
-            wkb_element = from_shape(feature_shape, srid=4326)
-            feature_obj = db_models.DbFeatures(
-                project_id=project_id,
-                category_title="buildings",
-                geometry=wkb_element,
-                task_id=1,
-                properties=feature["properties"],
+    db = database.SessionLocal()
+    rejected = RejectedFeatures()
+    try:
+        db.execute(
+            text(
+                """CREATE TEMPORARY TABLE feature_staging (
+                    geometry geometry(Geometry, 4326),
+                    properties jsonb
+                ) ON COMMIT DROP"""
             )
-            db.add(feature_obj)
-            db.commit()
-            success += 1
-        except Exception:
-            failure += 1
-            continue
+        )
+        postgis_utils.copy_rows(
+            db,
+            "feature_staging",
+            ["geometry", "properties"],
+            feature_rows(features, rejected),
+            chunk_size,
+        )
+
+        query = text(
+            """
+            INSERT INTO features (
+                project_id, category_title, geometry, properties, task_id
+            )
+            SELECT :project_id, :category_title, s.geometry, s.properties, task.id
+            FROM feature_staging AS s
+            LEFT JOIN LATERAL (
+                SELECT t.id
+                FROM tasks AS t
+                WHERE t.project_id = :project_id
+                AND ST_Intersects(t.outline, s.geometry)
+                ORDER BY ST_Intersects(t.outline, ST_Centroid(s.geometry)) DESC, t.id
+                LIMIT 1
+            ) AS task ON true
+            """
+        )
+        result = db.execute(
+            query, {"project_id": project_id, "category_title": category_title}
+        )
+        added = result.rowcount
+        db.commit()
+
+        # Refresh the planner statistics after a large load
+        db.execute(text("ANALYZE features"))
+        db.commit()
+
+        message = f"Added {added} features, rejected {rejected.count}"
+        if rejected.count:
+            reasons = "; ".join(rejected.reasons)
+            logger.warning(f"{message} for project {project_id}: {reasons}")
+            message += f": {reasons}"
+        else:
+            logger.info(f"{message} for project {project_id}")
+        update_background_task_status_in_database(
+            db, background_task_id, 4, message
+        )  # 4 is COMPLETED
+
+    except Exception as e:
+        logger.error(f"Failed to add features to project {project_id}: {e}")
+        db.rollback()
+        update_background_task_status_in_database(
+            db, background_task_id, 2, str(e)
+        )  # 2 is FAILED
+        return False
 
-    update_background_task_status_in_database(
-        db, background_task_id, 4
-    )  # 4 is COMPLETED
+    finally:
+        db.close()
 
     return True
@@ -16,14 +16,14 @@
 #     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
 #
 
-import json
 import os
+import shutil
+import tempfile
 import uuid
 from typing import List, Optional
 
 from fastapi import (
     APIRouter,
-    BackgroundTasks,
     Depends,
     File,
     Form,
@@ -35,7 +35,11 @@ from osm_fieldwork.make_data_extract import getChoices
 from sqlalchemy.orm import Session
 
 from ..central import central_crud
-from ..db import database
+from ..config import settings
+from ..db import database, postgis_utils
+from ..jobs import job_crud
+from ..jobs import progress as job_progress
+from ..models.enums import GridType
 from . import project_crud, project_schemas
 from ..tasks import tasks_crud
 
@@ -47,6 +51,14 @@ router = APIRouter(
 )
 
 
+def read_geojson_upload(upload: UploadFile) -> dict:
+    """Read an uploaded GeoJSON file as a FeatureCollection."""
+    try:
+        return postgis_utils.read_geojson(upload.file)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+
+
 @router.get("/", response_model=List[project_schemas.ProjectOut])
 async def read_projects(
     user_id: int = None,
@@ -251,9 +263,8 @@ async def upload_multi_project_boundary(
     A success message indicating that the boundary was successfully uploaded.
     If the project ID does not exist in the database, an HTTP 428 error is raised.
     """
-    # read entire file
-    content = await upload.read()
-    boundary = json.loads(content)
+    # parse the features one at a time
+    boundary = read_geojson_upload(upload)
 
     """Create tasks for each polygon """
     result = project_crud.update_multi_polygon_project_boundary(
@@ -275,19 +286,67 @@ async def task_split(
     db: Session = Depends(database.get_db)
     ):
 
-    # read entire file
-    content = await upload.read()
+    # parse the features one at a time
+    boundary = read_geojson_upload(upload)
 
-    result = await project_crud.split_into_tasks(db, project_id, content)
+    result = await project_crud.split_into_tasks(db, project_id, boundary)
 
     return result
 
 
+@router.post("/{project_id}/split_by_feature_count")
+async def split_by_feature_count(
+    project_id: int,
+    upload: UploadFile = File(...),
+    max_features: int = Form(100),
+    data_extract: Optional[UploadFile] = File(None),
+    db: Session = Depends(database.get_db),
+):
+    """Split the project boundary into tasks with an even number of features.
+
+    The boundary is recursively subdivided (quadtree) until every task holds
+    at most `max_features` features, so dense areas get small tasks and
+    sparse areas large ones.
+
+    Params:
+    - project_id (int): The ID of the project to split.
+    - upload (UploadFile): The boundary geojson file.
+    - max_features (int): The maximum number of features per task.
+    - data_extract (UploadFile): Optional geojson of features to balance on.
+        If not provided, the features already loaded for the project are used.
+
+    Returns:
+    - Dict: A dictionary with a message, the project ID, and the number of tasks.
+    """
+    if max_features < 1:
+        raise HTTPException(status_code=400, detail="max_features must be positive")
+
+    boundary = read_geojson_upload(upload)
+    extract = read_geojson_upload(data_extract) if data_extract else None
+
+    task_count = project_crud.split_by_feature_count(
+        db, project_id, boundary, max_features, extract
+    )
+    if not task_count:
+        raise HTTPException(
+            status_code=428, detail=f"Project with id {project_id} does not exist"
+        )
+
+    return {
+        "message": "Project Boundary Uploaded",
+        "project_id": project_id,
+        "task_count": task_count,
+    }
+
+
 @router.post("/{project_id}/upload")
 async def upload_project_boundary(
     project_id: int,
     upload: UploadFile = File(...),
     dimension: int = Form(500),
+    server_side: bool = Form(False),
+    grid_type: GridType = Form(GridType.SQUARE),
+    projected: bool = Form(False),
     db: Session = Depends(database.get_db),
 ):
     """
@@ -297,6 +356,10 @@ async def upload_project_boundary(
     - project_id (int): The ID of the project to update.
     - upload (UploadFile): The boundary file to upload.
     - dimension (int): The new dimension of the project.
+    - server_side (bool): Generate and clip the task grid inside the database.
+    - grid_type (GridType): Square or hexagonal task cells.
+    - projected (bool): Lay the grid out in metres in a local equal-area projection,
+        so cells have the same ground size at any latitude.
     - db (Session): The database session to use.
 
     Returns:
@@ -310,12 +373,13 @@ async def upload_project_boundary(
     if file_ext not in allowed_extensions:
         raise HTTPException(status_code=400, detail="Provide a valid .geojson file")
 
-    # read entire file
-    content = await upload.read()
-    boundary = json.loads(content)
+    # parse the features one at a time
+    boundary = read_geojson_upload(upload)
 
     # update project boundary and dimension
-    result = project_crud.update_project_boundary(db, project_id, boundary, dimension)
+    result = project_crud.update_project_boundary(
+        db, project_id, boundary, dimension, server_side, grid_type, projected
+    )
     if not result:
         raise HTTPException(
             status_code=428, detail=f"Project with id {project_id} does not exist"
@@ -353,9 +417,22 @@ async def download_task_boundaries(
     return {"Message": out}
 
 
+def spool_upload(upload: UploadFile, suffix: str) -> str:
+    """Save an upload for a background job, returning its path.
+
+    JOB_FILES_DIR must be shared with the workers, which remove the file
+    once they have read it.
+    """
+    os.makedirs(settings.JOB_FILES_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=settings.JOB_FILES_DIR, suffix=suffix, delete=False
+    ) as spool:
+        shutil.copyfileobj(upload.file, spool)
+    return spool.name
+
+
 @router.post("/{project_id}/generate")
 async def generate_files(
-    background_tasks: BackgroundTasks,
     project_id: int,
     extract_polygon: bool = Form(False),
     upload: Optional[UploadFile] = File(None),
@@ -382,7 +459,7 @@ async def generate_files(
     Message (str): A success message containing the project ID.
 
     """
-    contents = None
+    upload_path = None
     xform_title = None
     if upload:
         # Validating for .XLS File.
@@ -392,30 +469,66 @@ async def generate_files(
         if file_ext not in allowed_extensions:
             raise HTTPException(status_code=400, detail="Provide a valid .xls file")
         xform_title = file_name[0]
-        contents = await upload.read()
-
-    # generate a unique task ID using uuid
-    background_task_id = uuid.uuid4()
-
-    # insert task and task ID into database
-    await project_crud.insert_background_task_into_database(
-        db, task_id=background_task_id
-    )
+        upload_path = spool_upload(upload, file_ext)
 
-    background_tasks.add_task(
-        project_crud.generate_appuser_files,
+    # queue the job for the background workers
+    background_task_id = job_crud.enqueue_job(
         db,
-        project_id,
-        extract_polygon,
-        contents,
-        xform_title,
-        background_task_id,
+        job_crud.GENERATE_APPUSER_FILES,
+        {
+            "project_id": project_id,
+            "extract_polygon": extract_polygon,
+            "upload_path": upload_path,
+            "category": xform_title,
+        },
     )
 
     # FIXME: fix return value
     return {"Message": f"{project_id}", "task_id": f"{background_task_id}"}
 
 
+@router.post("/{project_id}/generate/resume")
+async def resume_generate_files(
+    project_id: int,
+    extract_polygon: bool = Form(False),
+    db: Session = Depends(database.get_db),
+):
+    """Resume generating the files of a project after a failed or interrupted run.
+
+    Tasks whose app user, form and QR code were all generated are skipped,
+    and the others carry on from the last stage they completed, reusing their
+    app user. The data extract and any custom form of the earlier run are reused.
+
+    Parameters:
+
+    project_id (int): The ID of the project to resume.
+    polygon (bool): A boolean flag indicating whether the polygon is extracted or not,
+        only used if the data extract was not loaded by the earlier run.
+
+    Returns:
+    Message (str): The project ID, the background task ID and the tasks left to do.
+    """
+    remaining = project_crud.get_incomplete_generation_count(db, project_id)
+    if not remaining:
+        raise HTTPException(
+            status_code=400,
+            detail=f"All tasks of project {project_id} have been generated",
+        )
+
+    # queue the job for the background workers
+    background_task_id = job_crud.enqueue_job(
+        db,
+        job_crud.GENERATE_APPUSER_FILES,
+        {"project_id": project_id, "extract_polygon": extract_polygon, "resume": True},
+    )
+
+    return {
+        "Message": f"{project_id}",
+        "task_id": f"{background_task_id}",
+        "remaining_tasks": remaining,
+    }
+
+
 
 @router.get("/{project_id}/features", response_model=List[project_schemas.Feature])
 def get_project_features(
@@ -451,24 +564,28 @@ async def generate_log(
 
     ### Return format
     Task Status and Logs are returned in a JSON format.
+    `progress` is the number of tasks generated, and `stages` has the
+    per-stage counters, rates and ETA, as returned by /jobs/{job_id}.
     """
     try:
-        # Get the backgrund task status
-        task_status, task_message = await project_crud.get_background_task_status(uuid, db)
-        extract_completion_count = await project_crud.get_extract_completion_count(
-            project_id, db
-        )
-
-        with open(f"/tmp/{project_id}_generate.log", "r") as f:
-            lines = f.readlines()
-            last_100_lines = lines[-50:]
-            logs = "".join(last_100_lines)
-            return {
-                "status": task_status.name,
-                "message":task_message,
-                "progress": extract_completion_count,
-                "logs": logs,
-            }
+        job = job_crud.get_job(db, str(uuid))
+        summary = job_progress.summarize(job.progress)
+        if summary and "tasks" in summary["stages"]:
+            tasks_done = summary["stages"]["tasks"]["done"]
+        else:
+            tasks_done = await project_crud.get_extract_completion_count(
+                project_id, db
+            )
+
+        # Only the end of the log is read
+        logs = job_progress.tail(f"/tmp/{project_id}_generate.log", 50)
+        return {
+            "status": job.status.name,
+            "message": job.message,
+            "progress": tasks_done,
+            "stages": summary,
+            "logs": logs,
+        }
     except Exception as e:
         logger.error(e)
         return "Error in generating log file"
@@ -491,13 +608,21 @@ async def get_categories():
 
 
 @router.post("/preview_tasks/")
-async def preview_tasks(upload: UploadFile = File(...), dimension: int = Form(500)):
+async def preview_tasks(
+    upload: UploadFile = File(...),
+    dimension: int = Form(500),
+    grid_type: GridType = Form(GridType.SQUARE),
+    projected: bool = Form(False),
+):
     """Preview tasks for a project.
 
     This endpoint allows you to preview tasks for a project.
 
     ## Request Body
-    - `project_id` (int): the project's id. Required.
+    - `upload` (file): Geojson file with the project boundary. Required.
+    - `dimension` (int): the task size in metres.
+    - `grid_type` (str): `square` or `hexagon` cells.
+    - `projected` (bool): lay the grid out in metres in a local projection.
 
     ## Response
     - Returns a JSON object containing a list of tasks.
@@ -510,17 +635,17 @@ async def preview_tasks(upload: UploadFile = File(...), dimension: int = Form(50
     if file_ext not in allowed_extensions:
         raise HTTPException(status_code=400, detail="Provide a valid .geojson file")
 
-    # read entire file
-    content = await upload.read()
-    boundary = json.loads(content)
+    # parse the features one at a time
+    boundary = read_geojson_upload(upload)
 
-    result = await project_crud.preview_tasks(boundary, dimension)
+    result = await project_crud.preview_tasks(
+        boundary, dimension, grid_type, projected
+    )
     return result
 
 
 @router.post("/add_features/")
 async def add_features(
-    background_tasks: BackgroundTasks,
     project_id: int,
     upload: UploadFile = File(...),
     db: Session = Depends(database.get_db),
@@ -533,6 +658,8 @@ async def add_features(
     - `project_id` (int): the project's id. Required.
     - `upload` (file): Geojson files with the features. Required.
 
+    The features are added by a background job. Its status, and the number
+    of features added and rejected, are at /jobs/{task_id}.
     """
     # Validating for .geojson File.
     file_name = os.path.splitext(upload.filename)
@@ -541,25 +668,13 @@ async def add_features(
     if file_ext not in allowed_extensions:
         raise HTTPException(status_code=400, detail="Provide a valid .geojson file")
 
-    # read entire file
-    content = await upload.read()
-    features = json.loads(content)
-
-    # generate a unique task ID using uuid
-    background_task_id = uuid.uuid4()
-
-    # insert task and task ID into database
-    await project_crud.insert_background_task_into_database(
-        db, task_id=background_task_id
-    )
-
-    background_tasks.add_task(
-        project_crud.add_features_into_database,
+    # Spool the upload to disk, so a background worker can stream the
+    # features from it after this request has finished.
+    background_task_id = job_crud.enqueue_job(
         db,
-        project_id,
-        features,
-        background_task_id,
+        job_crud.ADD_FEATURES,
+        {"project_id": project_id, "path": spool_upload(upload, file_ext)},
     )
-    return True
+    return {"Message": f"{project_id}", "task_id": f"{background_task_id}"}
 
 
@@ -0,0 +1,283 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+"""Task grid engine used to split a project boundary into tasks."""
+
+import geojson
+import numpy as np
+import shapely
+from shapely.geometry import mapping
+from shapely.geometry.base import BaseGeometry
+
+from ..models.enums import GridType
+
+# 1 degree = 111139 m
+METRES_PER_DEGREE = 111139
+
+# Mean earth radius, used by the local equal-area projection
+EARTH_RADIUS = 6371008.8
+
+
+def get_grid_lattice(bounds: tuple, dimension: int):
+    """Get the x and y lattice lines covering the bounds, in degrees."""
+    minx, miny, maxx, maxy = bounds
+
+    value = dimension / METRES_PER_DEGREE
+
+    nx = int((maxx - minx) / value)
+    ny = int((maxy - miny) / value)
+
+    xdiff = abs(maxx - minx)
+    ydiff = abs(maxy - miny)
+    if xdiff > ydiff:
+        gx, gy = np.linspace(minx, maxx, ny), np.linspace(miny, miny + xdiff, ny)
+    else:
+        gx, gy = np.linspace(minx, minx + ydiff, nx), np.linspace(miny, maxy, nx)
+    return gx, gy
+
+
+def get_grid_cells(gx: np.ndarray, gy: np.ndarray) -> np.ndarray:
+    """Build every cell of the lattice as one array of polygons.
+
+    Cells are ordered column by column (x outer, y inner).
+    """
+    if len(gx) < 2 or len(gy) < 2:
+        return np.empty(0, dtype=object)
+
+    x0, y0 = np.meshgrid(gx[:-1], gy[:-1], indexing="ij")
+    x1, y1 = np.meshgrid(gx[1:], gy[1:], indexing="ij")
+    return shapely.box(x0.ravel(), y0.ravel(), x1.ravel(), y1.ravel(), ccw=False)
+
+
+def get_metric_lattice(bounds: tuple, dimension: float):
+    """Get x and y lattice lines spaced exactly dimension apart over the bounds."""
+    minx, miny, maxx, maxy = bounds
+
+    nx = max(int(np.ceil((maxx - minx) / dimension)), 1)
+    ny = max(int(np.ceil((maxy - miny) / dimension)), 1)
+    return minx + np.arange(nx + 1) * dimension, miny + np.arange(ny + 1) * dimension
+
+
+def get_hexagon_cells(bounds: tuple, size: float) -> np.ndarray:
+    """Build flat-topped hexagons with edges of the given size over the bounds.
+
+    The layout matches PostGIS ST_HexagonGrid: columns are 1.5 * size apart
+    and every odd column is shifted up by half a hexagon height.
+    """
+    minx, miny, maxx, maxy = bounds
+    height = np.sqrt(3) * size
+
+    nx = int(np.ceil((maxx - minx) / (1.5 * size))) + 1
+    ny = int(np.ceil((maxy - miny) / height)) + 1
+    cols, rows = np.meshgrid(np.arange(nx), np.arange(ny), indexing="ij")
+    cx = minx + cols.ravel() * 1.5 * size
+    cy = miny + (rows.ravel() + (cols.ravel() % 2) / 2) * height
+
+    angles = np.radians(np.arange(0, 420, 60))
+    coords = np.stack(
+        [
+            cx[:, np.newaxis] + size * np.cos(angles),
+            cy[:, np.newaxis] + size * np.sin(angles),
+        ],
+        axis=-1,
+    )
+    return shapely.polygons(coords)
+
+
+def get_local_projection(boundary: BaseGeometry):
+    """Get a Lambert azimuthal equal-area projection centred on the boundary.
+
+    Returns the forward (lon/lat to metres) and inverse (metres to lon/lat)
+    coordinate functions, suitable for shapely.transform.
+    """
+    centroid = boundary.centroid
+    lon0, lat0 = np.radians(centroid.x), np.radians(centroid.y)
+
+    def forward(coords: np.ndarray) -> np.ndarray:
+        lon, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+        cos_c = np.sin(lat0) * np.sin(lat) + np.cos(lat0) * np.cos(lat) * np.cos(
+            lon - lon0
+        )
+        k = np.sqrt(2 / (1 + cos_c))
+        x = EARTH_RADIUS * k * np.cos(lat) * np.sin(lon - lon0)
+        north = np.cos(lat0) * np.sin(lat)
+        y = EARTH_RADIUS * k * (north - np.sin(lat0) * np.cos(lat) * np.cos(lon - lon0))
+        return np.column_stack([x, y])
+
+    def inverse(coords: np.ndarray) -> np.ndarray:
+        x, y = coords[:, 0], coords[:, 1]
+        rho = np.hypot(x, y)
+        c = 2 * np.arcsin(rho / (2 * EARTH_RADIUS))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            lat = np.where(
+                rho == 0,
+                lat0,
+                np.arcsin(
+                    np.cos(c) * np.sin(lat0) + y * np.sin(c) * np.cos(lat0) / rho
+                ),
+            )
+        lon = lon0 + np.arctan2(
+            x * np.sin(c),
+            rho * np.cos(lat0) * np.cos(c) - y * np.sin(lat0) * np.sin(c),
+        )
+        return np.column_stack([np.degrees(lon), np.degrees(lat)])
+
+    return forward, inverse
+
+
+def clip_cells(boundary: BaseGeometry, cells: np.ndarray) -> list:
+    """Clip the grid cells to the boundary, returning the resulting polygons.
+
+    Cells not touching the boundary are dropped with an STRtree query,
+    cells lying fully inside the prepared boundary are kept untouched,
+    and only the remaining edge cells are intersected.
+    MultiPolygon results are split into their parts, in cell order.
+    """
+    if len(cells) == 0:
+        return []
+
+    tree = shapely.STRtree(cells)
+    index = np.sort(tree.query(boundary, predicate="intersects"))
+    candidates = cells[index]
+
+    shapely.prepare(boundary)
+    inside = shapely.contains_properly(boundary, candidates)
+    clipped = candidates.copy()
+    clipped[~inside] = shapely.intersection(boundary, candidates[~inside])
+
+    parts = shapely.get_parts(clipped)
+    polygons = parts[
+        (shapely.get_type_id(parts) == shapely.GeometryType.POLYGON)
+        & ~shapely.is_empty(parts)
+    ]
+    return list(polygons)
+
+
+def create_grid(
+    boundary: BaseGeometry,
+    dimension: int,
+    grid_type: GridType = GridType.SQUARE,
+    projected: bool = False,
+) -> list:
+    """Split the boundary into grid cells of the given dimension (metres).
+
+    By default the square grid is laid out in degrees, using a fixed
+    conversion factor. With projected=True the boundary is transformed to a
+    local equal-area projection, tiled in metres and transformed back, so
+    every cell covers the same ground area at any latitude.
+
+    For hexagonal grids the dimension is the length of a hexagon edge.
+    """
+    if projected:
+        forward, inverse = get_local_projection(boundary)
+        area = shapely.transform(boundary, forward)
+        size = dimension
+    else:
+        area = boundary
+        size = dimension / METRES_PER_DEGREE
+
+    if grid_type == GridType.HEXAGON:
+        cells = get_hexagon_cells(area.bounds, size)
+    elif projected:
+        cells = get_grid_cells(*get_metric_lattice(area.bounds, size))
+    else:
+        cells = get_grid_cells(*get_grid_lattice(area.bounds, dimension))
+
+    polygons = clip_cells(area, cells)
+
+    if projected and polygons:
+        polygons = list(shapely.transform(np.array(polygons), inverse))
+    return polygons
+
+
+def get_quadtree_cells(
+    bounds: tuple, points: np.ndarray, max_features: int, max_depth: int = 16
+) -> np.ndarray:
+    """Subdivide the bounds until each quadtree cell holds at most max_features.
+
+    The tree is built level by level over the whole point array, rather than
+    recursing cell by cell: at each depth every remaining point is binned
+    into the 2^depth x 2^depth lattice and only overfull cells are split.
+    Cells at max_depth are never split further.
+    """
+    minx, miny, maxx, maxy = bounds
+    side = max(maxx - minx, maxy - miny)
+    if side <= 0:
+        return np.empty(0, dtype=object)
+
+    leaves = []
+    nodes = np.zeros((1, 2), dtype=np.int64)
+    active = np.asarray(points, dtype=float).reshape(-1, 2)
+    for depth in range(max_depth + 1):
+        n = 2**depth
+        size = side / n
+
+        ix = np.clip(((active[:, 0] - minx) / size).astype(np.int64), 0, n - 1)
+        iy = np.clip(((active[:, 1] - miny) / size).astype(np.int64), 0, n - 1)
+        keys = ix * n + iy
+        node_keys = nodes[:, 0] * n + nodes[:, 1]
+
+        occupied, counts = np.unique(keys, return_counts=True)
+        node_counts = np.zeros(len(nodes), dtype=np.int64)
+        found = np.isin(node_keys, occupied)
+        node_counts[found] = counts[np.searchsorted(occupied, node_keys[found])]
+
+        split = node_counts > max_features
+        if depth == max_depth:
+            split[:] = False
+
+        leaf = nodes[~split]
+        leaves.append(
+            shapely.box(
+                minx + leaf[:, 0] * size,
+                miny + leaf[:, 1] * size,
+                minx + (leaf[:, 0] + 1) * size,
+                miny + (leaf[:, 1] + 1) * size,
+            )
+        )
+        if not split.any():
+            break
+
+        active = active[np.isin(keys, node_keys[split])]
+        parents = nodes[split] * 2
+        nodes = np.concatenate(
+            [parents + offset for offset in ([0, 0], [0, 1], [1, 0], [1, 1])]
+        )
+
+    return np.concatenate(leaves)
+
+
+def split_by_feature_count(
+    boundary: BaseGeometry, points: np.ndarray, max_features: int
+) -> list:
+    """Split the boundary into quadtree tasks of at most max_features each.
+
+    The points are the feature centroids, as an (n, 2) array of lon/lat.
+    """
+    cells = get_quadtree_cells(boundary.bounds, points, max_features)
+    return clip_cells(boundary, cells)
+
+
+def grid_to_feature_collection(polygons: list) -> geojson.FeatureCollection:
+    """Convert grid polygons to a FeatureCollection, numbering each task."""
+    return geojson.FeatureCollection(
+        [
+            geojson.Feature(geometry=mapping(polygon), properties={"id": str(index)})
+            for index, polygon in enumerate(polygons, start=1)
+        ]
+    )
@@ -0,0 +1,167 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+"""Async client for the HOT raw-data-api OSM snapshots."""
+
+import asyncio
+import json
+import tempfile
+import zipfile
+
+import httpx
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.logger import logger as logger
+
+from ..config import settings
+from . import extract_cache
+
+# Filters for the osm extracts used to split a project into tasks
+OSM_LINES_FILTERS = {
+    "tags": {
+        "all_geometry": {
+            "join_or": {
+                "highway": [],
+                "waterway": [],
+            }
+        }
+    }
+}
+
+
+async def wait_for_snapshot(
+    client: httpx.AsyncClient,
+    task_id: str,
+    deadline: float,
+    poll_interval: float,
+    max_poll_interval: float,
+):
+    """Poll a snapshot task with exponential backoff until it finishes.
+
+    Raises an HTTPException if the task fails or the deadline passes.
+    Returns the task result, containing the download_url.
+    """
+    loop = asyncio.get_running_loop()
+    delay = poll_interval
+
+    while True:
+        response = await client.get(f"/tasks/status/{task_id}")
+        response.raise_for_status()
+        status = response.json()
+
+        if status["status"] == "SUCCESS":
+            return status["result"]
+        if status["status"] in ("FAILURE", "REVOKED"):
+            raise HTTPException(
+                status_code=502, detail=f"OSM extract failed: {status.get('result')}"
+            )
+
+        if loop.time() + delay > deadline:
+            raise HTTPException(
+                status_code=504, detail="Timed out waiting for the OSM extract"
+            )
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_poll_interval)
+
+
+async def get_osm_extracts(
+    geometry: dict,
+    filters: dict = OSM_LINES_FILTERS,
+    base_url: str = settings.RAW_DATA_API_URL,
+    timeout: float = 600,
+    poll_interval: float = 1,
+    max_poll_interval: float = 30,
+):
+    """Get the OSM features in a geometry from the raw-data-api.
+
+    A snapshot is requested, polled until ready (for at most timeout seconds
+    overall), and the zipped GeoJSON result is streamed to a temporary file
+    before being parsed. Results are kept in the extract cache, so the same
+    AOI and filters are only requested once. The file reads and writes,
+    and the parsing, are run in the threadpool.
+    Returns the FeatureCollection as a dict.
+    """
+    key = extract_cache.cache_key(geometry, source=base_url, filters=filters)
+    data = await run_in_threadpool(extract_cache.get_cached_extract, key)
+    if data is not None:
+        return data
+
+    data = await request_snapshot(
+        geometry, filters, base_url, timeout, poll_interval, max_poll_interval
+    )
+    await run_in_threadpool(extract_cache.cache_extract, key, data)
+    return data
+
+
+def read_export(zip_file) -> dict:
+    """Parse the GeoJSON export in a downloaded snapshot zip."""
+    zip_file.seek(0)
+    with zipfile.ZipFile(zip_file) as archive:
+        with archive.open("Export.geojson") as geojson_file:
+            return json.load(geojson_file)
+
+
+async def request_snapshot(
+    geometry: dict,
+    filters: dict,
+    base_url: str,
+    timeout: float,
+    poll_interval: float,
+    max_poll_interval: float,
+):
+    """Request a snapshot from the raw-data-api and download the result."""
+    query = {
+        "geometry": geometry,
+        "filters": filters,
+        "geometryType": ["polygon", "line"],
+        "centroid": "false",
+    }
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    async with httpx.AsyncClient(
+        base_url=base_url,
+        headers={"accept": "application/json"},
+        timeout=httpx.Timeout(60, connect=10),
+    ) as client:
+        try:
+            response = await client.post("/snapshot/", json=query)
+            response.raise_for_status()
+            task_id = response.json()["task_id"]
+
+            result = await wait_for_snapshot(
+                client, task_id, deadline, poll_interval, max_poll_interval
+            )
+
+            zip_file = await run_in_threadpool(tempfile.TemporaryFile)
+            try:
+                async with client.stream("GET", result["download_url"]) as download:
+                    download.raise_for_status()
+                    async for chunk in download.aiter_bytes():
+                        await run_in_threadpool(zip_file.write, chunk)
+
+                return await run_in_threadpool(read_export, zip_file)
+            finally:
+                zip_file.close()
+
+        except httpx.HTTPError as e:
+            logger.error(f"raw-data-api request failed: {e}")
+            raise HTTPException(
+                status_code=502, detail=f"Could not get OSM extract: {e}"
+            ) from e
@@ -19,17 +19,30 @@
 import csv
 import io
 import os
+import tempfile
+import textwrap
 import zipfile
+import itertools
 import json
 from datetime import datetime
 import logging
-from fastapi import HTTPException, Response
-from fastapi.responses import FileResponse
+import zlib
+from typing import BinaryIO, Iterable, Iterator, Optional, Tuple
+from zipfile import ZIP64_LIMIT
+from fastapi import HTTPException
+from fastapi.responses import FileResponse, StreamingResponse
 from sqlalchemy.orm import Session
 
-from ..central.central_crud import get_odk_form, get_odk_project
+from ..central.central_crud import (
+    download_submission_media,
+    get_odk_form,
+    iter_fan_out,
+    get_odk_project,
+    list_tasks_submissions,
+)
 from ..tasks import tasks_crud
 from ..projects import project_crud, project_schemas
+from . import submission_sync
 from osm_fieldwork.json2osm import JsonDump
 from pathlib import Path
 from fastapi.logger import logger as logger
@@ -39,12 +52,13 @@ def get_submission_of_project(db: Session, project_id: int, task_id: int = None)
     """Gets the submission of project.
     This function takes project_id and task_id as a parameter.
     If task_id is provided, it returns all the submission made to that particular task, else all the submission made in the projects are returned.
+    Returns the submissions, and the errors of the tasks that failed by task id.
     """
     project_info = project_crud.get_project(db, project_id)
 
     # Return empty list if project is not found
     if not project_info:
-        return []
+        return [], {}
 
     odkid = project_info.odkid
     project_name = project_info.project_name_prefix
@@ -60,6 +74,17 @@ def get_submission_of_project(db: Session, project_id: int, task_id: int = None)
             status_code=404, detail="ODK Central Credentials not found in project"
         )
 
+    # Read the local copy of the submissions, once the project has been synced
+    if submission_sync.use_local_copy(db, project_id):
+        submission_list = [
+            submission_sync.submission_metadata(submission)
+            for submission in submission_sync.get_submissions(db, project_id, task_id)
+        ]
+        if task_id is not None:
+            for x in submission_list:
+                x["submitted_by"] = f"{project_name}_{form_category}_{task_id}"
+        return submission_list, {}
+
     # ODK Credentials
     odk_credentials = project_schemas.ODKCentral(
         odk_central_url=project_info.odk_central_url,
@@ -67,35 +92,31 @@ def get_submission_of_project(db: Session, project_id: int, task_id: int = None)
         odk_central_password=project_info.odk_central_password,
     )
 
-    xform = get_odk_form(odk_credentials)
-
     # If task id is not provided, submission for all the task are listed
     if task_id is None:
-        task_list = []
+        # XML Form Id is a combination or project_name, category and task_id
+        form_ids = {
+            x.id: f"{project_name}_{form_category}_{x.id}".split("_")[2]
+            for x in project_tasks
+        }
 
-        task_list = [x.id for x in project_tasks]
+        # The tasks are listed concurrently, and merged in task order.
+        # Failed tasks are left out, and returned with their error.
+        submissions, errors = list_tasks_submissions(odkid, form_ids, odk_credentials)
 
         data = []
-
-        for id in task_list:
-
-            # XML Form Id is a combination or project_name, category and task_id
-            xml_form_id = f"{project_name}_{form_category}_{id}".split("_")[2]
-            submission_list = xform.listSubmissions(odkid, xml_form_id)
-
-            # data.append(submission_list)
-            if isinstance(submission_list, list):
-                for submission in submission_list:
-                    data.append(submission)
-        return data
+        for submission_list in submissions.values():
+            data.extend(submission_list)
+        return data, errors
 
     else:
+        xform = get_odk_form(odk_credentials)
         # If task_id is provided, submission made to this particular task is returned.
         xml_form_id = f"{project_name}_{form_category}_{task_id}".split("_")[2]
         submission_list = xform.listSubmissions(odkid, xml_form_id)
         for x in submission_list:
             x["submitted_by"] = f"{project_name}_{form_category}_{task_id}"
-        return submission_list
+        return submission_list, {}
 
 
 def get_forms_of_project(db: Session, project_id: int):
@@ -125,6 +146,181 @@ def list_app_users_or_project(db: Session, project_id: int):
     return result
 
 
+# Size of the chunks copied into streamed downloads
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class StreamBuffer(io.RawIOBase):
+    """An unseekable file keeping what is written to it, until drained."""
+
+    def __init__(self):
+        """Create an empty buffer."""
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        """Whether the file can be written to, it always can."""
+        return True
+
+    def write(self, data):
+        """Keep a copy of the bytes written."""
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        """Get and forget the bytes written since the last drain."""
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(archives: Iterable[Tuple[str, BinaryIO]]) -> Iterator[bytes]:
+    """Merge zip files into a new zip, yielded in chunks as it is written.
+
+    archives yields (directory, zip file) pairs, and the entries of each zip
+    file are copied into that directory of the new zip. Entries are copied
+    a chunk at a time, without extracting them, and the new zip is never
+    held whole in memory or on disk.
+    """
+    buffer = StreamBuffer()
+    # zipfile writes data descriptors, as the buffer cannot be seeked
+    with zipfile.ZipFile(buffer, mode="w") as merged:
+        for directory, file in archives:
+            with zipfile.ZipFile(file) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    entry = zipfile.ZipInfo(
+                        f"{directory}/{info.filename}", info.date_time
+                    )
+                    entry.compress_type = info.compress_type
+                    with archive.open(info) as source, merged.open(
+                        entry, mode="w", force_zip64=info.file_size > ZIP64_LIMIT
+                    ) as target:
+                        while chunk := source.read(STREAM_CHUNK_SIZE):
+                            target.write(chunk)
+                            yield buffer.drain()
+    yield buffer.drain()
+
+
+def task_media_archives(
+    odkid: int, xform_ids: dict, odk_credentials: project_schemas.ODKCentral
+) -> Iterator[Tuple[str, BinaryIO]]:
+    """Download the submission zip of each task form, one at a time.
+
+    xform_ids maps directory names to XForm ids. Each zip is kept in a
+    temporary file, removed as soon as the next one is requested, so
+    concurrent downloads never share files. A form that fails raises an
+    HTTPException, rather than being left out of the zip.
+    """
+    for directory, xform_id in xform_ids.items():
+        with tempfile.TemporaryFile() as file:
+            try:
+                download_submission_media(odkid, xform_id, file, odk_credentials)
+            except Exception as e:
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"Could not get the submissions to form {xform_id}: {e}",
+                ) from e
+            yield directory, file
+
+
+def prime_stream(blocks: Iterator[bytes]) -> Iterator[bytes]:
+    """Read the first block of a streamed response before it is sent.
+
+    Failures up to the first block then get an error status, later ones
+    can only abort the response.
+    """
+    first = next(blocks, b"")
+    return itertools.chain([first], blocks)
+
+
+def iter_file(file: BinaryIO) -> Iterator[bytes]:
+    """Yield the contents of a file in chunks, then close it."""
+    with file:
+        while chunk := file.read(STREAM_CHUNK_SIZE):
+            yield chunk
+
+
+# Encoded JSON is yielded once this many bytes have been gathered
+EXPORT_BUFFER_SIZE = 64 * 1024
+
+
+def json_export(
+    records: Iterable[dict],
+    ndjson: bool = False,
+    compact: bool = False,
+    envelope: Optional[dict] = None,
+) -> Iterator[str]:
+    """Encode records as a JSON array, or as NDJSON, one record at a time.
+
+    The indented array is the same as json.dumps(records, indent=4). With an
+    envelope, the array is the "value" of an object holding the envelope
+    members first, like the ODK Central OData responses. NDJSON has one
+    compact record per line, not wrapped.
+    """
+    if ndjson:
+        for record in records:
+            yield json.dumps(record, separators=(",", ":")) + "\n"
+        return
+
+    if envelope is None:
+        empty = "[]"
+        start, separator, end = ("[", ",", "]") if compact else ("[\n", ",\n", "\n]")
+    elif compact:
+        # The object with an empty "value", split where the records go
+        empty = json.dumps({**envelope, "value": []}, separators=(",", ":"))
+        start, separator, end = empty[:-2], ",", "]}"
+    else:
+        empty = json.dumps({**envelope, "value": []}, indent=4)
+        start, separator, end = empty[:-3] + "\n", ",\n", "\n    ]\n}"
+    pad = " " * (4 if envelope is None else 8)
+
+    def encode(record: dict) -> str:
+        if compact:
+            return json.dumps(record, separators=(",", ":"))
+        return textwrap.indent(json.dumps(record, indent=4), pad)
+
+    records = iter(records)
+    first = next(records, None)
+    if first is None:
+        yield empty
+        return
+
+    yield start + encode(first)
+    for record in records:
+        yield separator + encode(record)
+    yield end
+
+
+def encode_export(chunks: Iterable[str], gzip: bool = False) -> Iterator[bytes]:
+    """Encode text chunks as UTF-8, in blocks of EXPORT_BUFFER_SIZE bytes.
+
+    With gzip, each block is compressed and flushed, so the client can
+    decode it as soon as it arrives.
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if gzip else None
+    buffer, size = [], 0
+
+    def flush(final: bool = False) -> bytes:
+        data = b"".join(buffer)
+        buffer.clear()
+        if compressor:
+            mode = zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH
+            data = compressor.compress(data) + compressor.flush(mode)
+        return data
+
+    for chunk in chunks:
+        data = chunk.encode()
+        buffer.append(data)
+        size += len(data)
+        if size >= EXPORT_BUFFER_SIZE:
+            size = 0
+            if data := flush():
+                yield data
+    yield flush(final=True)
+
+
 def create_zip_file(files, output_file_path):
     with zipfile.ZipFile(output_file_path, mode="w") as zip_file:
         for file_path in files:
@@ -230,8 +426,23 @@ async def convert_to_osm(db: Session, project_id: int, task_id: int):
     return FileResponse(final_zip_file_path)
 
 
-def download_submission(db: Session, project_id: int, task_id: int, exportJson: bool):
-
+def download_submission(
+    db: Session,
+    project_id: int,
+    task_id: int,
+    exportJson: bool,
+    ndjson: bool = False,
+    compact: bool = False,
+    gzip: bool = False,
+):
+    """Download the submissions of a project, or of one task.
+
+    The media zips are merged, or the JSON is encoded, while they are sent.
+    The JSON export is an array of the OData records of all tasks, or for
+    one task an object with the records as its "value". ndjson gives one
+    record per line instead, compact leaves out the indentation and gzip
+    compresses the response.
+    """
     project_info = project_crud.get_project(db, project_id)
 
     # Return empty list if project is not found
@@ -250,93 +461,118 @@ def download_submission(db: Session, project_id: int, task_id: int, exportJson:
         odk_central_password=project_info.odk_central_password,
     )
 
-    # Get ODK Form with odk credentials from the project.
-    xform = get_odk_form(odk_credentials)
-
     if not exportJson:
-        file_path = f"{project_id}_submissions.zip"
-
         # If task id is not provided, submission for all the task are listed
         if task_id is None:
-            task_list = []
-
-            task_list = [x.id for x in project_tasks]
-
-            # zip_file_path = f"{project_name}_{form_category}_submissions.zip"  # Create a new ZIP file for all submissions
-            files = []
-
-            for id in task_list:
-
-                # XML Form Id is a combination or project_name, category and task_id
-                # FIXME: fix xml_form_id
-                xml_form_id = f"{project_name}_{form_category}_{id}".split("_")[
-                    2]
-                file = xform.getSubmissionMedia(odkid, xml_form_id)
-
-                # Create a new output file for each submission
-                file_path = f"{project_name}_{form_category}_submission_{id}.zip"
-                with open(file_path, "wb") as f:
-                    f.write(file.content)
-
-                files.append(
-                    file_path
-                )  # Add the output file path to the list of files for the final ZIP file
-
-            extracted_files = []
-            for file_path in files:
-                with zipfile.ZipFile(file_path, "r") as zip_file:
-                    zip_file.extractall(
-                        os.path.splitext(file_path)[0]
-                    )  # Extract the contents of the nested ZIP files to a directory with the same name as the ZIP file
-                    extracted_files += [
-                        os.path.join(os.path.splitext(file_path)[0], f)
-                        for f in zip_file.namelist()
-                    ]  # Add the extracted file paths to the list of extracted files
-
-            # Create a new ZIP file for the extracted files
-            final_zip_file_path = f"{project_name}_{form_category}_submissions_final.zip"
-            with zipfile.ZipFile(final_zip_file_path, mode="w") as final_zip_file:
-                for file_path in extracted_files:
-                    final_zip_file.write(file_path)
-
-            return FileResponse(final_zip_file_path)
+            # XML Form Id is a combination or project_name, category and task_id
+            # FIXME: fix xml_form_id
+            xform_ids = {
+                f"{project_name}_{form_category}_submission_{x.id}": (
+                    f"{project_name}_{form_category}_{x.id}".split("_")[2]
+                )
+                for x in project_tasks
+            }
+
+            # The task zips are merged into one as it is sent
+            archives = task_media_archives(odkid, xform_ids, odk_credentials)
+            filename = f"{project_name}_{form_category}_submissions_final.zip"
+            return StreamingResponse(
+                prime_stream(stream_zip(archives)),
+                media_type="application/zip",
+                headers={"Content-Disposition": f"attachment; filename={filename}"},
+            )
         else:
             xml_form_id = f"{project_name}_{form_category}_{task_id}".split("_")[
                 2]
-            file = xform.getSubmissionMedia(odkid, xml_form_id)
-            with open(file_path, "wb") as f:
-                f.write(file.content)
-            return FileResponse(file_path)
+            file = tempfile.TemporaryFile()
+            try:
+                download_submission_media(odkid, xml_form_id, file, odk_credentials)
+            except Exception:
+                file.close()
+                raise
+            return StreamingResponse(
+                iter_file(file),
+                media_type="application/zip",
+                headers={
+                    "Content-Disposition": (
+                        f"attachment; filename={project_id}_submissions.zip"
+                    )
+                },
+            )
     else:
         timestamp = datetime.now().strftime("%Y_%m_%d")
+        extension, media_type = ("json", "application/json")
+        if ndjson:
+            extension, media_type = ("ndjson", "application/x-ndjson")
         headers = {
-            "Content-Disposition": f"attachment; filename=Submission_data_{timestamp}.json",
-            "Content-Type": "application/json",
+            "Content-Disposition": (
+                f"attachment; filename=Submission_data_{timestamp}.{extension}"
+            )
         }
-
-        files = []
-
-        if task_id is None:
-            task_list = [x.id for x in project_tasks]
-            for id in task_list:
-                xml_form_id = f"{project_name}_{form_category}_{id}".split("_")[
-                    2]
-                file = xform.getSubmissions(
-                    odkid, xml_form_id, None, False, True)
-                json_data = json.loads(file)
-                json_data_value = json_data.get('value')
-                if json_data_value:
-                    files.extend(json_data_value)
+        if gzip:
+            headers["Content-Encoding"] = "gzip"
+
+        envelope = None if task_id is None else {}
+        if submission_sync.use_local_copy(db, project_id):
+            # Read the local copy, in the shape of the ODK Central responses
+            records = submission_sync.iter_submissions(project_id, task_id)
+        elif task_id is None:
+            records = iter_live_submissions(
+                odkid,
+                [
+                    f"{project_name}_{form_category}_{x.id}".split("_")[2]
+                    for x in project_tasks
+                ],
+                odk_credentials,
+            )
         else:
             xml_form_id = f"{project_name}_{form_category}_{task_id}".split("_")[
                 2]
-            file = xform.getSubmissions(odkid, xml_form_id, None, False, True)
-            json_data = json.loads(file)
+            pages = submission_sync.iter_submission_pages(
+                odkid, xml_form_id, odk_central=odk_credentials
+            )
+            # Keep the OData members of the response, such as @odata.context
+            first_page = next(pages)
+            envelope = {
+                key: value
+                for key, value in first_page.items()
+                if key not in ("value", "@odata.nextLink")
+            }
+            records = itertools.chain(
+                first_page.get("value", []),
+                (record for page in pages for record in page.get("value", [])),
+            )
+
+        # Records are encoded as they are read, the export is never held whole
+        chunks = json_export(records, ndjson=ndjson, compact=compact, envelope=envelope)
+        return StreamingResponse(
+            prime_stream(encode_export(chunks, gzip=gzip)),
+            media_type=media_type,
+            headers=headers,
+        )
 
-        response_content = json.dumps(
-            files if task_id is None else json_data, indent=4).encode()
 
-        return Response(content=response_content, headers=headers)
+def iter_live_submissions(
+    odkid: int, xform_ids: list, odk_credentials: project_schemas.ODKCentral
+) -> Iterator[dict]:
+    """Get the submissions to many forms from ODK Central, in form order.
+
+    A few forms are downloaded concurrently, and each one is yielded as soon
+    as it and the forms before it have arrived. A form that fails raises an
+    HTTPException, rather than being left out of the export.
+    """
+
+    def get_form_submissions(xform_id: str) -> list:
+        return submission_sync.fetch_submissions(odkid, xform_id, None, odk_credentials)
+
+    results = iter_fan_out(get_form_submissions, xform_ids)
+    for xform_id, submissions, error in results:
+        if error:
+            raise HTTPException(
+                status_code=502,
+                detail=f"Could not get the submissions to form {xform_id}: {error}",
+            ) from error
+        yield from submissions
 
 
 def get_submission_points(db: Session, project_id: int, task_id: int = None):
@@ -362,6 +598,11 @@ def get_submission_points(db: Session, project_id: int, task_id: int = None):
         odk_central_password=project_info.odk_central_password,
     )
 
+    # Read the local copy of the submissions, once the project has been synced.
+    # The points are in the same shape as those read from the CSV below.
+    if submission_sync.use_local_copy(db, project_id):
+        return submission_sync.get_submission_points(db, project_id, task_id)
+
     xform = get_odk_form(odk_credentials)
 
     if task_id:
@@ -16,12 +16,14 @@
 #     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
 #
 
-from fastapi import APIRouter, Depends
+import json
+
+from fastapi import APIRouter, Depends, Response
 from fastapi.logger import logger as logger
 from sqlalchemy.orm import Session
 
 from ..db import database
-from . import submission_crud
+from . import submission_crud, submission_sync
 
 router = APIRouter(
     prefix="/submission",
@@ -34,6 +36,7 @@ router = APIRouter(
 @router.get("/")
 async def read_submissions(
     project_id: int,
+    response: Response,
     task_id: int = None,
     db: Session = Depends(database.get_db),
 ):
@@ -45,9 +48,16 @@ async def read_submissions(
 
     task_id: The ID of the task. This parameter is optional. If task_id is provided, this endpoint returns the submissions made for this task.
 
-    Returns the list of submissions.
+    Returns the list of submissions. The tasks whose submissions could not
+    be listed are left out, and their errors are in the X-Failed-Tasks
+    header, as a JSON object by task id.
     """
-    return submission_crud.get_submission_of_project(db, project_id, task_id)
+    submissions, errors = submission_crud.get_submission_of_project(
+        db, project_id, task_id
+    )
+    if errors:
+        response.headers["X-Failed-Tasks"] = json.dumps(errors)
+    return submissions
 
 
 @router.get("/list-forms")
@@ -87,6 +97,9 @@ async def download_submission(
     project_id: int,
     task_id: int = None,
     exportJson: bool = True,
+    ndjson: bool = False,
+    compact: bool = False,
+    gzip: bool = False,
     db: Session = Depends(database.get_db),
 ):
     """This api downloads the the submission made in the project.
@@ -96,8 +109,35 @@ async def download_submission(
 
     task_id: The ID of the task. This parameter is optional. If task_id is provided, this endpoint returns the submissions made for this task.
 
+    ndjson: Export the JSON as one submission per line.
+
+    compact: Export the JSON without indentation.
+
+    gzip: Compress the response, with gzip Content-Encoding.
+
+    """
+    return submission_crud.download_submission(
+        db, project_id, task_id, exportJson, ndjson, compact, gzip
+    )
+
+
+@router.post("/sync")
+async def sync_submissions(
+    project_id: int,
+    db: Session = Depends(database.get_db),
+):
+    """Queue a sync of the local copy of the project's submissions.
+
+    Only the submissions made since the last sync are downloaded from ODK
+    Central. Once a project has been synced, the job workers sync it again
+    every SUBMISSION_SYNC_INTERVAL seconds. Submissions are read from the
+    local copy once every task form has been synced, and from ODK Central
+    until then.
+
+    Returns the id of the background task, or null if a sync is already queued.
     """
-    return submission_crud.download_submission(db, project_id, task_id, exportJson)
+    task_id = submission_sync.request_sync(db, project_id, force=True)
+    return {"Message": f"{project_id}", "task_id": task_id}
 
 
 @router.get("/submission-points")
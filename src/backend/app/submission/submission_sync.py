@@ -0,0 +1,426 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+"""Local copy of the ODK Central submissions of a project.
+
+Submissions are copied into the submissions table by sync_submissions,
+which runs as a background job. Each task form has a high-water mark, the
+latest __system/submissionDate or __system/updatedAt copied, and each sync
+only asks ODK Central for the submissions made or updated since then, using
+an OData $filter. Edited and reviewed submissions are so copied again.
+The read endpoints then query the local table instead of downloading every
+submission again.
+"""
+
+import json
+from datetime import datetime, timedelta
+from typing import Iterator, Optional
+
+from fastapi.logger import logger as logger
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import text
+
+from ..central import central_crud
+from ..config import settings
+from ..db import database, db_models
+from ..db.postgis_utils import timestamp
+from ..jobs import job_crud
+from ..projects import project_crud, project_schemas
+
+# Number of submissions requested at a time
+PAGE_SIZE = 1000
+
+GEOMETRY_TYPES = ("Point", "LineString", "Polygon")
+
+# Key of the advisory lock held while queueing the due syncs
+SYNC_SCHEDULE_LOCK = 7_100_023
+
+
+def task_form_ids(project: db_models.DbProject) -> dict:
+    """Get the XForm id of each task of a project, by task id."""
+    # XML Form Id is a combination or project_name, category and task_id
+    prefix = f"{project.project_name_prefix}_{project.xform_title}"
+    return {task.id: f"{prefix}_{task.id}".split("_")[2] for task in project.tasks}
+
+
+def odata_date(date: datetime) -> str:
+    """Format a UTC datetime as an OData literal."""
+    return f"{date.isoformat(timespec='milliseconds')}Z"
+
+
+def iter_submission_pages(
+    odk_id: int,
+    xform_id: str,
+    since: Optional[datetime] = None,
+    odk_central: project_schemas.ODKCentral = None,
+) -> Iterator[dict]:
+    """Get the OData responses for the submissions to a form, a page at a time.
+
+    With since, only the submissions made or updated since then. Those
+    at exactly since are included again, so none are missed if several
+    share the same date.
+    """
+    xform = central_crud.get_odk_form(odk_central)
+    url = f"{xform.base}projects/{odk_id}/forms/{xform_id}.svc/Submissions"
+    params = {"$top": PAGE_SIZE}
+    if since:
+        date = odata_date(since)
+        changed = f"__system/submissionDate ge {date} or __system/updatedAt ge {date}"
+        params["$filter"] = changed
+
+    while url:
+        response = xform.session.get(
+            url, params=params, auth=xform.auth, verify=xform.verify
+        )
+        response.raise_for_status()
+        data = response.json()
+        yield data
+
+        # The next page link already holds the query
+        url, params = data.get("@odata.nextLink"), None
+
+
+def fetch_submissions(
+    odk_id: int,
+    xform_id: str,
+    since: Optional[datetime],
+    odk_central: project_schemas.ODKCentral = None,
+) -> list:
+    """Get the OData records of the submissions to a form changed since a date."""
+    submissions = []
+    for page in iter_submission_pages(odk_id, xform_id, since, odk_central):
+        submissions.extend(page.get("value", []))
+    return submissions
+
+
+def submission_geometry(data) -> Optional[dict]:
+    """Find the first GeoJSON geometry in a submission, if any."""
+    if isinstance(data, dict):
+        if data.get("type") in GEOMETRY_TYPES and "coordinates" in data:
+            return data
+        values = data.values()
+    elif isinstance(data, list):
+        values = data
+    else:
+        return None
+
+    for value in values:
+        if geometry := submission_geometry(value):
+            return geometry
+    return None
+
+
+def parse_date(date: str) -> datetime:
+    """Parse an ODK Central date as a naive UTC datetime."""
+    return datetime.fromisoformat(date.replace("Z", "+00:00")).replace(tzinfo=None)
+
+
+def last_change(submission: dict) -> datetime:
+    """Get the date a submission was made or, if later, last updated."""
+    system = submission["__system"]
+    return parse_date(system.get("updatedAt") or system["submissionDate"])
+
+
+def save_submissions(
+    db: Session, project_id: int, task_id: int, xform_id: str, submissions: list
+):
+    """Insert or update the local copies of submissions to a task form."""
+    rows = []
+    for submission in submissions:
+        geometry = submission_geometry(submission)
+        rows.append(
+            {
+                "project_id": project_id,
+                "instance_id": submission["__id"],
+                "task_id": task_id,
+                "xform_id": xform_id,
+                "submitted": parse_date(submission["__system"]["submissionDate"]),
+                "data": json.dumps(submission),
+                "geometry": json.dumps(geometry) if geometry else None,
+            }
+        )
+    if not rows:
+        return
+
+    db.execute(
+        text(
+            """INSERT INTO submissions
+                (project_id, instance_id, task_id, xform_id, submitted, data, geometry)
+            VALUES (
+                :project_id, :instance_id, :task_id, :xform_id, :submitted,
+                CAST(:data AS JSONB),
+                ST_SetSRID(ST_Force2D(ST_GeomFromGeoJSON(:geometry)), 4326)
+            )
+            ON CONFLICT (project_id, instance_id) DO UPDATE
+            SET task_id = EXCLUDED.task_id,
+                xform_id = EXCLUDED.xform_id,
+                submitted = EXCLUDED.submitted,
+                data = EXCLUDED.data,
+                geometry = EXCLUDED.geometry"""
+        ),
+        rows,
+    )
+
+
+def sync_submissions(db: Session, project_id: int) -> dict:
+    """Copy the submissions made since the last sync of a project.
+
+    The task forms are requested concurrently. A form that fails keeps its
+    high-water mark, so its submissions are requested again next time.
+    Returns the number of new or updated submissions by task id.
+    """
+    project = project_crud.get_project(db, project_id)
+    odk_central = project_schemas.ODKCentral(
+        odk_central_url=project.odk_central_url,
+        odk_central_user=project.odk_central_user,
+        odk_central_password=project.odk_central_password,
+    )
+    form_ids = task_form_ids(project)
+    marks = {
+        row.xform_id: row
+        for row in db.query(db_models.DbSubmissionSync).filter(
+            db_models.DbSubmissionSync.project_id == project_id
+        )
+    }
+
+    def fetch(task_id: int):
+        mark = marks.get(form_ids[task_id])
+        since = mark.last_submission if mark else None
+        return fetch_submissions(project.odkid, form_ids[task_id], since, odk_central)
+
+    results, errors = central_crud.fan_out(fetch, form_ids)
+
+    counts = {}
+    for task_id, submissions in results.items():
+        xform_id = form_ids[task_id]
+        save_submissions(db, project_id, task_id, xform_id, submissions)
+
+        mark = marks.get(xform_id)
+        if not mark:
+            mark = db_models.DbSubmissionSync(project_id=project_id, xform_id=xform_id)
+            db.add(mark)
+        dates = [last_change(submission) for submission in submissions]
+        if dates:
+            mark.last_submission = max(dates + [mark.last_submission or dates[0]])
+        mark.synced = timestamp()
+        counts[task_id] = len(submissions)
+
+    db.commit()
+    logger.info(
+        f"Synced {sum(counts.values())} submissions of project {project_id}, "
+        f"{len(errors)} task forms failed"
+    )
+    return counts
+
+
+def is_synced(db: Session, project_id: int) -> bool:
+    """Whether every task form of a project has been copied at least once.
+
+    Until then the local copy would silently miss the submissions of the
+    forms that have never been synced.
+    """
+    project = project_crud.get_project(db, project_id)
+    form_ids = set(task_form_ids(project).values()) if project else set()
+    synced = {
+        row.xform_id
+        for row in db.query(db_models.DbSubmissionSync.xform_id).filter(
+            db_models.DbSubmissionSync.project_id == project_id
+        )
+    }
+    return bool(form_ids) and form_ids <= synced
+
+
+def request_sync(
+    db: Session, project_id: int, force: bool = False, commit: bool = True
+) -> Optional[str]:
+    """Queue a sync of a project's submissions, if it is due.
+
+    A sync is due if the project was last synced more than
+    SUBMISSION_SYNC_INTERVAL seconds ago, or never, and no sync of the
+    project is already queued or running.
+    Returns the id of the queued job, if any.
+    """
+    query = text(
+        """SELECT
+            EXISTS (
+                SELECT 1 FROM background_tasks
+                WHERE name = :name
+                AND status IN ('PENDING', 'RECEIVED')
+                AND (params->>'project_id')::int = :project_id
+            ) AS queued,
+            (
+                SELECT min(synced) FROM submission_sync
+                WHERE project_id = :project_id
+            ) AS synced"""
+    )
+    state = db.execute(
+        query, {"name": job_crud.SYNC_SUBMISSIONS, "project_id": project_id}
+    ).first()
+
+    if state.queued:
+        return None
+    interval = timedelta(seconds=settings.SUBMISSION_SYNC_INTERVAL)
+    if not force and state.synced and timestamp() - state.synced < interval:
+        return None
+
+    return job_crud.enqueue_job(
+        db, job_crud.SYNC_SUBMISSIONS, {"project_id": project_id}, commit=commit
+    )
+
+
+def queue_due_syncs(db: Session) -> int:
+    """Queue the due syncs of the projects that have a local copy.
+
+    Run periodically by the job workers, so the local copies are kept up
+    to date without reads queueing jobs. An advisory lock keeps workers
+    from queueing the same syncs at once.
+    Returns the number of syncs queued.
+    """
+    locked = db.execute(
+        text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": SYNC_SCHEDULE_LOCK}
+    ).scalar()
+    if not locked:
+        db.rollback()
+        return 0
+
+    project_ids = [
+        row.project_id
+        for row in db.query(db_models.DbSubmissionSync.project_id).distinct()
+    ]
+    # Queued in one transaction, which holds the lock until it commits
+    queued = [
+        project_id
+        for project_id in project_ids
+        if request_sync(db, project_id, commit=False)
+    ]
+    db.commit()
+    return len(queued)
+
+
+def use_local_copy(db: Session, project_id: int) -> bool:
+    """Whether to read a project's submissions from the local copy.
+
+    This does not refresh the copy: syncs are queued by POST
+    /submission/sync, and then every SUBMISSION_SYNC_INTERVAL seconds by
+    the job workers, see queue_due_syncs.
+    """
+    return is_synced(db, project_id)
+
+
+def submissions_query(db: Session, project_id: int, task_id: int = None):
+    """Query the local copies of the submissions of a project, or of one task.
+
+    The OData records are in task and submission order.
+    """
+    query = db.query(db_models.DbSubmission.data).filter(
+        db_models.DbSubmission.project_id == project_id
+    )
+    if task_id is not None:
+        query = query.filter(db_models.DbSubmission.task_id == task_id)
+    return query.order_by(
+        db_models.DbSubmission.task_id, db_models.DbSubmission.submitted
+    )
+
+
+def get_submissions(db: Session, project_id: int, task_id: int = None) -> list:
+    """Get the local copies of the submissions of a project, or of one task."""
+    return [row.data for row in submissions_query(db, project_id, task_id)]
+
+
+def get_form_submissions(
+    db: Session, project_id: int, xform_id: str = None, instance_id: str = None
+) -> dict:
+    """Get the local copies of the submissions of a project, by XForm id.
+
+    Only the submissions to xform_id, or the submission instance_id, if given.
+    """
+    query = db.query(
+        db_models.DbSubmission.xform_id, db_models.DbSubmission.data
+    ).filter(db_models.DbSubmission.project_id == project_id)
+    if xform_id:
+        query = query.filter(db_models.DbSubmission.xform_id == xform_id)
+    if instance_id:
+        query = query.filter(db_models.DbSubmission.instance_id == instance_id)
+    query = query.order_by(
+        db_models.DbSubmission.task_id, db_models.DbSubmission.submitted
+    )
+
+    forms = {}
+    for row in query:
+        forms.setdefault(row.xform_id, []).append(row.data)
+    return forms
+
+
+def iter_submissions(project_id: int, task_id: int = None) -> Iterator[dict]:
+    """Read the local copies of the submissions PAGE_SIZE rows at a time.
+
+    A session of its own is used, as this is consumed while the response
+    is sent, after the request's session has been closed.
+    """
+    db = database.SessionLocal()
+    try:
+        query = submissions_query(db, project_id, task_id)
+        # Uses a server side cursor, so only one batch is held in memory
+        for row in query.yield_per(PAGE_SIZE):
+            yield row.data
+    finally:
+        db.close()
+
+
+def submission_metadata(data: dict) -> dict:
+    """Get the submission metadata of ODK Central's REST API from an OData record."""
+    system = data.get("__system", {})
+    return {
+        "instanceId": data["__id"],
+        "submitterId": system.get("submitterId"),
+        "deviceId": system.get("deviceId"),
+        "createdAt": system.get("submissionDate"),
+        "updatedAt": system.get("updatedAt"),
+        "reviewState": system.get("reviewState"),
+    }
+
+
+def submission_point(data: dict) -> Optional[dict]:
+    """Get the warmup location of a submission, if any, as a GeoJSON Feature.
+
+    In the shape read from the ODK Central CSV export by
+    submission_crud.get_submission_points: the coordinates are the
+    latitude and longitude, in that order, as strings.
+    """
+    warmup = data.get("warmup")
+    if not isinstance(warmup, dict) or len(warmup.get("coordinates") or []) < 2:
+        return None
+    longitude, latitude = warmup["coordinates"][:2]
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": (str(latitude), str(longitude))},
+    }
+
+
+def get_submission_points(
+    db: Session, project_id: int, task_id: int = None
+) -> Optional[list]:
+    """Get the location of each submission to a task, as GeoJSON Features.
+
+    The same response as the live path of submission_crud.get_submission_points,
+    so it does not change once a project is synced: None without a task_id.
+    """
+    if not task_id:
+        return None
+    submissions = get_submissions(db, project_id, task_id)
+    return [point for point in map(submission_point, submissions) if point]
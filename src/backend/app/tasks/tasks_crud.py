@@ -19,6 +19,8 @@
 import base64
 from typing import List
 
+import numpy as np
+import shapely
 from fastapi import HTTPException
 from fastapi.logger import logger as logger
 from sqlalchemy import column, select, table
@@ -52,6 +54,75 @@ async def get_task_lists(db: Session, project_id: int):
     return tasks
 
 
+def bulk_create_tasks(
+    db: Session, project_id: int, outlines: List, task_names: List[str] = None
+):
+    """Insert many tasks for a project in one statement.
+
+    Task ids are drawn from the tasks sequence up front, so tasks without an
+    explicit name are named after their id in the same round trip.
+    The project total_tasks count is updated in the same statement.
+    Returns the ids of the new tasks, in the order of the outlines.
+    """
+    if not outlines:
+        return []
+    if task_names is None:
+        task_names = [None] * len(outlines)
+
+    query = text(
+        """
+        WITH new_tasks AS (
+            SELECT nextval(pg_get_serial_sequence('tasks', 'id')) AS id, *
+            FROM (
+                SELECT *
+                FROM unnest(CAST(:outlines AS text[]), CAST(:task_names AS text[]))
+                    WITH ORDINALITY AS t(outline, task_name, ordinal)
+                ORDER BY ordinal
+            ) AS ordered
+        ),
+        inserted AS (
+            INSERT INTO tasks (
+                id,
+                project_id,
+                project_task_index,
+                project_task_name,
+                outline,
+                task_status
+            )
+            SELECT
+                id,
+                :project_id,
+                1,
+                COALESCE(task_name, id::text),
+                ST_SetSRID(CAST(outline AS geometry), 4326),
+                'READY'
+            FROM new_tasks
+            RETURNING id
+        ),
+        project AS (
+            UPDATE projects
+            SET total_tasks = (
+                SELECT count(*) FROM tasks WHERE project_id = :project_id
+            ) + (SELECT count(*) FROM inserted)
+            WHERE id = :project_id
+        )
+        SELECT id FROM inserted ORDER BY id
+        """
+    )
+    result = db.execute(
+        query,
+        {
+            "project_id": project_id,
+            "outlines": list(shapely.to_wkb(np.array(outlines), hex=True)),
+            "task_names": task_names,
+        },
+    )
+    task_ids = [row.id for row in result.fetchall()]
+    db.commit()
+
+    return task_ids
+
+
 def get_tasks(
     db: Session, project_id: int, user_id: int, skip: int = 0, limit: int = 1000
 ):
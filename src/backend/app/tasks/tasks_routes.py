@@ -20,6 +20,7 @@ from typing import List
 
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import text
 
 from ..db import database
 from ..models.enums import TaskStatus
@@ -131,21 +132,30 @@ async def task_features_count(
         odk_central_password = project.odk_central_password,
         )
 
-    data = []
-    for task in task_list:
-        
-        feature_count_query = f"""
-            select count(*) from features where project_id = {project_id} and task_id = {task}
-        """
-        result = db.execute(feature_count_query)
-        feature_count = result.fetchone()
+    feature_count_query = text(
+        """SELECT task_id, count(*)
+        FROM features
+        WHERE project_id = :project_id
+        GROUP BY task_id"""
+    )
+    feature_counts = dict(
+        db.execute(feature_count_query, {"project_id": project_id}).fetchall()
+    )
 
-        submission_list = central_crud.list_task_submissions(project.odkid, task, odk_credentials)
+    # The submissions of all the tasks are listed concurrently
+    submissions, errors = central_crud.list_tasks_submissions(
+        project.odkid, {task: task for task in task_list}, odk_credentials
+    )
 
-        data.append({
+    data = []
+    for task in task_list:
+        task_data = {
             'task_id': task,
-            'feature_count': feature_count['count'],
-            'submission_count': len(submission_list) if isinstance(submission_list, list) else 0
-        })
+            'feature_count': feature_counts.get(task, 0),
+            'submission_count': len(submissions.get(task, [])),
+        }
+        if task in errors:
+            task_data['error'] = errors[task]
+        data.append(task_data)
 
     return data
\ No newline at end of file
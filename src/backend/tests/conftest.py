@@ -16,6 +16,12 @@
 #     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
 #
 
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
 import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
@@ -71,3 +77,81 @@ def client(db):
 
     with TestClient(api) as c:
         yield c
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answer requests from the server's route table, see stub_server."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):  # noqa: N802
+        self.route("GET")
+
+    def do_POST(self):  # noqa: N802
+        self.route("POST")
+
+    def route(self, method: str):
+        server = self.server
+        url = urlparse(self.path)
+        self.query = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        self.json = json.loads(body) if body else None
+        with server.lock:
+            server.clients.add(self.client_address)
+            server.requests.append((method, url.path, self.query))
+
+        handler = None
+        for (route_method, pattern), route in server.routes.items():
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                handler, self.match = route, match
+                break
+        if handler is None:
+            self.send_error(404)
+            return
+
+        response = handler(self)
+        if isinstance(response, int):
+            self.send_error(response)
+            return
+        content_type = "application/octet-stream"
+        if not isinstance(response, bytes):
+            response = json.dumps(response).encode()
+            content_type = "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+@pytest.fixture
+def stub_server():
+    """Start local HTTP servers answering from a route table.
+
+    Routes map (method, path regex) to a function of the request handler,
+    which has the match, query and json of the request. It returns JSON
+    data, bytes, or the status code of an error. Each server records its
+    client addresses and its (method, path, query) requests.
+    """
+    servers = []
+
+    def start(routes: dict) -> ThreadingHTTPServer:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        server.routes = routes
+        server.lock = threading.Lock()
+        server.clients = set()
+        server.requests = []
+        server.url = f"http://127.0.0.1:{server.server_port}"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,194 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+import threading
+import time
+
+import pytest
+
+from app.central import central_crud, odk_clients
+
+
+def authorized(request) -> bool:
+    return request.headers.get("Authorization") == f"Bearer {request.server.token}"
+
+
+def login(request):
+    with request.server.lock:
+        request.server.logins += 1
+        request.server.token = f"session-token-{request.server.logins}"
+        return {"token": request.server.token, "expiresAt": "2999-01-01T00:00:00Z"}
+
+
+def create_app_user(request):
+    if not authorized(request):
+        return 401
+    name = request.json["displayName"]
+    if name.endswith("_fail"):
+        return 500
+    with request.server.lock:
+        request.server.next_id += 1
+        actor_id = request.server.next_id
+    return {"id": actor_id, "token": f"token-{name}"}
+
+
+def assign_role(request):
+    if not authorized(request):
+        return 401
+    with request.server.lock:
+        request.server.assigned.append((request.match[1], int(request.match[2])))
+    return {"success": True}
+
+
+# Minimal ODK Central: sessions, app-user creation and form assignments
+ROUTES = {
+    ("POST", "/v1/sessions"): login,
+    ("POST", r".*/app-users"): create_app_user,
+    ("POST", r".*/forms/(\w+)/assignments/2/(\d+)"): assign_role,
+}
+
+
+@pytest.fixture
+def odk_credentials(stub_server):
+    server = stub_server(ROUTES)
+    server.assigned = []
+    server.next_id = 0
+    server.logins = 0
+    server.token = None
+    yield {
+        "odk_central_url": server.url,
+        "odk_central_user": "admin",
+        "odk_central_password": "secret",
+        "server": server,
+    }
+    odk_clients.clear()
+
+
+def test_create_appusers(odk_credentials):
+    server = odk_credentials["server"]
+    names = {task_id: f"project_buildings_{task_id}" for task_id in range(1, 41)}
+    names[41] = "project_buildings_fail"
+
+    appusers = central_crud.create_appusers(1, names, odk_credentials, max_workers=4)
+
+    assert set(appusers) == set(range(1, 41))
+    assert appusers[7]["token"] == "token-project_buildings_7"
+    assert len({appuser["id"] for appuser in appusers.values()}) == 40
+    # Connections are kept alive and reused: one per worker, and one more
+    # as the error response closes its connection
+    assert len(server.clients) <= 5
+
+
+def test_assign_appuser_roles(odk_credentials):
+    server = odk_credentials["server"]
+    actors = {task_id: (str(task_id), task_id + 100) for task_id in range(1, 11)}
+
+    assigned = central_crud.assign_appuser_roles(
+        1, actors, odk_credentials, max_workers=4
+    )
+
+    assert assigned == set(range(1, 11))
+    assert sorted(server.assigned) == sorted(actors.values())
+
+
+def test_clients_share_sessions(odk_credentials):
+    server = odk_credentials["server"]
+    login = central_crud.odk_login(odk_credentials)
+
+    central_crud.create_appuser(1, "first", odk_credentials)
+    central_crud.create_appuser(1, "second", odk_credentials)
+    form = odk_clients.get_client(central_crud.OdkForm, *login)
+
+    # One login and one connection for all the clients of the server
+    assert server.logins == 1
+    assert len(server.clients) == 1
+    assert form.session is odk_clients.get_session(*login)[0]
+
+    # A changed password replaces the session
+    url, user, _ = login
+    assert odk_clients.get_session(url, user, "new")[0] is not form.session
+
+
+def test_expired_token_is_renewed(odk_credentials):
+    server = odk_credentials["server"]
+    assert central_crud.create_appuser(1, "first", odk_credentials).ok
+
+    # The server ends the session before the token's expiry date
+    server.token = "expired"
+    response = central_crud.create_appuser(1, "second", odk_credentials)
+
+    # The refused request is retried once, with a new token
+    assert response.ok
+    assert response.json()["token"] == "token-second"
+    assert [r.status_code for r in response.history] == [401]
+    assert server.logins == 2
+
+
+def test_sessions_are_evicted(monkeypatch):
+    monkeypatch.setattr(odk_clients, "MAX_SESSIONS", 2)
+    first = odk_clients.get_session("http://first", "user", "pw")
+    odk_clients.get_session("http://second", "user", "pw")
+    # Using first makes second the least recently used
+    assert odk_clients.get_session("http://first", "user", "pw") is first
+    odk_clients.get_session("http://third", "user", "pw")
+
+    servers = {("http://first", "user"), ("http://third", "user")}
+    assert set(odk_clients._sessions) == servers
+    odk_clients.clear()
+
+
+def test_fan_out():
+    running, peak = 0, 0
+    lock = threading.Lock()
+
+    def call(task_id):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.01 * (task_id % 3))
+        with lock:
+            running -= 1
+        if task_id == 5:
+            raise ValueError("form not found")
+        return task_id * 10
+
+    results, errors = central_crud.fan_out(call, range(1, 21), max_workers=4)
+
+    # Merged in task order, whatever order the calls finished in
+    assert list(results) == [task_id for task_id in range(1, 21) if task_id != 5]
+    assert results[3] == 30
+    assert errors == {5: "form not found"}
+    assert peak <= 4
+
+
+def test_iter_fan_out_window():
+    started = []
+
+    def call(task_id):
+        started.append(task_id)
+        time.sleep(0.01 * (task_id % 3))
+        return task_id
+
+    results = central_crud.iter_fan_out(call, range(1, 11), max_workers=3)
+    assert next(results) == (1, 1, None)
+
+    # Only the calls within the window have been started
+    time.sleep(0.1)
+    assert sorted(started) == [1, 2, 3, 4]
+    assert [task_id for task_id, _, _ in results] == list(range(2, 11))
@@ -0,0 +1,78 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+import os
+import time
+
+import pytest
+
+from app.config import settings
+from app.projects import extract_cache
+
+SQUARE = {
+    "type": "Polygon",
+    "coordinates": [[[0, 0], [0, 1], [1, 1], [1, 0], [0, 0]]],
+}
+EXTRACT = {"type": "FeatureCollection", "features": []}
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "EXTRACT_CACHE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_cache_key_is_normalised():
+    # Same square, opposite orientation, different start vertex
+    reversed_square = {
+        "type": "Polygon",
+        "coordinates": [[[1, 1], [1, 0], [0, 0], [0, 1.00000001], [1, 1]]],
+    }
+
+    key = extract_cache.cache_key(SQUARE, category="buildings")
+    assert extract_cache.cache_key(reversed_square, category="buildings") == key
+    assert extract_cache.cache_key(SQUARE, category="amenities") != key
+
+
+def test_cache_hit_and_ttl(monkeypatch):
+    key = extract_cache.cache_key(SQUARE)
+    assert extract_cache.get_cached_extract(key) is None
+
+    extract_cache.cache_extract(key, EXTRACT)
+    assert extract_cache.get_cached_extract(key) == EXTRACT
+
+    monkeypatch.setattr(settings, "EXTRACT_CACHE_TTL", -1)
+    assert extract_cache.get_cached_extract(key) is None
+
+
+def test_cache_size_eviction(cache_dir, monkeypatch):
+    monkeypatch.setattr(settings, "EXTRACT_CACHE_MAX_SIZE", 100)
+    keys = [extract_cache.cache_key(SQUARE, category=str(i)) for i in range(3)]
+
+    extract_cache.cache_extract(keys[0], EXTRACT)
+    extract_cache.cache_extract(keys[1], EXTRACT)
+    # Use the first entry, so the second one is least recently used
+    past = time.time() - 60
+    os.utime(cache_dir / f"{keys[1]}.geojson", (past, past))
+    extract_cache.get_cached_extract(keys[0])
+
+    extract_cache.cache_extract(keys[2], EXTRACT)
+
+    assert extract_cache.get_cached_extract(keys[1]) is None
+    assert extract_cache.get_cached_extract(keys[0]) == EXTRACT
+    assert extract_cache.get_cached_extract(keys[2]) == EXTRACT
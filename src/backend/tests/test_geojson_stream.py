@@ -0,0 +1,95 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+import io
+import json
+import os
+import zipfile
+
+import pytest
+import shapely
+
+from app.db import postgis_utils
+from app.projects import project_crud
+from app.test_data import test_data_path
+
+FEATURE = {
+    "type": "Feature",
+    "geometry": {"type": "Point", "coordinates": [36.4, -0.7]},
+    "properties": {"building": "yes", "levels": 2.5, "features": []},
+}
+
+
+def test_feature_collection_is_streamed():
+    with zipfile.ZipFile(os.path.join(test_data_path, "Naivasha.zip")) as zip:
+        content = zip.read("Naivasha.geojson")
+
+    features = list(postgis_utils.iter_geojson_features(io.BytesIO(content)))
+
+    assert features == json.loads(content)["features"]
+
+
+def test_single_feature():
+    content = json.dumps(FEATURE).encode()
+
+    assert postgis_utils.read_geojson(io.BytesIO(content)) == {
+        "type": "FeatureCollection",
+        "features": [FEATURE],
+    }
+
+
+def test_features_are_yielded_before_the_end_of_file():
+    content = json.dumps({"type": "FeatureCollection", "features": [FEATURE] * 3})
+    # Truncated file: the features before the error are still yielded
+    features = postgis_utils.iter_geojson_features(io.BytesIO(content[:-30].encode()))
+
+    assert next(features) == FEATURE
+    with pytest.raises(ValueError):
+        list(features)
+
+
+def test_invalid_geojson_type():
+    content = json.dumps({"type": "Topology", "objects": {}}).encode()
+
+    with pytest.raises(ValueError, match="Invalid GeoJSON type: Topology"):
+        postgis_utils.read_geojson(io.BytesIO(content))
+
+
+def test_geojson_file_is_removed(tmp_path):
+    path = tmp_path / "features.geojson"
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": [FEATURE]}))
+
+    assert list(postgis_utils.iter_geojson_file(str(path), remove=True)) == [FEATURE]
+    assert not path.exists()
+
+
+def test_feature_rows_drop_z_and_count_rejected():
+    point_z = {**FEATURE, "geometry": {"type": "Point", "coordinates": [1, 2, 3]}}
+    features = [point_z] + [{"type": "Feature", "geometry": None}] * 25
+    rejected = project_crud.RejectedFeatures(limit=3)
+
+    rows = list(project_crud.feature_rows(features, rejected))
+    assert len(rows) == 1
+    geometry = shapely.from_wkb(bytes.fromhex(rows[0][0]))
+    assert not shapely.has_z(geometry)
+    assert json.loads(rows[0][1]) == FEATURE["properties"]
+
+    assert rejected.count == 25
+    assert rejected.reasons == [
+        f"feature {index}: ValueError('missing geometry')" for index in (1, 2, 3)
+    ]
@@ -0,0 +1,79 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.central import central_crud
+from app.jobs.job_logging import job_log
+
+logger = logging.getLogger("test_job_logging")
+logger.setLevel(logging.DEBUG)
+
+
+def run_job(path: str, name: str, barrier: threading.Barrier):
+    with job_log(path, logger=logger):
+        # Both jobs log while the other's handler is attached
+        barrier.wait()
+        logger.info(f"{name} started")
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            for i in range(2):
+                executor.submit(
+                    contextvars.copy_context().run, logger.info, f"{name} task {i}"
+                )
+        barrier.wait()
+
+
+def test_job_logs_are_separate(tmp_path):
+    handlers = list(logger.handlers)
+    barrier = threading.Barrier(2)
+    paths = {name: str(tmp_path / f"{name}.log") for name in ("a", "b")}
+
+    threads = [
+        threading.Thread(target=run_job, args=(path, name, barrier))
+        for name, path in paths.items()
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for name, path in paths.items():
+        with open(path) as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 3
+        assert all(f" - {name} " in line for line in lines)
+
+    # Records from outside any job are not written, and no handler is left
+    logger.info("after")
+    assert logger.handlers == handlers
+    with open(paths["a"]) as f:
+        assert "after" not in f.read()
+
+
+def test_fan_out_logs_to_the_job_log(tmp_path):
+    path = str(tmp_path / "job.log")
+
+    with job_log(path, logger=logger):
+        central_crud.fan_out(lambda task_id: logger.info(f"task {task_id}"), [1, 2])
+
+    with open(path) as f:
+        assert f.read().count(" - task ") == 2
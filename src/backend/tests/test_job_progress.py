@@ -0,0 +1,90 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+from app.jobs import job_crud, progress
+
+
+def test_summarize():
+    stored = {
+        "stage": "tasks",
+        "started": 0.0,
+        "stages": {
+            "extract": {
+                "total": 1,
+                "done": 1,
+                "initial": 0,
+                "started": 0.0,
+                "finished": 30.0,
+            },
+            "tasks": {
+                "total": 100,
+                "done": 40,
+                "initial": 10,
+                "started": 30.0,
+                "finished": None,
+            },
+        },
+    }
+
+    summary = progress.summarize(stored, now=90.0)
+
+    assert summary["elapsed"] == 90.0
+    tasks = summary["stages"]["tasks"]
+    # 30 tasks done in this run in 60 seconds, 60 left
+    assert tasks["percent"] == 40.0
+    assert tasks["per_minute"] == 30.0
+    assert tasks["eta"] == 120.0
+    assert summary["eta"] == 120.0
+    assert summary["stages"]["extract"]["eta"] == 0
+
+    assert progress.summarize(None) is None
+
+
+def test_progress_flushes_in_batches(monkeypatch):
+    saved = []
+    monkeypatch.setattr(
+        job_crud, "save_progress", lambda db, job_id, data: saved.append(data)
+    )
+
+    class Session:
+        def close(self):
+            pass
+
+    job = progress.JobProgress("job", flush_interval=3600, session_factory=Session)
+    job.start_stage("tasks", 100)
+    for _ in range(99):
+        job.advance("tasks")
+    # Only the start of the stage is stored before flush_interval
+    assert len(saved) == 1
+
+    job.finish_stage("tasks")
+    assert len(saved) == 2
+    assert saved[-1]["stages"]["tasks"]["done"] == 99
+    assert job.done("tasks") == 99
+
+
+def test_tail(tmp_path):
+    path = tmp_path / "generate.log"
+    path.write_text("".join(f"line {i}\n" for i in range(10000)))
+
+    last_lines = progress.tail(str(path), 3, block_size=16)
+    assert last_lines == "line 9997\nline 9998\nline 9999\n"
+    assert progress.tail(str(path), 20000).count("\n") == 10000
+
+    path.write_text("")
+    assert progress.tail(str(path), 3) == ""
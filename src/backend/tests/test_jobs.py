@@ -0,0 +1,70 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+from sqlalchemy.sql import text
+
+from app.db import db_models
+from app.jobs import job_crud
+from app.models.enums import BackgroundTaskStatus
+
+
+def get_job(db, job_id):
+    db.expire_all()
+    return db.query(db_models.BackgroundTasks).get(job_id)
+
+
+def test_claim_jobs_in_order(db):
+    first = job_crud.enqueue_job(db, job_crud.ADD_FEATURES, {"project_id": 1})
+    second = job_crud.enqueue_job(db, job_crud.ADD_FEATURES, {"project_id": 2})
+    names = [job_crud.ADD_FEATURES]
+
+    job = job_crud.claim_job(db, "worker-1", names)
+    assert job["id"] == first
+    assert job["params"] == {"project_id": 1}
+    assert job["attempts"] == 1
+    assert get_job(db, first).status == BackgroundTaskStatus.RECEIVED
+
+    assert job_crud.claim_job(db, "worker-1", names)["id"] == second
+    assert job_crud.claim_job(db, "worker-1", names) is None
+
+    job_crud.finish_job(db, first, BackgroundTaskStatus.SUCCESS)
+    assert get_job(db, first).status == BackgroundTaskStatus.SUCCESS
+
+    # The status set by the handler is kept
+    job_crud.finish_job(db, first, BackgroundTaskStatus.FAILED, "error")
+    assert get_job(db, first).status == BackgroundTaskStatus.SUCCESS
+
+
+def test_requeue_stale_jobs(db):
+    job_id = job_crud.enqueue_job(db, job_crud.ADD_FEATURES, {})
+    names = [job_crud.ADD_FEATURES]
+    stop_worker = text(
+        "UPDATE background_tasks SET heartbeat = now() - interval '1 hour' "
+        "WHERE id = :job_id"
+    )
+
+    job_crud.claim_job(db, "worker-1", names)
+    db.execute(stop_worker, {"job_id": job_id})
+    assert job_crud.requeue_stale_jobs(db, timeout=60, max_attempts=2) == 1
+    assert get_job(db, job_id).status == BackgroundTaskStatus.PENDING
+
+    # Failed once it has been tried max_attempts times
+    assert job_crud.claim_job(db, "worker-2", names)["attempts"] == 2
+    db.execute(stop_worker, {"job_id": job_id})
+    assert job_crud.requeue_stale_jobs(db, timeout=60, max_attempts=2) == 0
+    assert get_job(db, job_id).status == BackgroundTaskStatus.FAILED
@@ -0,0 +1,74 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+import gzip
+import json
+import zlib
+
+import pytest
+
+from app.submission import submission_crud
+
+RECORDS = [
+    {"__id": "uuid:1", "name": "Café", "geometry": {"coordinates": [1, 2]}},
+    {"__id": "uuid:2", "tags": [], "notes": "line\nbreak"},
+    {"__id": "uuid:3", "empty": {}},
+]
+
+
+def export(records, **options) -> str:
+    return "".join(submission_crud.json_export(records, **options))
+
+
+CONTEXT = "https://odk.example.org/v1/projects/1/forms/1.svc/$metadata#Submissions"
+
+
+@pytest.mark.parametrize("envelope", [None, {}, {"@odata.context": CONTEXT}])
+@pytest.mark.parametrize("records", [RECORDS, RECORDS[:1], []])
+def test_json_export(records, envelope):
+    # Encoded a record at a time, but the same as encoding them at once
+    data = records if envelope is None else {**envelope, "value": records}
+    assert export(iter(records), envelope=envelope) == json.dumps(data, indent=4)
+    assert export(iter(records), compact=True, envelope=envelope) == json.dumps(
+        data, separators=(",", ":")
+    )
+
+
+def test_ndjson_export():
+    lines = export(RECORDS, ndjson=True, envelope={}).splitlines()
+    assert [json.loads(line) for line in lines] == RECORDS
+
+
+def test_encode_export(monkeypatch):
+    monkeypatch.setattr(submission_crud, "EXPORT_BUFFER_SIZE", 1024)
+    records = [{"__id": f"uuid:{i}", "value": i} for i in range(1000)]
+    text = export(records)
+
+    blocks = list(submission_crud.encode_export(submission_crud.json_export(records)))
+    assert len(blocks) > 10
+    assert max(len(block) for block in blocks) < 2048
+    assert b"".join(blocks) == text.encode()
+
+    chunks = submission_crud.json_export(records)
+    blocks = list(submission_crud.encode_export(chunks, gzip=True))
+    assert len(blocks) > 1
+    assert gzip.decompress(b"".join(blocks)) == text.encode()
+
+    # Each block can be decoded as it arrives
+    decoder = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    assert decoder.decompress(blocks[0])
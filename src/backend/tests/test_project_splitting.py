@@ -0,0 +1,119 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import zipfile
+
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import Polygon, shape
+
+from app.models.enums import GridType
+from app.projects import project_splitting
+from app.test_data import test_data_path
+
+
+@pytest.fixture
+def boundary():
+    with zipfile.ZipFile(os.path.join(test_data_path, "Naivasha.zip")) as zip:
+        data = json.loads(zip.read("Naivasha.geojson"))
+    return shape(data["features"][0]["geometry"])
+
+
+def looped_grid(boundary, dimension):
+    """Reference implementation: one intersection per cell."""
+    gx, gy = project_splitting.get_grid_lattice(boundary.bounds, dimension)
+    grid = []
+    for i in range(len(gx) - 1):
+        for j in range(len(gy) - 1):
+            cell = Polygon(
+                [
+                    [gx[i], gy[j]],
+                    [gx[i], gy[j + 1]],
+                    [gx[i + 1], gy[j + 1]],
+                    [gx[i + 1], gy[j]],
+                    [gx[i], gy[j]],
+                ]
+            )
+            geom = boundary.intersection(cell)
+            if geom.geom_type == "MultiPolygon":
+                grid.extend(geom.geoms)
+            elif geom.geom_type == "Polygon" and not geom.is_empty:
+                grid.append(geom)
+    return grid
+
+
+@pytest.mark.parametrize("dimension", [10, 50, 100])
+def test_grid_matches_cell_by_cell_intersection(boundary, dimension):
+    expected = looped_grid(boundary, dimension)
+    grid = project_splitting.create_grid(boundary, dimension)
+
+    assert len(grid) == len(expected)
+    assert all(a.equals(b) for a, b in zip(grid, expected))
+
+
+def test_grid_feature_collection_ids(boundary):
+    grid = project_splitting.create_grid(boundary, 100)
+    collection = project_splitting.grid_to_feature_collection(grid)
+
+    ids = [feature["properties"]["id"] for feature in collection["features"]]
+    assert ids == [str(i) for i in range(1, len(grid) + 1)]
+
+
+def test_grid_larger_than_boundary(boundary):
+    assert project_splitting.create_grid(boundary, 5000) == []
+
+
+@pytest.mark.parametrize("grid_type", list(GridType))
+def test_projected_grid_covers_boundary(boundary, grid_type):
+    grid = project_splitting.create_grid(boundary, 100, grid_type, projected=True)
+
+    assert all(polygon.is_valid for polygon in grid)
+    assert shapely.union_all(grid).symmetric_difference(boundary).area == (
+        pytest.approx(0, abs=boundary.area * 1e-5)
+    )
+
+
+def test_projected_grid_is_metric_at_high_latitude():
+    boundary = shapely.box(20.0, 69.0, 20.2, 69.1)
+    forward, _ = project_splitting.get_local_projection(boundary)
+
+    grid = project_splitting.create_grid(boundary, 1000, projected=True)
+    areas = [shapely.transform(polygon, forward).area for polygon in grid]
+
+    assert max(areas) == pytest.approx(1000 * 1000, rel=1e-3)
+
+
+def test_split_by_feature_count():
+    boundary = shapely.box(0, 0, 1, 0.5)
+    rng = np.random.default_rng(0)
+    points = np.concatenate(
+        [
+            rng.normal(0.25, 0.02, (5000, 2)),
+            rng.uniform((0, 0), (1, 0.5), (1000, 2)),
+        ]
+    )
+
+    tasks = project_splitting.split_by_feature_count(boundary, points, 200)
+    counts = [shapely.contains_xy(task, *points.T).sum() for task in tasks]
+
+    assert max(counts) <= 200
+    assert sum(counts) == len(points)
+    assert shapely.union_all(tasks).equals(boundary)
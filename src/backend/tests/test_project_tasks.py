@@ -0,0 +1,76 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+import pytest
+from fastapi import HTTPException
+
+from app.db import db_models
+from app.models.enums import TaskAction
+from app.projects import project_crud
+
+OUTLINE = "SRID=4326;POLYGON((0 0,0 1,1 1,1 0,0 0))"
+
+
+@pytest.fixture
+def user(db):
+    user = db_models.DbUser(username="split_test")
+    db.add(user)
+    db.flush()
+    return user
+
+
+@pytest.fixture
+def task(db, user):
+    project = db_models.DbProject(author_id=user.id, outline=OUTLINE)
+    db.add(project)
+    db.flush()
+    task = db_models.DbTask(project_id=project.id, outline=OUTLINE)
+    db.add(task)
+    db.flush()
+    return task
+
+
+def test_delete_project_tasks(db, task):
+    project_crud.delete_project_tasks(db, task.project_id)
+    assert not db.query(db_models.DbTask).filter_by(project_id=task.project_id).count()
+
+
+def test_tasks_with_history_are_kept(db, user, task):
+    history = db_models.DbTaskHistory(
+        project_id=task.project_id,
+        task_id=task.id,
+        action=TaskAction.LOCKED_FOR_MAPPING,
+        user_id=user.id,
+    )
+    db.add(history)
+    db.flush()
+
+    with pytest.raises(HTTPException) as error:
+        project_crud.delete_project_tasks(db, task.project_id)
+    assert error.value.status_code == 400
+    assert db.query(db_models.DbTask).filter_by(project_id=task.project_id).count()
+
+
+def test_save_task_qrcodes(db, task):
+    images = {task.id: b"png"}
+    project_crud.save_task_qrcodes(db, task.project_id, images, "project.png")
+    db.expire_all()
+
+    task = db.query(db_models.DbTask).filter_by(id=task.id).one()
+    assert task.qr_code.image == b"png"
+    assert task.qr_code.filename == "project.png"
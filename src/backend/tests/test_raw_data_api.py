@@ -0,0 +1,119 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+import asyncio
+import io
+import json
+import zipfile
+
+import pytest
+from fastapi import HTTPException
+
+from app.config import settings
+from app.projects import raw_data_api
+
+EXPORT = {
+    "type": "FeatureCollection",
+    "features": [
+        {
+            "type": "Feature",
+            "geometry": {"type": "LineString", "coordinates": [[0, 0], [1, 1]]},
+            "properties": {"osm_id": 1, "highway": "track"},
+        }
+    ],
+}
+
+
+def snapshot(request):
+    return {"task_id": "abc"}
+
+
+def task_status(request):
+    server = request.server
+    server.polls += 1
+    if server.polls < server.pending_polls:
+        return {"id": "abc", "status": "PENDING", "result": None}
+    url = f"{server.url}/export"
+    return {"id": "abc", "status": "SUCCESS", "result": {"download_url": url}}
+
+
+def export(request):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("Export.geojson", json.dumps(EXPORT))
+    return buffer.getvalue()
+
+
+# Minimal raw-data-api: snapshot, status polling and zip download
+ROUTES = {
+    ("POST", "/snapshot/"): snapshot,
+    ("GET", "/tasks/status/.+"): task_status,
+    ("GET", "/export"): export,
+}
+
+
+@pytest.fixture(autouse=True)
+def extract_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "EXTRACT_CACHE_DIR", str(tmp_path))
+
+
+@pytest.fixture
+def raw_data_server(stub_server):
+    server = stub_server(ROUTES)
+    server.polls = 0
+    server.pending_polls = 3
+    return server
+
+
+def test_get_osm_extracts(raw_data_server):
+    data = asyncio.run(
+        raw_data_api.get_osm_extracts(
+            {"type": "Point", "coordinates": [0, 0]},
+            base_url=raw_data_server.url,
+            poll_interval=0.01,
+        )
+    )
+
+    assert data == EXPORT
+    assert raw_data_server.polls == 3
+
+    # The same AOI is served from the extract cache
+    data = asyncio.run(
+        raw_data_api.get_osm_extracts(
+            {"type": "Point", "coordinates": [0, 0]},
+            base_url=raw_data_server.url,
+        )
+    )
+    assert data == EXPORT
+    assert raw_data_server.polls == 3
+
+
+def test_get_osm_extracts_timeout(raw_data_server):
+    raw_data_server.pending_polls = 1000
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(
+            raw_data_api.get_osm_extracts(
+                {"type": "Point", "coordinates": [0, 0]},
+                base_url=raw_data_server.url,
+                timeout=0.2,
+                poll_interval=0.01,
+            )
+        )
+
+    assert error.value.status_code == 504
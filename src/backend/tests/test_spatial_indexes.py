@@ -0,0 +1,141 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+import json
+
+import pytest
+from sqlalchemy.sql import text
+
+from app.db import db_models
+
+FEATURE_COUNT = 1_000_000
+
+
+def plan_indexes(db, query: str, params: dict) -> set:
+    """Get the names of the indexes used in the query plan."""
+    result = db.execute(text(f"EXPLAIN (FORMAT JSON) {query}"), params)
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    indexes = set()
+    nodes = [plan[0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        if "Index Name" in node:
+            indexes.add(node["Index Name"])
+        nodes.extend(node.get("Plans", []))
+    return indexes
+
+
+@pytest.fixture
+def project_id(db):
+    """A 1x1 degree project with 10,000 tasks, 1M features and 2,000 lines."""
+    user = db_models.DbUser(username="index_test")
+    db.add(user)
+    db.flush()
+
+    project = db_models.DbProject(
+        author_id=user.id, outline="SRID=4326;POLYGON((0 0,0 1,1 1,1 0,0 0))"
+    )
+    db.add(project)
+    db.flush()
+
+    params = {"project_id": project.id, "count": FEATURE_COUNT}
+    db.execute(
+        text(
+            """INSERT INTO tasks (project_id, project_task_name, outline, task_status)
+            SELECT :project_id, cell.i || '_' || cell.j, cell.geom, 'READY'
+            FROM ST_SquareGrid(
+                0.01, ST_MakeEnvelope(0, 0, 1, 1, 4326)
+            ) AS cell"""
+        ),
+        params,
+    )
+    db.execute(
+        text(
+            """INSERT INTO features (project_id, geometry, properties)
+            SELECT
+                :project_id,
+                ST_SetSRID(ST_MakePoint(random(), random()), 4326),
+                '{}'::jsonb
+            FROM generate_series(1, :count)"""
+        ),
+        params,
+    )
+    db.execute(
+        text(
+            """INSERT INTO osm_lines (project_id, geometry)
+            SELECT
+                :project_id,
+                ST_SetSRID(
+                    ST_MakeLine(ST_MakePoint(x, 0), ST_MakePoint(x, 1)), 4326
+                )
+            FROM generate_series(0.0005, 1, 0.0005) AS x"""
+        ),
+        params,
+    )
+    for table in ("tasks", "features", "osm_lines"):
+        db.execute(text(f"ANALYZE {table}"))
+    return project.id
+
+
+# Hot spatial queries, and the spatial indexes they are expected to use
+QUERIES = [
+    (
+        # Feature to task assignment in generate_appuser_files
+        """SELECT DISTINCT ON (f.id) f.id, t.id
+        FROM features AS f
+        JOIN tasks AS t
+            ON t.project_id = f.project_id
+            AND ST_Intersects(t.outline, f.geometry)
+        WHERE f.project_id = :project_id
+        ORDER BY f.id, ST_Intersects(t.outline, ST_Centroid(f.geometry)) DESC, t.id""",
+        {"idx_features_geometry", "idx_tasks_outline"},
+    ),
+    (
+        # Features within one task
+        """SELECT f.id
+        FROM features AS f, tasks AS t
+        WHERE t.project_id = :project_id
+        AND t.project_task_name = '0_0'
+        AND ST_Intersects(f.geometry, t.outline)""",
+        {"idx_features_geometry"},
+    ),
+    (
+        """SELECT id
+        FROM tasks
+        WHERE project_id = :project_id
+        AND ST_Intersects(outline, ST_MakeEnvelope(0.1, 0.1, 0.11, 0.11, 4326))""",
+        {"idx_tasks_outline"},
+    ),
+    (
+        """SELECT id
+        FROM osm_lines
+        WHERE project_id = :project_id
+        AND ST_Intersects(geometry, ST_MakeEnvelope(0.1, 0.1, 0.11, 0.11, 4326))""",
+        {"idx_osm_lines_geometry"},
+    ),
+]
+
+
+def test_spatial_queries_use_indexes(db, project_id):
+    # The synthetic project is large, so it is built once for all queries
+    for query, expected in QUERIES:
+        indexes = plan_indexes(db, query, {"project_id": project_id})
+        assert expected <= indexes, query
@@ -0,0 +1,97 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+import io
+import os
+import zipfile
+
+import pytest
+from fastapi import HTTPException
+
+from app.submission import submission_crud
+
+
+def make_zip(entries: dict, compression=zipfile.ZIP_DEFLATED) -> io.BytesIO:
+    file = io.BytesIO()
+    with zipfile.ZipFile(file, "w", compression=compression) as archive:
+        for name, data in entries.items():
+            archive.writestr(name, data)
+    file.seek(0)
+    return file
+
+
+def test_stream_zip(monkeypatch):
+    monkeypatch.setattr(submission_crud, "STREAM_CHUNK_SIZE", 1024)
+    photo = os.urandom(500_000)
+    archives = [
+        ("task_1", make_zip({"submissions.csv": "a,b\n1,2\n", "media/1.jpg": photo})),
+        ("task_2", make_zip({"submissions.csv": "a,b\n3,4\n"}, zipfile.ZIP_STORED)),
+    ]
+
+    chunks = list(submission_crud.stream_zip(archives))
+
+    # The zip is sent in pieces, not all at once
+    assert len([chunk for chunk in chunks if chunk]) > 10
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as merged:
+        assert merged.testzip() is None
+        assert merged.namelist() == [
+            "task_1/submissions.csv",
+            "task_1/media/1.jpg",
+            "task_2/submissions.csv",
+        ]
+        assert merged.read("task_1/media/1.jpg") == photo
+        assert merged.read("task_2/submissions.csv") == b"a,b\n3,4\n"
+        assert merged.getinfo("task_1/media/1.jpg").compress_type == (
+            zipfile.ZIP_DEFLATED
+        )
+
+
+def test_stream_zip_empty():
+    data = b"".join(submission_crud.stream_zip([]))
+    with zipfile.ZipFile(io.BytesIO(data)) as merged:
+        assert merged.namelist() == []
+
+
+def test_failed_task_fails_the_zip(monkeypatch):
+    def download(odkid, xform_id, file, odk_credentials):
+        if xform_id == "2":
+            raise ConnectionError("timed out")
+        file.write(make_zip({"submissions.csv": "a,b\n1,2\n"}).getvalue())
+        file.seek(0)
+
+    monkeypatch.setattr(submission_crud, "download_submission_media", download)
+    xform_ids = {"task_1": "1", "task_2": "2"}
+
+    # Read up to the first block before the response starts
+    blocks = submission_crud.prime_stream(
+        submission_crud.stream_zip(
+            submission_crud.task_media_archives(1, xform_ids, None)
+        )
+    )
+    with pytest.raises(HTTPException) as error:
+        list(blocks)
+    assert error.value.status_code == 502
+    assert "form 2" in error.value.detail
+
+    # A failure before the first block is raised before the response starts
+    with pytest.raises(HTTPException):
+        submission_crud.prime_stream(
+            submission_crud.stream_zip(
+                submission_crud.task_media_archives(1, {"task_2": "2"}, None)
+            )
+        )
@@ -0,0 +1,130 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+from datetime import datetime
+
+import pytest
+
+from app.central import odk_clients
+from app.projects import project_schemas
+from app.submission import submission_sync
+
+SUBMISSIONS = [
+    {
+        "__id": f"uuid:{i}",
+        "__system": {
+            "submissionDate": f"2023-07-0{i}T10:00:00.000Z",
+            "updatedAt": None,
+        },
+        "survey": {"location": {"type": "Point", "coordinates": [85.3, 27.7, 0, 5]}},
+    }
+    for i in range(1, 6)
+]
+# The first submission was reviewed after the others were made
+SUBMISSIONS[0]["__system"]["updatedAt"] = "2023-07-06T10:00:00.000Z"
+
+
+def login(request):
+    return {"token": "token", "expiresAt": "2999-01-01T00:00:00Z"}
+
+
+def odata_submissions(request):
+    """Two submissions a page, filtered by submission or update date."""
+    query = request.query
+    submissions = SUBMISSIONS
+    if "$filter" in query:
+        since = query["$filter"][0].split(" ge ")[1].split(" or ")[0]
+        submissions = [
+            s
+            for s in submissions
+            if s["__system"]["submissionDate"] >= since
+            or (s["__system"]["updatedAt"] or "") >= since
+        ]
+
+    skip = int(query.get("$skip", ["0"])[0])
+    data = {"value": submissions[skip : skip + 2]}
+    if skip + 2 < len(submissions):
+        next_query = f"$skip={skip + 2}"
+        if "$filter" in query:
+            next_query += f"&$filter={query['$filter'][0]}"
+        path = request.path.split("?")[0]
+        data["@odata.nextLink"] = f"{request.server.url}{path}?{next_query}"
+    return data
+
+
+# Minimal ODK Central OData submissions feed
+ROUTES = {
+    ("POST", "/v1/sessions"): login,
+    ("GET", r".*\.svc/Submissions"): odata_submissions,
+}
+
+
+@pytest.fixture
+def odk_central(stub_server):
+    server = stub_server(ROUTES)
+    yield server, project_schemas.ODKCentral(
+        odk_central_url=server.url,
+        odk_central_user="admin",
+        odk_central_password="secret",
+    )
+    odk_clients.clear()
+
+
+def test_fetch_submissions(odk_central):
+    server, credentials = odk_central
+
+    submissions = submission_sync.fetch_submissions(1, "7", None, credentials)
+    assert [s["__id"] for s in submissions] == [s["__id"] for s in SUBMISSIONS]
+    pages = [query for method, _, query in server.requests if method == "GET"]
+    assert len(pages) == 3
+
+    # Only the submissions made or updated since the high-water mark
+    since = datetime(2023, 7, 4, 10)
+    submissions = submission_sync.fetch_submissions(1, "7", since, credentials)
+    assert [s["__id"] for s in submissions] == ["uuid:1", "uuid:4", "uuid:5"]
+    assert server.requests[-1][2]["$filter"] == [
+        "__system/submissionDate ge 2023-07-04T10:00:00.000Z"
+        " or __system/updatedAt ge 2023-07-04T10:00:00.000Z"
+    ]
+    assert submission_sync.last_change(SUBMISSIONS[0]) == datetime(2023, 7, 6, 10)
+    assert submission_sync.last_change(SUBMISSIONS[1]) == datetime(2023, 7, 2, 10)
+
+
+def test_submission_geometry():
+    assert submission_sync.submission_geometry(SUBMISSIONS[0]) == {
+        "type": "Point",
+        "coordinates": [85.3, 27.7, 0, 5],
+    }
+    assert submission_sync.submission_geometry({"survey": [{"name": "x"}]}) is None
+
+
+def test_parse_date():
+    date = submission_sync.parse_date("2023-07-04T10:00:00.123Z")
+    assert date == datetime(2023, 7, 4, 10, 0, 0, 123000)
+    assert submission_sync.odata_date(date) == "2023-07-04T10:00:00.123Z"
+
+
+def test_submission_point():
+    # In the shape of the points read from the ODK Central CSV export
+    data = {"warmup": {"type": "Point", "coordinates": [85.3, 27.7, 1300.0, 5.0]}}
+    assert submission_sync.submission_point(data) == {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": ("27.7", "85.3")},
+    }
+    assert submission_sync.submission_point(SUBMISSIONS[0]) is None
+    assert submission_sync.submission_point({"warmup": None}) is None
@@ -0,0 +1,128 @@
+# Copyright (c) 2022, 2023 Humanitarian OpenStreetMap Team
+#
+# This file is part of FMTM.
+#
+#     FMTM is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     FMTM is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with FMTM.  If not, see <https:#www.gnu.org/licenses/>.
+#
+
+import shutil
+import threading
+
+import xmltodict
+from osm_fieldwork.xlsforms import xlsforms_path
+
+from app.central import central_crud
+
+
+def test_xlsform_is_converted_once(tmp_path, monkeypatch):
+    xlsform = tmp_path / "buildings.xls"
+    shutil.copy(f"{xlsforms_path}/buildings.xls", xlsform)
+
+    conversions = []
+    convert = central_crud.xls2xform_convert
+
+    def counting_convert(**kwargs):
+        conversions.append(kwargs["xlsform_path"])
+        return convert(**kwargs)
+
+    monkeypatch.setattr(central_crud, "xls2xform_convert", counting_convert)
+
+    forms = []
+    for task_id in (1, 2):
+        xform = str(tmp_path / f"project_buildings_{task_id}.xml")
+        central_crud.generate_updated_xform(task_id, str(xlsform), xform)
+        with open(xform) as f:
+            forms.append(xmltodict.parse(f.read()))
+
+    assert conversions == [str(xlsform)]
+
+    for task_id, form in zip((1, 2), forms):
+        head = form["h:html"]["h:head"]
+        assert head["h:title"] == f"project_buildings_{task_id}"
+        sources = [inst.get("@src") for inst in head["model"]["instance"]]
+        assert f"jr://file/project_buildings_{task_id}.geojson" in sources
+
+
+def test_conversions_do_not_block_other_forms(tmp_path, monkeypatch):
+    first, second = tmp_path / "first.xls", tmp_path / "second.xls"
+    shutil.copy(f"{xlsforms_path}/buildings.xls", first)
+    shutil.copy(f"{xlsforms_path}/buildings.xls", second)
+    second.write_bytes(second.read_bytes() + b"\0")
+
+    started, release = threading.Event(), threading.Event()
+    convert = central_crud.convert_xlsform
+
+    def slow_convert(xlsform):
+        if xlsform == str(first):
+            started.set()
+            release.wait(5)
+        return convert(xlsform)
+
+    monkeypatch.setattr(central_crud, "convert_xlsform", slow_convert)
+    thread = threading.Thread(target=central_crud.get_xform_template, args=[str(first)])
+    thread.start()
+    started.wait(5)
+
+    # Converted while the first form is still being converted
+    assert central_crud.get_xform_template(str(second))
+    assert not release.is_set()
+    release.set()
+    thread.join()
+
+
+def test_failed_conversion_keeps_the_lock_of_waiting_threads(tmp_path, monkeypatch):
+    xlsform = tmp_path / "failing.xls"
+    shutil.copy(f"{xlsforms_path}/buildings.xls", xlsform)
+
+    started, release = threading.Event(), threading.Event()
+    conversions, done, overlapped = [], [], []
+    convert = central_crud.convert_xlsform
+
+    def failing_convert(xlsform):
+        if len(conversions) > len(done):
+            overlapped.append(xlsform)
+        conversions.append(xlsform)
+        try:
+            if len(conversions) == 1:
+                started.set()
+                release.wait(5)
+                raise ValueError("bad form")
+            return convert(xlsform)
+        finally:
+            done.append(xlsform)
+
+    def get_template():
+        try:
+            central_crud.get_xform_template(str(xlsform))
+        except ValueError:
+            pass
+
+    monkeypatch.setattr(central_crud, "convert_xlsform", failing_convert)
+    first = threading.Thread(target=get_template)
+    first.start()
+    assert started.wait(5)
+
+    # Waits on the lock of the first conversion, which then fails
+    second = threading.Thread(target=get_template)
+    second.start()
+    second.join(0.5)
+    release.set()
+    first.join(5)
+
+    # A new thread does not convert the form alongside the waiting one
+    assert central_crud.get_xform_template(str(xlsform))
+    second.join(5)
+    assert not overlapped
+    assert len(conversions) == 2
+    assert not central_crud._xform_template_locks